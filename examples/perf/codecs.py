@@ -0,0 +1,68 @@
+import contextlib
+import io
+import time
+
+from pubsub.common import CODECS, FrameReader, construct_message
+from pubsub.server import MessageQueueHandler, RoutingTable
+
+
+# Measures the broker's cost of handling one published message in-process, without sockets, for a protocol 1 JSON
+# publish (decoded, stamped and re-encoded) and protocol 2 publishes that are forwarded without being decoded.
+
+
+class NullHandler(MessageQueueHandler):
+    connections = dict()
+    routes = RoutingTable()
+
+    def __init__(self, protocol):
+        self.options = dict(ack='none')
+        self.reader = FrameReader()
+        self.subscriber_protocol = protocol
+
+    def open_connection(self):
+        conn_id = super(NullHandler, self).open_connection()
+        self.protocol = self.subscriber_protocol
+        return conn_id
+
+    def send_frame(self, frame, publisher=None, message=False):
+        pass
+
+
+def document(fields):
+    return dict(('field%s' % i, dict(values=list(range(10)), name='sensor %s' % i, ok=True)) for i in range(fields))
+
+
+def bench(protocol, codec, message, count=2000):
+    NullHandler.connections = dict()
+    NullHandler.routes = RoutingTable()
+
+    publisher = NullHandler(protocol)
+    publisher_id = publisher.open_connection()
+    for i in range(10):
+        h = NullHandler(2)
+        h.subscribe(h.open_connection(), 'bench')
+
+    publisher.reader.protocol = protocol
+    frame = publisher.reader.feed(construct_message('bench', message, protocol, codec=codec))[0]
+
+    start_time = time.perf_counter()
+    for i in range(count):
+        publisher.handle_frame(publisher_id, *frame)
+    elapsed = time.perf_counter() - start_time
+    return elapsed / count * 1e6, len(frame[1])
+
+
+def main():
+    for fields in (1, 10, 100):
+        message = document(fields)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = [('protocol 1 json', bench(1, None, message)),
+                       ('protocol 2 json', bench(2, CODECS['json'], message)),
+                       ('protocol 2 marshal', bench(2, CODECS['marshal'], message))]
+
+        for label, (usec, size) in results:
+            print('%4s fields %-20s %8s B  %8.2f us/msg' % (fields, label, size, usec))
+
+
+if __name__ == '__main__':
+    main()
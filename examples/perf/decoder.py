@@ -0,0 +1,70 @@
+import socket
+import threading
+import time
+
+from pubsub.common import FrameReader, construct_message, get_message
+
+
+# Compares the legacy common.get_message with FrameReader, reading frames from a local socket pair, and the
+# protocol 1 and protocol 2 framings.
+
+
+def writer(sock, frames):
+    for frame in frames:
+        sock.sendall(frame)
+
+
+def bench(read, frames):
+    a, b = socket.socketpair()
+    t = threading.Thread(target=writer, args=(a, frames))
+    t.start()
+
+    start_time = time.perf_counter()
+    read(b, len(frames))
+    elapsed = time.perf_counter() - start_time
+
+    t.join()
+    a.close()
+    b.close()
+    return elapsed
+
+
+def read_legacy(sock, count):
+    for i in range(count):
+        get_message(sock, timeout=10)
+
+
+def read_buffered(sock, count):
+    reader = FrameReader(sock)
+    for i in range(count):
+        reader.get_message(timeout=10)
+
+
+def read_v2(sock, count):
+    reader = FrameReader(sock)
+    reader.protocol = 2
+    for i in range(count):
+        reader.get_message(timeout=10)
+
+
+def report(name, messages):
+    cases = [('protocol 2', read_v2, [construct_message('bench', m, protocol=2) for m in messages])]
+    if not isinstance(messages[0], bytes):
+        frames = [construct_message('bench', m) for m in messages]
+        cases = [('get_message', read_legacy, frames), ('FrameReader', read_buffered, frames)] + cases
+
+    for label, read, frames in cases:
+        size = sum(len(f) for f in frames)
+        elapsed = bench(read, frames)
+        print('%-16s %-12s %10.0f msg/s %10.1f MB/s %8.1f B/msg' % (name, label, len(frames) / elapsed,
+                                                                    size / elapsed / 1e6, size / len(frames)))
+
+
+def main():
+    report('small', [dict(iteration=i) for i in range(100000)])
+    report('small raw bytes', [b'%16d' % i for i in range(100000)])
+    report('large (12 MB)', ['x' * 12000000 for i in range(5)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import os
+import signal
+import threading
+import time
+from multiprocessing import Process
+
+from pubsub import MessageQueue
+from pubsub.async_server import message_queue_process as async_process
+from pubsub.server import message_queue_process as threaded_process
+
+
+# Fan-out throughput of both engines: one publisher, several subscribers, for a few values of the flush_delay option
+# of the subscribers (0 writes as soon as possible, otherwise frames are held back that many milliseconds to be
+# coalesced into fewer writes).
+
+PORT = 6790
+SUBSCRIBERS = 8
+COUNT = 20000
+
+
+def consume(client, count, results):
+    received = 0
+    while received < count:
+        queue, message = client.get_message(timeout=10)
+        if queue is None:
+            break
+        if queue == 'bench':
+            received += 1
+
+    results.append((received, time.perf_counter()))
+
+
+def bench(port, flush_delay):
+    subscribers = []
+    for i in range(SUBSCRIBERS):
+        client = MessageQueue(port=port, protocol=2)
+        client.connect()
+        client.set_options(flush_delay=flush_delay)
+        client.subscribe('bench')
+        subscribers.append(client)
+
+    publisher = MessageQueue(port=port, protocol=2)
+    publisher.connect()
+    publisher.set_options(ack='none')
+    publisher.wait_for_ack()
+    for client in subscribers:
+        client.wait_for_ack()
+
+    results = []
+    threads = [threading.Thread(target=consume, args=(c, COUNT, results)) for c in subscribers]
+    for t in threads:
+        t.start()
+
+    start_time = time.perf_counter()
+    for i in range(COUNT):
+        publisher.send_message('bench', b'%64d' % i)
+
+    for t in threads:
+        t.join()
+
+    elapsed = max(end for received, end in results) - start_time
+    received = sum(received for received, end in results)
+
+    publisher.close()
+    for client in subscribers:
+        client.close()
+
+    return received, elapsed
+
+
+def main():
+    for port, (engine, target) in enumerate([('threaded', threaded_process), ('asyncio', async_process)], PORT):
+        p = Process(target=target, args=('127.0.0.1', port))
+        p.start()
+        time.sleep(0.5)
+
+        try:
+            for flush_delay in (0, 1, 5):
+                received, elapsed = bench(port, flush_delay)
+                print('%-10s flush_delay=%-3s %8d delivered %10.0f msg/s' % (engine, flush_delay, received,
+                                                                            received / elapsed))
+        finally:
+            os.kill(p.pid, signal.SIGTERM)
+            p.join()
+
+
+if __name__ == '__main__':
+    main()
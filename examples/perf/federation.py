@@ -0,0 +1,96 @@
+import os
+import signal
+import threading
+import time
+from multiprocessing import Process
+
+from pubsub import MessageQueue
+from pubsub.federation import Federation
+from pubsub.server import message_queue_process
+
+
+# Latency and throughput across federated brokers on localhost: two brokers bridged to each other, with the
+# subscriber on the same broker as the publisher, then on the other one.
+
+PORT = 6800
+PINGS = 2000
+COUNT = 20000
+
+
+def latency(publisher, subscriber):
+    samples = []
+    for i in range(PINGS):
+        start_time = time.perf_counter()
+        publisher.send_message('bench.ping', b'%d' % i)
+        while True:
+            queue, message = subscriber.get_message(timeout=10)
+            if queue == 'bench.ping':
+                break
+        samples.append(time.perf_counter() - start_time)
+
+    samples.sort()
+    return samples[len(samples) // 2] * 1e6, samples[int(len(samples) * 0.99)] * 1e6
+
+
+def throughput(publisher, subscriber):
+    results = []
+
+    def consume():
+        received = 0
+        while received < COUNT:
+            queue, message = subscriber.get_message(timeout=10)
+            if queue is None:
+                break
+            if queue == 'bench.flood':
+                received += 1
+        results.append((received, time.perf_counter()))
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    start_time = time.perf_counter()
+    for i in range(COUNT):
+        publisher.send_message('bench.flood', b'%64d' % i)
+    thread.join()
+
+    received, end_time = results[0]
+    return received, received / (end_time - start_time)
+
+
+def main():
+    ports = (PORT, PORT + 1)
+    processes = [Process(target=message_queue_process, args=('127.0.0.1', port, None, None,
+                                                             Federation([('127.0.0.1', peer)])))
+                 for port, peer in zip(ports, reversed(ports))]
+    for p in processes:
+        p.start()
+    time.sleep(2)
+
+    try:
+        for label, subscriber_port in (('same broker', ports[0]), ('across bridge', ports[1])):
+            publisher = MessageQueue(port=ports[0], protocol=2)
+            publisher.connect()
+            publisher.set_options(ack='none')
+            subscriber = MessageQueue(port=subscriber_port, protocol=2)
+            subscriber.connect()
+            subscriber.subscribe('bench.#')
+            subscriber.wait_for_ack()
+            publisher.wait_for_ack()
+            # the subscription reaches the other broker through its bridge
+            time.sleep(0.5)
+
+            p50, p99 = latency(publisher, subscriber)
+            received, rate = throughput(publisher, subscriber)
+            print('%-14s latency p50 %6.0f us  p99 %6.0f us  throughput %8d delivered %8.0f msg/s'
+                  % (label, p50, p99, received, rate))
+
+            publisher.close()
+            subscriber.close()
+    finally:
+        for p in processes:
+            os.kill(p.pid, signal.SIGTERM)
+        for p in processes:
+            p.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import os
+import signal
+import threading
+import time
+from multiprocessing import Process
+
+from pubsub import MessageQueue
+from pubsub.publisher import PublisherPool
+from pubsub.server import message_queue_process
+
+
+# Publish rate of many application threads: each with its own MessageQueue, against all of them sharing one
+# PublisherPool with a few connections. The rate counts the messages the broker has accepted, and a subscriber
+# checks that every message was delivered.
+
+PORT = 6805
+COUNT = 5000  # per thread
+QUEUES = 16
+
+
+def subscriber(total, results):
+    client = MessageQueue(port=PORT, protocol=2)
+    client.connect()
+    client.subscribe('bench.#')
+    client.wait_for_ack()
+
+    def consume():
+        received = 0
+        while received < total:
+            queue, message = client.get_message(timeout=10)
+            if queue is None:
+                break
+            if queue.startswith('bench.'):
+                received += 1
+        results.append(received)
+        client.close()
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    return thread
+
+
+def own_connections(threads):
+    clients = []
+    for i in range(threads):
+        client = MessageQueue(port=PORT, protocol=2)
+        client.connect()
+        client.set_options(ack='none')
+        clients.append(client)
+
+    def produce(client, i):
+        for j in range(COUNT):
+            client.send_message('bench.%s' % ((i + j) % QUEUES), b'%64d' % j)
+        client.wait_for_ack()
+
+    workers = [threading.Thread(target=produce, args=(c, i)) for i, c in enumerate(clients)]
+    start_time = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start_time
+
+    for client in clients:
+        client.close()
+
+    return elapsed, threads
+
+
+def pooled(threads, connections):
+    pool = PublisherPool(port=PORT, connections=connections)
+
+    def produce(i):
+        for j in range(COUNT):
+            pool.publish('bench.%s' % ((i + j) % QUEUES), b'%64d' % j)
+
+    workers = [threading.Thread(target=produce, args=(i,)) for i in range(threads)]
+    start_time = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    pool.flush(timeout=60)
+    elapsed = time.perf_counter() - start_time
+
+    pool.close()
+    return elapsed, connections
+
+
+def main():
+    process = Process(target=message_queue_process, args=('127.0.0.1', PORT))
+    process.start()
+    time.sleep(1)
+
+    try:
+        for threads in (4, 16, 64):
+            for label, run in (('own connections', lambda: own_connections(threads)),
+                               ('pool of 2', lambda: pooled(threads, 2)),
+                               ('pool of 4', lambda: pooled(threads, 4))):
+                results = []
+                consumer = subscriber(threads * COUNT, results)
+                elapsed, connections = run()
+                consumer.join()
+                print('threads=%-3s %-16s %3s connections %10.0f msg/s  delivered %s/%s'
+                      % (threads, label, connections, threads * COUNT / elapsed, results[0], threads * COUNT))
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import contextlib
+import io
+import time
+
+from pubsub.common import encode_message
+from pubsub.server import Envelope, MessageQueueHandler, RoutingTable
+
+
+# Measures the broker's publish cost in-process, without sockets, while the number of connections that are not
+# subscribed to the published queue grows, with exact subscriptions and then with patterns. With the routing table
+# and its cache of pattern matches the cost should stay flat.
+
+
+class NullHandler(MessageQueueHandler):
+    connections = dict()
+    routes = RoutingTable()
+
+    def __init__(self):
+        self.options = dict()
+        self.protocol = 1
+        self.delivered = 0
+
+    def send_frame(self, frame, publisher=None, message=False):
+        self.delivered += 1
+
+    def respond(self, conn_id, text):
+        pass
+
+
+def bench(unrelated, listeners=10, count=20000, patterns=False):
+    NullHandler.connections = dict()
+    NullHandler.routes = RoutingTable()
+
+    publisher = NullHandler()
+    publisher_id = publisher.open_connection()
+
+    for i in range(listeners):
+        h = NullHandler()
+        h.subscribe(h.open_connection(), 'bench.*' if patterns else 'bench.1')
+
+    for i in range(unrelated):
+        h = NullHandler()
+        h.subscribe(h.open_connection(), 'other-%s.#' % i if patterns else 'other-%s' % i)
+
+    envelope = Envelope('bench.1', encode_message(dict(iteration=0)), 0, publisher_id, 0, stamped=True)
+    start_time = time.perf_counter()
+    for i in range(count):
+        publisher.broadcast('bench.1', envelope, publisher_id)
+    elapsed = time.perf_counter() - start_time
+    return elapsed / count * 1e6
+
+
+def main():
+    # open_connection prints the client count
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = [(n, bench(n), bench(n, patterns=True)) for n in (0, 100, 1000, 10000)]
+
+    for unrelated, usec, pattern_usec in results:
+        print('Unrelated connections: %6s  publish cost: %.2f us  with patterns: %.2f us' % (unrelated, usec,
+                                                                                           pattern_usec))
+
+
+if __name__ == '__main__':
+    main()
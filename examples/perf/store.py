@@ -0,0 +1,76 @@
+import contextlib
+import io
+import shutil
+import tempfile
+import time
+
+from pubsub.server import MessageQueueHandler, RoutingTable, ThreadedTCPServer
+from pubsub.store import LogStore
+
+
+# Per-message broker cost of publishing to one subscriber, in-process without sockets, with history kept in memory
+# and in a LogStore with each fsync policy, then the cost of a get_history replay.
+
+
+class NullHandler(MessageQueueHandler):
+    connections = dict()
+    routes = RoutingTable()
+
+    def __init__(self):
+        self.options = dict(ack='none')
+        self.protocol = 1
+
+    def send_frame(self, frame, publisher=None, message=False):
+        pass
+
+    def respond(self, conn_id, text):
+        pass
+
+
+def bench(store, count):
+    NullHandler.connections = dict()
+    NullHandler.routes = RoutingTable()
+    ThreadedTCPServer.HISTORY = dict()
+    ThreadedTCPServer.STORE = store
+
+    publisher = NullHandler()
+    publisher_id = publisher.open_connection()
+    subscriber = NullHandler()
+    subscriber.subscribe(subscriber.open_connection(), 'bench')
+
+    start_time = time.perf_counter()
+    for i in range(count):
+        publisher.publish(publisher_id, [('bench', dict(iteration=i, pad='x' * 100))])
+    publish = (time.perf_counter() - start_time) / count * 1e6
+
+    start_time = time.perf_counter()
+    for i in range(1000):
+        subscriber.get_history(publisher_id, ['bench'])
+    replay = (time.perf_counter() - start_time) / 1000 * 1e6
+
+    return publish, replay
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        cases = [('memory', None, 50000)]
+        for policy, count in (('never', 50000), ('interval', 50000), ('always', 2000)):
+            cases.append(('store, fsync=%s' % policy, LogStore(tempfile.mkdtemp(dir=directory), fsync=policy), count))
+
+        for label, store, count in cases:
+            with contextlib.redirect_stdout(io.StringIO()):
+                if store is not None:
+                    store.open()
+                publish, replay = bench(store, count)
+                if store is not None:
+                    store.close()
+
+            print('%-24s publish: %7.2f us/msg  get_history: %7.2f us' % (label, publish, replay))
+    finally:
+        ThreadedTCPServer.STORE = None
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import os
+import signal
+import threading
+import time
+import tracemalloc
+from multiprocessing import Process
+
+from pubsub import MessageQueue, ThreadedMessageQueue
+from pubsub.async_server import message_queue_process as async_process
+from pubsub.server import message_queue_process as threaded_process
+from pubsub.stream import MessageStream
+
+
+# A large message published as one message and streamed in chunks (send_stream), while another publisher sends a
+# small message every few milliseconds. The subscriber gets both, and its peak memory (tracemalloc) shows what it
+# held of the large message at once: all of it, or a chunk at a time. The latency of the small messages is from
+# their publishing to their arrival at the subscriber: behind one large frame they wait for all of it to be written,
+# between chunks only for the chunks queued ahead of them, which the max_queued option of the subscriber bounds. On
+# loopback the large frame is written fast, so the gap is in the tail. The publishers run in another process, so only
+# the subscriber is measured.
+
+PORT = 6810
+SIZE = 32 * 1024 * 1024
+BLOCK = os.urandom(1024 * 1024)
+PING_INTERVAL = 0.005
+MAX_QUEUED = 16
+
+
+def blocks():
+    # generated as it is sent, so the streaming publisher never holds the message either
+    for i in range(SIZE // len(BLOCK)):
+        yield BLOCK
+
+
+def publish(port, streamed):
+    done = threading.Event()
+
+    def ping():
+        client = MessageQueue(port=port, protocol=2)
+        client.connect()
+        while not done.is_set():
+            client.send_message('ping', dict(sent=time.time()))
+            time.sleep(PING_INTERVAL)
+        client.send_message('ping', dict(sent=None))
+        client.wait_for_ack()
+
+    thread = threading.Thread(target=ping)
+    thread.start()
+    time.sleep(0.2)
+
+    client = MessageQueue(port=port, protocol=2)
+    client.connect()
+    if streamed:
+        client.send_stream('bulk', blocks())
+    else:
+        client.send_message('bulk', b''.join(blocks()))
+    client.wait_for_ack(timeout=60)
+
+    time.sleep(0.2)
+    done.set()
+    thread.join()
+
+
+def bench(port, streamed):
+    latencies = []
+    finished = threading.Event()
+
+    def on_ping(queue, message):
+        if message['sent'] is None:
+            finished.set()
+        else:
+            latencies.append(time.time() - message['sent'])
+
+    client = ThreadedMessageQueue(port=port, protocol=2)
+    client.connect()
+    client.set_options(max_queued=MAX_QUEUED).result()
+    client.subscribe('ping', callback=on_ping).result()
+    client.subscribe('bulk').result()
+
+    tracemalloc.start()
+    publisher = Process(target=publish, args=(port, streamed))
+    publisher.start()
+
+    start_time = time.perf_counter()
+    queue, message = client.get_message(timeout=60)
+    received = 0
+    if isinstance(message, MessageStream):
+        for chunk in message:
+            received += len(chunk)
+    elif message is not None:
+        received = len(message)
+    elapsed = time.perf_counter() - start_time
+    message = None
+
+    finished.wait(10)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    publisher.join()
+    client.close()
+
+    latencies.sort()
+    return received, elapsed, peak, latencies[len(latencies) // 2], latencies[len(latencies) * 99 // 100]
+
+
+def main():
+    for port, (engine, target) in enumerate([('threaded', threaded_process), ('asyncio', async_process)], PORT):
+        p = Process(target=target, args=('127.0.0.1', port))
+        p.start()
+        time.sleep(0.5)
+
+        try:
+            for label, streamed in (('message', False), ('streamed', True)):
+                received, elapsed, peak, median, slowest = bench(port, streamed)
+                print('%-9s %-9s %6.1f MB in %5.2fs  subscriber peak %7.1f MB  small messages p50 %7.1f ms  '
+                      'p99 %7.1f ms' % (engine, label, received / 1e6, elapsed, peak / 1e6, median * 1000,
+                                        slowest * 1000))
+        finally:
+            os.kill(p.pid, signal.SIGTERM)
+            p.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import os
+import signal
+import threading
+import time
+from multiprocessing import Process
+
+from pubsub import LocalBroker, MessageQueue
+from pubsub.async_server import message_queue_process
+
+
+# Delivery latency and publish rate over each transport, all served by the asyncio engine: TCP on the loopback, a Unix
+# domain socket, and a broker embedded in the benchmark process reached through local://. Latency is measured one
+# message at a time, from send_message to get_message on a subscriber of another connection.
+
+PORT = 6806
+PATH = '/tmp/coremq-bench.sock'
+ROUND_TRIPS = 5000
+COUNT = 50000
+
+
+def latency(address):
+    publisher = MessageQueue(address, PORT, protocol=2)
+    subscriber = MessageQueue(address, PORT, protocol=2)
+    publisher.connect()
+    publisher.set_options(ack='none')
+    subscriber.connect()
+    subscriber.subscribe('latency')
+    subscriber.wait_for_ack()
+    subscriber.get_message(timeout=1)
+
+    samples = []
+    for i in range(ROUND_TRIPS):
+        start_time = time.perf_counter()
+        publisher.send_message('latency', b'%64d' % i)
+        while True:
+            queue, message = subscriber.get_message(timeout=5)
+            if queue == 'latency' or queue is None:
+                break
+        samples.append(time.perf_counter() - start_time)
+
+    publisher.close()
+    subscriber.close()
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def throughput(address):
+    subscriber = MessageQueue(address, PORT, protocol=2)
+    subscriber.connect()
+    subscriber.subscribe('rate')
+    subscriber.wait_for_ack()
+    received = []
+
+    def consume():
+        count = 0
+        while count < COUNT:
+            queue, message = subscriber.get_message(timeout=5)
+            if queue is None:
+                break
+            if queue == 'rate':
+                count += 1
+        received.append(count)
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    publisher = MessageQueue(address, PORT, protocol=2)
+    publisher.connect()
+    publisher.set_options(ack='none')
+    start_time = time.perf_counter()
+    for i in range(COUNT):
+        publisher.send_message('rate', b'%64d' % i)
+    thread.join()
+    elapsed = time.perf_counter() - start_time
+
+    publisher.close()
+    subscriber.close()
+    return COUNT / elapsed, received[0]
+
+
+def report(label, address):
+    p50, p99 = latency(address)
+    rate, received = throughput(address)
+    print('%-6s p50 %7.1f us  p99 %7.1f us  %9.0f msg/s  delivered %s/%s'
+          % (label, p50 * 1e6, p99 * 1e6, rate, received, COUNT))
+
+
+def main():
+    for label, address in (('tcp', '127.0.0.1'), ('unix', 'unix://' + PATH)):
+        process = Process(target=message_queue_process, args=(address, PORT))
+        process.start()
+        time.sleep(1)
+        try:
+            report(label, address)
+        finally:
+            os.kill(process.pid, signal.SIGTERM)
+            process.join()
+
+    broker = LocalBroker('bench').start()
+    try:
+        report('local', 'local://bench')
+    finally:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
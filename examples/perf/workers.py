@@ -0,0 +1,101 @@
+import os
+import signal
+import threading
+import time
+from multiprocessing import Process
+
+from pubsub import MessageQueue
+from pubsub.server import message_queue_process
+from pubsub.workers import start_workers
+
+
+# Aggregate delivery rate of the threaded engine with 1, 2 and 4 worker processes: several publishers and subscribers
+# spread over the workers by the kernel, each subscriber receiving every queue. Messages published on one worker
+# reach the subscribers of the others through the worker owning the queue, so the rate only grows with the workers
+# when there are cores for them.
+
+PORT = 6795
+CLIENTS = 8
+QUEUES = 8
+COUNT = 5000  # per publisher
+
+
+def consume(client, count, results):
+    received = 0
+    while received < count:
+        queue, message = client.get_message(timeout=10)
+        if queue is None:
+            break
+        if queue.startswith('bench.'):
+            received += 1
+
+    results.append((received, time.perf_counter()))
+
+
+def produce(client, queue):
+    for i in range(COUNT):
+        client.send_message(queue, b'%64d' % i)
+    client.wait_for_ack()
+
+
+def bench(port):
+    subscribers = []
+    for i in range(CLIENTS):
+        client = MessageQueue(port=port, protocol=2)
+        client.connect()
+        client.subscribe('bench.#')
+        subscribers.append(client)
+
+    publishers = []
+    for i in range(CLIENTS):
+        client = MessageQueue(port=port, protocol=2)
+        client.connect()
+        client.set_options(ack='none')
+        publishers.append(client)
+
+    for client in subscribers + publishers:
+        client.wait_for_ack()
+    time.sleep(0.5)
+
+    results = []
+    threads = [threading.Thread(target=consume, args=(c, COUNT * CLIENTS, results)) for c in subscribers]
+    threads += [threading.Thread(target=produce, args=(c, 'bench.%s' % (i % QUEUES))) for i, c in
+                enumerate(publishers)]
+    start_time = time.perf_counter()
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    elapsed = max(end for received, end in results) - start_time
+    received = sum(received for received, end in results)
+
+    for client in subscribers + publishers:
+        client.close()
+
+    return received, elapsed
+
+
+def main():
+    for port, workers in enumerate((1, 2, 4), PORT):
+        if workers == 1:
+            processes = [Process(target=message_queue_process, args=('127.0.0.1', port))]
+            processes[0].start()
+        else:
+            processes = start_workers(message_queue_process, workers, '127.0.0.1', port)
+        time.sleep(1)
+
+        try:
+            received, elapsed = bench(port)
+            print('workers=%s %8d delivered %10.0f msg/s (%s cpus)' % (workers, received, received / elapsed,
+                                                                      os.cpu_count()))
+        finally:
+            for p in processes:
+                os.kill(p.pid, signal.SIGTERM)
+            for p in processes:
+                p.join()
+
+
+if __name__ == '__main__':
+    main()
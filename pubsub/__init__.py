@@ -24,3 +24,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 from .client import MessageQueue
+from .async_client import AsyncMessageQueue
+from .threaded_client import ThreadedMessageQueue
+from .publisher import PublisherPool
+from .local import LocalBroker
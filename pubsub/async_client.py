@@ -0,0 +1,432 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import asyncio
+import collections
+import socket
+import traceback
+
+from pubsub.client import BaseMessageQueue
+from pubsub.common import CHUNK_SIZE, FRAME_CONTROL, FRAME_MESSAGE, LOCAL_PREFIX, FrameReader, ProtocolError, \
+    construct_batch, construct_message, unix_path
+from pubsub.stream import AsyncMessageStream, BaseMessageStream
+
+CONNECT_TIMEOUT = 30
+RECONNECT_INTERVAL = 1  # seconds between attempts of the iterator to reconnect
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    The connection of an AsyncMessageQueue: passes the frames it receives on to the client, and makes publishers
+    wait in drain while the transport has more buffered than it wants.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.reader = FrameReader()
+        self.transport = None
+        self.paused = False
+        self.drained = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.client.connection_made(self)
+
+    def connection_lost(self, exc):
+        self.resume_writing()
+        self.client.connection_lost(self)
+
+    def data_received(self, data):
+        try:
+            frames = self.reader.feed(data)
+        except ProtocolError:
+            traceback.print_exc()
+            self.transport.close()
+            return
+
+        self.client.frames_received(self, frames)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.drained is not None and not self.drained.done():
+            self.drained.set_result(None)
+        self.drained = None
+
+    async def drain(self):
+        if self.paused:
+            if self.drained is None:
+                self.drained = asyncio.get_running_loop().create_future()
+            await self.drained
+
+
+class AsyncMessageQueue(BaseMessageQueue):
+    """
+    Client for the message broker for asyncio applications. Every connection is served by the event loop, so a
+    process can hold as many as it needs without a thread for each.
+
+    It works like MessageQueue, with coroutines: send_message (or publish) returns the sequence number of the
+    message on this client, wait_for_ack waits for the broker to accept messages, and a lost connection is made
+    again by the next call, resuming the subscriptions from the last message received on each queue.
+    Acknowledgements are recorded as they arrive rather than returned by get_message.
+
+    Iterating over the client with async for yields (queue, message) until close is called, reconnecting every
+    reconnect_interval seconds while the broker cannot be reached.
+
+    Streamed messages (see send_stream) come as a pubsub.stream.AsyncMessageStream, read with await stream.read()
+    or async for over its chunks.
+    """
+
+    def __init__(self, server='127.0.0.1', port=6747, protocol=1, codec=None, reconnect_interval=RECONNECT_INTERVAL,
+                 trace=False):
+        super(AsyncMessageQueue, self).__init__(server, port, protocol, codec, trace)
+        self.reconnect_interval = reconnect_interval
+        self.connection = None
+        # the connection while its handshake is in progress, the client only uses it as self.connection after
+        self.pending = None
+        self.handshake = None
+        self.connecting = None
+        self.waiter = None
+        self.closed = False
+
+    async def connect(self):
+        """
+        Connects to the broker unless connected. Tasks calling it together wait for a single connection.
+        """
+        if self.connecting is None:
+            self.connecting = asyncio.Lock()
+
+        async with self.connecting:
+            if self.connection is None:
+                await self.open_connection()
+
+    async def open_connection(self):
+        self.closed = False
+        loop = asyncio.get_running_loop()
+        path = unix_path(self.server)
+        if path is not None:
+            transport, connection = await loop.create_unix_connection(lambda: ClientProtocol(self), path)
+        elif self.server.startswith(LOCAL_PREFIX):
+            raise ValueError('Brokers embedded in the process are reached with MessageQueue')
+        else:
+            transport, connection = await loop.create_connection(lambda: ClientProtocol(self), self.server,
+                                                                 self.port)
+        try:
+            self.connection_id, self.welcome_message = await self.expect(lambda queue, message: True)
+
+            self.active_protocol = 1
+            if self.protocol != 1 and self.protocol in self.welcome_message.get('protocols', [1]):
+                transport.write(construct_message(self.connection_id, dict(coremq_protocol=self.protocol), 1,
+                                                  FRAME_CONTROL))
+                # the broker answers in protocol 1, then switches
+                await self.expect(lambda queue, message: queue == self.connection_id and isinstance(message, dict)
+                                  and str(message.get('response', '')).startswith('OK: Protocol'))
+                connection.reader.protocol = self.active_protocol = self.protocol
+
+            if self.pending is not connection:
+                raise ConnectionError('Lost the connection to %s:%s' % (self.server, self.port))
+
+            requests = self.connected()
+            if self.options:
+                requests.append(self.options_request(self.options))
+
+            # subscriptions are resumed before anything else is sent on the connection
+            for request in requests:
+                transport.write(construct_message(self.connection_id, request, self.active_protocol, FRAME_CONTROL))
+        except BaseException:
+            self.disconnect()
+            raise
+        finally:
+            if self.handshake is not None:
+                self.received.extend(self.handshake)
+            self.handshake = None
+
+        self.pending = None
+        self.connection = connection
+        await connection.drain()
+
+    async def expect(self, match, timeout=CONNECT_TIMEOUT):
+        """
+        Waits for a handshake message for which match(queue, message) is true, leaving the others to get_message
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            for item in self.handshake:
+                if match(*item):
+                    self.handshake.remove(item)
+                    return item
+
+            if self.pending is None:
+                raise ConnectionError('Lost the connection to %s:%s' % (self.server, self.port))
+
+            if not await self.wait(deadline - loop.time()):
+                raise socket.timeout('No response from %s:%s' % (self.server, self.port))
+
+    async def wait(self, timeout=None):
+        """
+        Waits for frames to arrive or the connection to change
+        :return: bool - False if timeout seconds passed first
+        """
+        if timeout is not None and timeout <= 0:
+            return False
+
+        if self.waiter is None:
+            self.waiter = asyncio.get_running_loop().create_future()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self.waiter), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
+
+    def notify(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+        self.waiter = None
+
+    def connection_made(self, connection):
+        self.pending = connection
+        # frames of the handshake are kept apart from messages still unread from the previous connection
+        self.handshake = collections.deque()
+
+    def frames_received(self, connection, frames):
+        if connection is not self.connection and connection is not self.pending:
+            return
+
+        received = self.received if self.handshake is None else self.handshake
+        for frame in frames:
+            try:
+                queue, message = self.decode(frame)
+            except (ProtocolError, ValueError):
+                traceback.print_exc()
+                continue
+
+            if queue is not None and not self.track(queue, message):
+                received.append((queue, message))
+
+        if self.stream_waited():
+            self.stalled()
+        self.notify()
+
+    def connection_lost(self, connection):
+        if connection is self.pending:
+            self.pending = None
+            self.notify()
+        elif connection is self.connection:
+            self.connection = None
+            self.abort_streams('Lost the connection to %s:%s' % (self.server, self.port))
+            self.notify()
+
+    def disconnect(self):
+        for connection in (self.connection, self.pending):
+            if connection is not None:
+                connection.transport.close()
+        self.connection = self.pending = None
+        self.abort_streams('Lost the connection to %s:%s' % (self.server, self.port))
+        self.notify()
+
+    async def close(self):
+        self.closed = True
+        self.disconnect()
+
+    async def transmit(self, build):
+        """
+        Sends the frame returned by build(), which is called after connecting since the connection id and protocol
+        may change
+        """
+        if self.connection is None:
+            await self.connect()
+
+        connection = self.connection
+        connection.transport.write(build())
+        await connection.drain()
+
+    async def publish(self, queue, message):
+        await self.transmit(lambda: construct_message(queue, message, self.active_protocol, FRAME_MESSAGE,
+                                                      self.codec, self.tracer is not None, self.compressor,
+                                                      self.compression_threshold))
+        self.published += 1
+        return self.published
+
+    send_message = publish
+
+    async def send_many(self, queue, messages):
+        return await self.publish_batch([(queue, m) for m in messages])
+
+    async def publish_batch(self, messages):
+        """
+        Publishes several messages in a single frame. The broker routes, stores and acknowledges them together.
+        :param messages: list of (queue, message) pairs
+        :return: int - the sequence number of the last message
+        """
+        messages = list(messages)
+        if not messages:
+            return self.published
+
+        await self.transmit(lambda: construct_batch(self.connection_id, messages, self.active_protocol, self.codec,
+                                                    self.tracer is not None, self.compressor,
+                                                    self.compression_threshold))
+        self.published += len(messages)
+        return self.published
+
+    async def send_stream(self, queue, source, chunk_size=CHUNK_SIZE, codec=None):
+        """
+        Publishes a message in chunks, see MessageQueue.send_stream. Other tasks publish between the chunks.
+        :return: int - the sequence number of the message, acknowledged with its last chunk
+        """
+        connection_id = None
+        for frame in self.stream_frames(queue, source, chunk_size, codec):
+            await self.transmit(lambda: frame)
+            if connection_id is None:
+                connection_id = self.connection_id
+            elif connection_id != self.connection_id:
+                raise ConnectionError('Lost the connection to %s:%s while streaming' % (self.server, self.port))
+
+        self.published += 1
+        return self.published
+
+    async def send_control(self, message):
+        await self.transmit(lambda: construct_message(self.connection_id, message, self.active_protocol,
+                                                      FRAME_CONTROL))
+
+    async def wait_for_ack(self, seq=None, timeout=10):
+        """
+        Waits until the broker has accepted every message up to seq
+        :param seq: A sequence number returned by send_message. Defaults to the last message sent
+        :param timeout: Seconds to wait
+        :return: bool - False if the broker did not confirm the messages in time or a reconnect may have lost them
+        """
+        if seq is None:
+            seq = self.published
+
+        acknowledged = self.acknowledged(seq)
+        if acknowledged is not None:
+            return acknowledged
+
+        await self.send_control(dict(coremq_sync=True))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.acked < seq:
+            if self.connection is None or not await self.wait(deadline - loop.time()):
+                return False
+
+        return True
+
+    async def get_message(self, timeout=None):
+        """
+        :param timeout: Seconds to wait, None to wait until a message arrives
+        :return: (str, object) - the queue and the message, or (None, None) if none arrived in time or the client
+        was closed
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not self.received:
+            if self.closed:
+                return None, None
+
+            if self.connection is None:
+                await self.connect()
+                continue
+
+            if not await self.wait(None if deadline is None else deadline - loop.time()):
+                return None, None
+
+        queue, message = self.received.popleft()
+        if isinstance(message, dict) and message.get('response') == 'BYE':
+            self.disconnect()
+
+        # the chunks of a stream are counted as they are read
+        if not isinstance(message, BaseMessageStream):
+            self.replenish(queue)
+
+        return queue, message
+
+    def replenish(self, queue):
+        self.grant(self.consume(queue))
+
+    def stalled(self):
+        self.grant(self.advance_credit())
+
+    def grant(self, credit):
+        if credit is not None and self.connection is not None:
+            # small enough to go without waiting for the transport to drain
+            self.connection.transport.write(construct_message(self.connection_id, credit, self.active_protocol,
+                                                              FRAME_CONTROL))
+
+    def open_stream(self, queue, sender, sent, codec):
+        return AsyncMessageStream(queue, sender, sent, codec, self.replenish, self.stalled)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            if self.closed:
+                raise StopAsyncIteration
+
+            try:
+                queue, message = await self.get_message()
+            except (OSError, asyncio.TimeoutError) as ex:
+                print('Reconnecting to %s:%s: %s' % (self.server, self.port, ex))
+                await asyncio.sleep(self.reconnect_interval)
+                continue
+
+            if queue is not None:
+                return queue, message
+
+    async def get_history(self, *queues):
+        await self.send_control(self.history_request(queues))
+
+    async def get_stats(self, *queues):
+        """
+        :param queues: Queue names or patterns to give the counters of, see MessageQueue.get_stats
+        """
+        await self.send_control(self.stats_request(queues))
+
+    async def subscribe(self, *queues, from_sequence=None):
+        """
+        :param queues: Queue names or patterns, see MessageQueue.subscribe
+        :param from_sequence: Optional sequence number to start each queue from
+        """
+        await self.send_control(self.subscription(queues, from_sequence))
+
+    async def unsubscribe(self, *queues):
+        await self.send_control(self.unsubscription(queues))
+
+    async def set_options(self, **options):
+        await self.send_control(self.options_request(options))
+
+    async def set_prefetch(self, messages=None, size=None):
+        """
+        Limits what the broker sends ahead of get_message, see MessageQueue.set_prefetch
+        """
+        await self.send_control(self.prefetch_request(messages, size))
@@ -0,0 +1,257 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import asyncio
+import collections
+import signal
+import socket
+import sys
+import traceback
+
+from pubsub.common import FrameReader, ProtocolError, unix_path
+from pubsub.server import ADDRESS, MAX_QUEUED, PORT, Credit, MessageQueueHandler, RoutingTable, ThreadedTCPServer, \
+    evict_oldest, frame_buffers, is_chunk, open_store, remove_socket
+
+FLUSH_FRAMES = 256  # frames per writelines call when draining the queue
+
+
+class AsyncRequestHandler(MessageQueueHandler, asyncio.Protocol):
+    """
+    Serves a single client from the event loop. Every connection shares one thread, so there is no locking around
+    connections or history.
+
+    Frames are written straight to the transport until it pauses writing, then queued up to the max_queued option.
+    The overflow option works as in server.Outbox, except that "block" pauses reading from the publishers until the
+    queue has room again, since the event loop itself cannot wait.
+
+    Queued frames are written with writelines, which sends all their buffers in one call. With the flush_delay option
+    (milliseconds) a frame that could be written straight away is held back that long so the frames following it
+    share the write.
+
+    Backlogs of resuming subscribers are sent while the transport takes writes and continued by flush.
+
+    Message frames beyond the credit granted by the client are held as in server.Outbox.
+    """
+    connections = dict()
+    routes = RoutingTable()
+
+    def __init__(self):
+        self.transport = None
+        self.conn_id = None
+        self.reader = FrameReader()
+        self.options = dict()
+        self.frames = collections.deque()
+        self.credit = Credit()
+        self.held = collections.deque()
+        self.paused = False
+        self.blocked = set()
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.conn_id = self.open_connection()
+
+    def connection_lost(self, exc):
+        self.close_connection(self.conn_id)
+        self.frames.clear()
+        self.held.clear()
+        self.backlogs = []
+        self.resume_publishers()
+
+        if self.dropped:
+            print('Dropped %s messages for %s' % (self.dropped, self.conn_id))
+
+    def schedule_ack(self, conn_id, delay):
+        asyncio.get_event_loop().call_later(delay, self.ack_due, conn_id, self.ack_deadline)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def writable(self):
+        return not self.paused and not self.held and self.queued < self.options.get('max_queued', MAX_QUEUED)
+
+    @property
+    def queued(self):
+        return len(self.frames) + len(self.held)
+
+    def grant(self, credit):
+        self.credit.grant(credit)
+        self.flush()
+
+    def flush(self):
+        if self.transport.is_closing():
+            return
+
+        while self.held and self.credit.available():
+            entry = self.held.popleft()
+            self.credit.take(entry[0])
+            self.frames.append(entry)
+
+        # a batch at a time, so whatever is left when the transport pauses again still counts against max_queued
+        while self.frames and not self.paused:
+            count = min(len(self.frames), FLUSH_FRAMES)
+            self.transport.writelines(frame_buffers([self.frames.popleft()[0] for _ in range(count)]))
+
+        if self.queued < self.options.get('max_queued', MAX_QUEUED):
+            self.resume_publishers()
+            if self.backlogs and not self.paused:
+                self.send_backlogs(self.conn_id)
+
+    def resume_publishers(self):
+        for publisher in self.blocked:
+            if not publisher.transport.is_closing():
+                publisher.transport.resume_reading()
+
+        self.blocked.clear()
+
+    def data_received(self, data):
+        try:
+            frames = self.reader.feed(data)
+        except ProtocolError as ex:
+            # the stream cannot be resynchronised once a header is broken
+            self.respond(self.conn_id, str(ex))
+            self.transport.close()
+            return
+
+        for frame in frames:
+            try:
+                self.handle_frame(self.conn_id, *frame)
+            except Exception as ex:
+                self.respond(self.conn_id, str(ex))
+                print(self.conn_id, ex)
+                traceback.print_exc()
+
+    def send_frame(self, frame, publisher=None, message=False):
+        if self.transport.is_closing():
+            return
+
+        entry = (frame, publisher is not None and not is_chunk(frame), message)
+        if message and (self.held or not self.credit.available()):
+            if not self.overflow(publisher):
+                self.held.append(entry)
+            return
+
+        if message:
+            self.credit.take(frame)
+
+        if not self.paused and not self.frames:
+            delay = self.options.get('flush_delay', 0)
+            if not delay:
+                if isinstance(frame, tuple):
+                    self.transport.writelines(frame)
+                else:
+                    self.transport.write(frame)
+                return
+
+            asyncio.get_event_loop().call_later(delay / 1000.0, self.flush)
+        elif self.overflow(publisher):
+            return
+
+        self.frames.append(entry)
+
+    def overflow(self, publisher):
+        """
+        Applies the overflow option to a frame of the publisher once max_queued frames are waiting
+        :return: bool - True if the frame is to be discarded
+        """
+        if publisher is None or self.queued < self.options.get('max_queued', MAX_QUEUED):
+            return False
+
+        overflow = self.options.get('overflow', 'block')
+        if overflow == 'block':
+            if publisher is not self and publisher not in self.blocked:
+                publisher.transport.pause_reading()
+                self.blocked.add(publisher)
+            return False
+
+        self.dropped += 1
+        if overflow == 'drop-oldest':
+            # the new frame goes instead when only control frames and chunks of streams are queued
+            return not evict_oldest(self.frames, self.held, self.credit)
+
+        if overflow == 'disconnect':
+            self.transport.abort()
+        return True
+
+
+def message_queue_process(address=ADDRESS, port=PORT, store=None, bus=None, federation=None, metrics=None):
+    """
+    :param bus: pubsub.workers.WorkerBus when running as one of several worker processes
+    :param federation: pubsub.federation.Federation to bridge this broker to others
+    :param metrics: pubsub.metrics.Metrics to count what the broker does, None to count nothing
+    """
+    print('Starting message queue (asyncio)')
+    open_store(store)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if bus is not None:
+        ThreadedTCPServer.BUS = bus
+        # frames from the other workers are handled on the event loop like those of clients
+        bus.start(AsyncRequestHandler, loop.call_soon_threadsafe)
+    if federation is not None:
+        ThreadedTCPServer.FEDERATION = federation
+        federation.start(AsyncRequestHandler, loop.call_soon_threadsafe)
+    if metrics is not None:
+        ThreadedTCPServer.METRICS = metrics
+        metrics.start(AsyncRequestHandler, loop.call_soon_threadsafe)
+
+    path = unix_path(address)
+    if path is not None:
+        remove_socket(path)
+        server = loop.run_until_complete(loop.create_unix_server(AsyncRequestHandler, path, backlog=1024))
+    else:
+        server = loop.run_until_complete(loop.create_server(AsyncRequestHandler, address, port, reuse_address=True,
+                                                           reuse_port=bus is not None, backlog=1024))
+
+    def shutdown():
+        print('Shutting down message queue')
+        loop.stop()
+
+    loop.add_signal_handler(signal.SIGINT, shutdown)
+    loop.add_signal_handler(signal.SIGTERM, shutdown)
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        if path is not None:
+            remove_socket(path)
+        if bus is not None:
+            bus.close()
+        if store is not None:
+            store.close()
+
+    print('Message queue stopped')
+    sys.exit(0)
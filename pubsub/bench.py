@@ -0,0 +1,360 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import argparse
+import array
+import itertools
+import json
+import os
+import platform
+import queue as queues
+import socket
+import struct
+import sys
+import time
+from multiprocessing import Barrier, Process, Queue
+
+from pubsub.client import MessageQueue
+from pubsub.server import ADDRESS, ENGINES
+
+PORT = 6748
+SIZES = (64, 1024, 16384)
+PUBLISHERS = (1, 4)
+SUBSCRIBERS = (1, 8)
+CHANNELS = (1, 16)
+COUNT = 20000  # messages per publisher
+IDLE_TIMEOUT = 10  # seconds a subscriber waits for the next message before giving up on the rest
+THRESHOLD = 10  # percent a result may be worse than before without being a regression
+DIMENSIONS = ('size', 'publishers', 'subscribers', 'channels')
+
+TIMESTAMP = struct.Struct('!d')
+
+
+def sweep(engines, sizes, publishers, subscribers, channels, count, rate=None, grid=False):
+    """
+    :param rate: Optional messages per second sent by each publisher, to measure latency below saturation rather than
+    as fast as the publishers can
+    :param grid: True to run every combination of the values, rather than varying one dimension at a time from the
+    first value of each
+    :return: list of dict - the cases to run
+    """
+    values = (sizes, publishers, subscribers, channels)
+    if grid:
+        combinations = list(itertools.product(*values))
+    else:
+        baseline = tuple(v[0] for v in values)
+        combinations = [baseline]
+        for i, dimension in enumerate(values):
+            for value in dimension[1:]:
+                combination = baseline[:i] + (value,) + baseline[i + 1:]
+                if combination not in combinations:
+                    combinations.append(combination)
+
+    return [dict(zip(('engine',) + DIMENSIONS + ('count', 'rate'), (engine,) + combination + (count, rate)))
+            for engine in engines for combination in combinations]
+
+
+def case_key(case):
+    return tuple(case.get(k) for k in ('engine',) + DIMENSIONS + ('rate',))
+
+
+def broker_process(engine, port):
+    # the broker reports every connection, which would bury the results
+    sys.stdout = open(os.devnull, 'w')
+    if engine == 'asyncio':
+        from pubsub.async_server import message_queue_process
+    else:
+        from pubsub.server import message_queue_process
+
+    message_queue_process(ADDRESS, port)
+
+
+def wait_for_broker(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((ADDRESS, port), 1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def channel_names(case):
+    return ['bench.%s' % i for i in range(case['channels'])]
+
+
+def publisher_process(port, case, index, barrier, results):
+    client = MessageQueue(ADDRESS, port, protocol=2)
+    client.connect()
+    client.set_options(ack='none')
+    channels = channel_names(case)
+    padding = b'\0' * max(0, case['size'] - TIMESTAMP.size)
+    barrier.wait()
+
+    start_time = time.time()
+    interval = 1.0 / case['rate'] if case.get('rate') else 0
+    for i in range(case['count']):
+        if interval:
+            delay = start_time + i * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        client.send_message(channels[(index + i) % len(channels)], TIMESTAMP.pack(time.time()) + padding)
+
+    acknowledged = client.wait_for_ack(timeout=60)
+    results.put(('publisher', start_time, time.time(), acknowledged))
+    client.close()
+
+
+def subscriber_process(port, case, barrier, results):
+    client = MessageQueue(ADDRESS, port, protocol=2)
+    client.connect()
+    client.subscribe(*channel_names(case))
+    client.wait_for_ack()
+    expected = case['publishers'] * case['count']
+    latencies = array.array('d')
+    barrier.wait()
+
+    last = None
+    while len(latencies) < expected:
+        queue, message = client.get_message(timeout=IDLE_TIMEOUT)
+        if queue is None:
+            break
+
+        now = time.time()
+        if queue.startswith('bench.'):
+            latencies.append(now - TIMESTAMP.unpack_from(message)[0])
+            last = now
+
+    results.put(('subscriber', last, latencies.tobytes()))
+    client.close()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_case(case, port=PORT):
+    """
+    Starts a broker for the case, runs its publishers and subscribers, each in a process of its own, and stops it
+    :return: dict - the case with its results: publish_rate, the rate at which the broker accepted messages,
+    delivery_rate, the rate at which subscribers received them, end-to-end latencies in microseconds, and the
+    messages that did not arrive
+    """
+    broker = Process(target=broker_process, args=(case['engine'], port))
+    broker.start()
+    try:
+        wait_for_broker(port)
+        results = Queue()
+        barrier = Barrier(case['publishers'] + case['subscribers'])
+        processes = [Process(target=subscriber_process, args=(port, case, barrier, results))
+                     for i in range(case['subscribers'])]
+        processes += [Process(target=publisher_process, args=(port, case, i, barrier, results))
+                      for i in range(case['publishers'])]
+        for process in processes:
+            process.start()
+
+        # results are taken before joining, as a process cannot exit while its large result is still queued
+        outcomes = []
+        for process in processes:
+            try:
+                outcomes.append(results.get(timeout=IDLE_TIMEOUT + 60 + case['count'] / 1000.0))
+            except queues.Empty:
+                break
+        for process in processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+    finally:
+        broker.terminate()
+        broker.join()
+
+    published = [o for o in outcomes if o[0] == 'publisher']
+    received = [o for o in outcomes if o[0] == 'subscriber']
+    latencies = array.array('d')
+    for o in received:
+        latencies.frombytes(o[2])
+    latencies = sorted(latencies)
+
+    result = dict(case)
+    expected = case['publishers'] * case['count'] * case['subscribers']
+    if published:
+        start_time = min(o[1] for o in published)
+        result['publish_rate'] = case['publishers'] * case['count'] / (max(o[2] for o in published) - start_time)
+        ends = [o[1] for o in received if o[1] is not None]
+        result['delivery_rate'] = len(latencies) / (max(ends) - start_time) if ends else 0
+
+    for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+        value = percentile(latencies, fraction)
+        result[name + '_us'] = value * 1e6 if value is not None else None
+    result['max_us'] = latencies[-1] * 1e6 if latencies else None
+    result['missing'] = expected - len(latencies)
+    if len(published) < case['publishers'] or not all(o[3] for o in published):
+        result['error'] = 'publishers did not finish or were not acknowledged'
+
+    return result
+
+
+def format_value(value, scale=1):
+    return '-' if value is None else '%.0f' % (value * scale)
+
+
+def print_header():
+    print('%-8s %6s %4s %4s %5s %12s %12s %9s %9s %9s %8s' % ('engine', 'size', 'pubs', 'subs', 'chans', 'publish/s',
+                                                              'deliver/s', 'p50 us', 'p99 us', 'p99.9 us', 'missing'))
+
+
+def print_result(result):
+    print('%-8s %6s %4s %4s %5s %12s %12s %9s %9s %9s %8s' % (
+        result['engine'], result['size'], result['publishers'], result['subscribers'], result['channels'],
+        format_value(result.get('publish_rate')), format_value(result.get('delivery_rate')),
+        format_value(result['p50_us']), format_value(result['p99_us']), format_value(result['p999_us']),
+        result['missing']))
+
+
+def run(cases, output=None, port=PORT):
+    """
+    Runs the cases one after the other, printing each result as it comes
+    :param output: Optional path of a JSON file to write the results to
+    :return: dict - the results and a description of the machine they were measured on
+    """
+    report = dict(started=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                  platform=platform.platform(), cpus=os.cpu_count(), results=[])
+    print_header()
+    for case in cases:
+        result = run_case(case, port)
+        report['results'].append(result)
+        print_result(result)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+
+def compare(before, after, threshold=THRESHOLD):
+    """
+    Compares the results of two runs, case by case
+    :param before: dict - a report of run, the reference
+    :param after: dict - the report to check against it
+    :param threshold: Percent by which the delivery rate may fall, or the p99 latency rise, before it is a regression
+    :return: list of str - the regressions found
+    """
+    reference = dict((case_key(r), r) for r in before['results'])
+    regressions = []
+    print('%-8s %6s %4s %4s %5s %12s %12s %8s %9s %9s %8s' % ('engine', 'size', 'pubs', 'subs', 'chans', 'deliver/s',
+                                                              'was', 'change', 'p99 us', 'was', 'change'))
+    for result in after['results']:
+        old = reference.get(case_key(result))
+        if old is None:
+            continue
+
+        rate = change(old.get('delivery_rate'), result.get('delivery_rate'))
+        latency = change(old.get('p99_us'), result.get('p99_us'))
+        problems = []
+        if rate is not None and rate < -threshold:
+            problems.append('delivery rate %.1f%%' % rate)
+        if latency is not None and latency > threshold:
+            problems.append('p99 latency +%.1f%%' % latency)
+        if result['missing'] > old['missing']:
+            problems.append('%s messages missing' % result['missing'])
+
+        print('%-8s %6s %4s %4s %5s %12s %12s %8s %9s %9s %8s %s' % (
+            result['engine'], result['size'], result['publishers'], result['subscribers'], result['channels'],
+            format_value(result.get('delivery_rate')), format_value(old.get('delivery_rate')), format_change(rate),
+            format_value(result['p99_us']), format_value(old['p99_us']), format_change(latency),
+            'REGRESSION' if problems else ''))
+
+        if problems:
+            regressions.append('%s: %s' % (' '.join(str(k) for k in case_key(result)), ', '.join(problems)))
+
+    return regressions
+
+
+def change(before, after):
+    """
+    :return: float - the change from before to after in percent, None if either is missing
+    """
+    if not before or after is None:
+        return None
+
+    return (after - before) / before * 100
+
+
+def format_change(value):
+    return '-' if value is None else '%+.1f%%' % value
+
+
+def parse_list(text):
+    return tuple(int(v) for v in text.split(','))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the pubsub broker, or compares two benchmark runs')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='start brokers and measure them')
+    run_parser.add_argument('--engine', action='append', choices=ENGINES,
+                            help='engine to measure, may be repeated (default: both)')
+    run_parser.add_argument('--sizes', type=parse_list, default=SIZES, help='message sizes in bytes, e.g. 64,1024')
+    run_parser.add_argument('--publishers', type=parse_list, default=PUBLISHERS, help='publisher counts')
+    run_parser.add_argument('--subscribers', type=parse_list, default=SUBSCRIBERS, help='subscribers of every channel')
+    run_parser.add_argument('--channels', type=parse_list, default=CHANNELS, help='queues the messages are spread over')
+    run_parser.add_argument('--count', type=int, default=COUNT, help='messages sent by each publisher')
+    run_parser.add_argument('--rate', type=int, help='messages per second sent by each publisher (default: no limit)')
+    run_parser.add_argument('--grid', action='store_true', help='run every combination instead of one dimension at a time')
+    run_parser.add_argument('--port', type=int, default=PORT)
+    run_parser.add_argument('--output', help='JSON file to write the results to')
+    compare_parser = commands.add_parser('compare', help='flag regressions between two runs')
+    compare_parser.add_argument('before', help='JSON results of the reference run')
+    compare_parser.add_argument('after', help='JSON results of the run to check')
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD, help='percent, default %s' % THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        cases = sweep(args.engine or ENGINES, args.sizes, args.publishers, args.subscribers, args.channels, args.count,
+                      args.rate, args.grid)
+        run(cases, args.output, args.port)
+    elif args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+
+        regressions = compare(before, after, args.threshold)
+        for regression in regressions:
+            print('Regression: %s' % regression)
+        sys.exit(1 if regressions else 0)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -24,68 +24,614 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import collections
+import itertools
 import socket
+import time
 from json import JSONDecodeError
 
-from pubsub.common import get_message, send_message, ProtocolError
+from pubsub.common import CHUNK_ABORT, CHUNK_LAST, CHUNK_SIZE, CHUNK_V2, CODEC_MASK, COMPRESSION_THRESHOLD, FLAG_RAW, \
+    FLAG_TRACE, FRAME_CHUNK, FRAME_CONTROL, FRAME_MESSAGE, HEADER_V2, METADATA_V2, TRACE_V2, ConnectionClosed, \
+    FrameReader, construct_batch, construct_chunk, construct_message, create_connection, decode_frame, get_codec, \
+    get_compressor, is_pattern, iter_chunks, send_message, validate_queue, ProtocolError
+from pubsub.stream import BaseMessageStream, MessageStream
+from pubsub.tracing import Tracer
 
 
-class MessageQueue(object):
-    def __init__(self, server='127.0.0.1', port=6747):
+class BaseMessageQueue(object):
+    """
+    State shared by the blocking and the asyncio clients, everything but the I/O: subscriptions, options, sequence
+    numbers and acknowledgements, and the control messages that go with them.
+    """
+
+    def __init__(self, server='127.0.0.1', port=6747, protocol=1, codec=None, trace=False):
+        if codec is not None:
+            codec = get_codec(codec)
+            if protocol == 1 and codec.name != 'json':
+                raise ValueError('Codecs other than json need protocol=2')
+
+        if trace and protocol == 1:
+            raise ValueError('Tracing needs protocol=2')
+
         self.server = server
         self.port = port
-        self.socket = None
+        self.protocol = protocol
+        self.codec = codec
+        self.active_protocol = 1
         self.connection_id = None
         self.welcome_message = None
         self.subscriptions = []
         self.options = dict()
         self.last_message_time = 0
+        self.last_sender = None
+        self.published = 0
+        self.acked = 0
+        self.seq_base = 0
+        self.unconfirmed = []
+        self.received = collections.deque()
+        self.sequences = dict()
+        self.tracer = Tracer() if trace else None
+        # the window of messages and bytes the broker may send ahead, and the sizes of the messages received within it
+        self.prefetch = None
+        self.prefetch_bytes = None
+        self.credited = collections.deque()
+        self.consumed = 0
+        self.consumed_bytes = 0
+        # messages and chunks whose credit was granted back before they were read, see advance_credit
+        self.released = 0
+        # the compression of published messages, set with the options that have the broker compress for this client
+        self.compressor = None
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        # (sender, stream number) -> stream of the message being received in chunks
+        self.streams = dict()
+        self.stream_numbers = itertools.count(1)
+
+    def connected(self):
+        """
+        Resets the publish count after a (re)connect
+        :return: list of dict - the control messages granting the prefetch window again and resuming the
+        subscriptions
+        """
+        # the broker counts publishes per connection, anything not acknowledged before a reconnect may be lost
+        if self.acked < self.published:
+            self.unconfirmed.append((self.acked, self.published))
+        self.seq_base = self.acked = self.published
+
+        requests = []
+        if self.prefetch is not None or self.prefetch_bytes is not None:
+            requests.append(self.prefetch_request(self.prefetch, self.prefetch_bytes))
+
+        if self.subscriptions:
+            cursors = dict((q, self.sequences[q] + 1) for q in self.subscriptions if q in self.sequences)
+            requests.append(dict(coremq_subscribe=self.subscriptions, coremq_from=cursors))
+
+        return requests
+
+    def acknowledged(self, seq):
+        """
+        :return: bool - True if the broker accepted every message up to seq, False if a reconnect may have lost some
+        of them, None while waiting
+        """
+        for start, end in self.unconfirmed:
+            if start < seq <= end:
+                return False
+
+        if self.acked >= seq:
+            return True
+
+        return None
+
+    def track(self, queue, message):
+        """
+        Records acknowledgements coming from the broker
+        :return: bool - True if the message was an acknowledgement
+        """
+        if queue == self.connection_id and isinstance(message, dict) and 'coremq_ack' in message:
+            self.acked = max(self.acked, self.seq_base + message['coremq_ack'])
+            return True
+
+        return False
+
+    def decode(self, frame):
+        """
+        Decodes a frame from the FrameReader, recording its sender, time and sequence number
+        :return: (str, object) - the queue and the message, which is a stream for the first chunk of a streamed
+        message, or (None, None) for its other chunks
+        """
+        if frame[2] == FRAME_CHUNK:
+            return self.receive_chunk(*frame)
+
+        queue, message = decode_frame(*frame)
+
+        seq = None
+        if frame[4] is not None:
+            self.last_sender, self.last_message_time, seq = frame[4]
+            if self.tracer is not None and frame[3] & FLAG_TRACE:
+                published, dispatched = TRACE_V2.unpack_from(frame[1], len(frame[1]) - TRACE_V2.size)
+                self.tracer.record(queue, published, self.last_message_time, dispatched, time.time())
+
+            if (self.prefetch is not None or self.prefetch_bytes is not None) and frame[2] == FRAME_MESSAGE \
+                    and queue != self.connection_id:
+                # the broker counts the whole frame against the credit
+                self.credited.append(HEADER_V2.size + METADATA_V2.size + len(queue.encode('utf-8')) + len(frame[1]))
+        elif isinstance(message, dict):
+            seq = message.get('coremq_seq')
+
+        if seq is not None and queue != self.connection_id:
+            self.sequences[queue] = seq
+        elif queue == self.connection_id and isinstance(message, dict):
+            self.track_sequences(message)
+
+        return queue, message
+
+    def receive_chunk(self, queue, payload, kind, flags, metadata):
+        """
+        Passes a chunk to the stream of its message, opening the stream with the first chunk
+        :return: (str, BaseMessageStream) for the first chunk, (None, None) for the others
+        """
+        number, index, marks = CHUNK_V2.unpack_from(payload)
+        credited = not marks & CHUNK_ABORT and (self.prefetch is not None or self.prefetch_bytes is not None)
+        if credited:
+            self.credited.append(HEADER_V2.size + METADATA_V2.size + len(queue.encode('utf-8')) + len(payload))
+
+        key = (metadata[0], number)
+        stream = self.streams.get(key)
+        first = stream is None and index == 0 and not marks & CHUNK_ABORT
+        if first:
+            stream = self.streams[key] = self.open_stream(queue, metadata[0], metadata[1], flags & CODEC_MASK)
+            self.last_sender, self.last_message_time = metadata[:2]
+
+        if marks & (CHUNK_LAST | CHUNK_ABORT):
+            self.streams.pop(key, None)
+
+        if stream is not None:
+            stream.feed(index, payload[CHUNK_V2.size:], marks)
+        elif credited:
+            # the rest of a stream given up already, e.g. when the broker's abort overtook chunks held for credit
+            self.replenish(queue)
+
+        return (queue, stream) if first else (None, None)
+
+    def open_stream(self, queue, sender, sent, codec):
+        """
+        :return: BaseMessageStream - the stream a message received in chunks is read from
+        """
+        raise NotImplementedError()
+
+    def abort_streams(self, reason):
+        streams, self.streams = self.streams, dict()
+        for stream in streams.values():
+            stream.abort(reason)
+
+    def replenish(self, queue):
+        """
+        Grants the broker credit again for a message or chunk taken by the application
+        """
+        raise NotImplementedError()
+
+    def stalled(self):
+        """
+        Sends advance_credit while a stream is waited for
+        """
+        raise NotImplementedError()
+
+    def stream_waited(self):
+        """
+        :return: bool - True while the application waits for a chunk received by another thread or task
+        """
+        return any(stream.reading for stream in list(self.streams.values()))
+
+    def stream_frames(self, queue, source, chunk_size=CHUNK_SIZE, codec=None):
+        """
+        :return: generator of the frames publishing source in chunks. If reading source fails, the frame giving the
+        message up comes before the exception.
+        """
+        if self.protocol == 1:
+            raise ValueError('Streaming needs protocol=2')
+
+        validate_queue(queue)
+        codec = FLAG_RAW if codec is None else get_codec(codec).id
+        number = next(self.stream_numbers) & 0xFFFFFFFF
+        index = 0
+        previous = None
+        try:
+            # the chunk after the next tells whether the next is the last
+            for data in iter_chunks(source, chunk_size):
+                if previous is not None:
+                    yield construct_chunk(queue, number, index, previous, 0, codec)
+                    index += 1
+                previous = data
+        except Exception:
+            yield construct_chunk(queue, number, index, b'', CHUNK_ABORT, codec)
+            raise
+
+        yield construct_chunk(queue, number, index, previous or b'', CHUNK_LAST, codec)
+
+    def track_sequences(self, response):
+        if 'coremq_queue' in response and 'coremq_next' in response:
+            # after "OK: Resumed", which also tells when the broker has lost count, e.g. after a restart
+            self.sequences[response['coremq_queue']] = response['coremq_next'] - 1
+        elif isinstance(response.get('coremq_next'), dict):
+            # a new subscription starts with the next message
+            for queue, seq in response['coremq_next'].items():
+                self.sequences[queue] = max(self.sequences.get(queue, 0), seq - 1)
+
+    def history_request(self, queues):
+        if not queues:
+            queues = self.subscriptions
+
+        if not queues:
+            raise ValueError('Must pass at least one queue name')
+
+        if not isinstance(queues, (list, tuple)):
+            queues = [queues]
+
+        return dict(coremq_gethistory=queues)
+
+    def stats_request(self, queues):
+        """
+        :return: dict - the control message asking for the broker's statistics, with the counters of queues or of
+        every queue
+        """
+        return dict(coremq_stats=list(queues) if queues else True)
+
+    def subscription(self, queues, from_sequence=None):
+        """
+        :return: dict - the control message subscribing to queues, see MessageQueue.subscribe
+        """
+        if not queues:
+            raise ValueError('Must pass at least one queue name')
+
+        if not isinstance(queues, (list, tuple)):
+            queues = [queues]
+
+        if from_sequence is not None and any(is_pattern(q) for q in queues):
+            raise ValueError('Patterns cannot be subscribed from a sequence number')
+
+        for q in queues:
+            if q not in self.subscriptions:
+                self.subscriptions.append(q)
+
+        message = dict(coremq_subscribe=queues)
+        if from_sequence is not None:
+            message['coremq_from'] = dict((q, from_sequence) for q in queues)
+
+        return message
+
+    def unsubscription(self, queues):
+        if not queues:
+            raise ValueError('Must pass at least one queue name')
+
+        if not isinstance(queues, (list, tuple)):
+            queues = [queues]
+
+        for q in queues:
+            if q in self.subscriptions:
+                self.subscriptions.remove(q)
+
+        return dict(coremq_unsubscribe=queues)
+
+    def prefetch_request(self, messages=None, size=None):
+        """
+        :return: dict - the control message setting the credit of the connection to the prefetch window, see
+        MessageQueue.set_prefetch
+        """
+        if self.protocol == 1:
+            raise ValueError('Flow control needs protocol=2')
+
+        self.prefetch = messages
+        self.prefetch_bytes = size
+        self.credited.clear()
+        self.consumed = self.consumed_bytes = self.released = 0
+        if messages is None and size is None:
+            return dict(coremq_credit=None)
+
+        return dict(coremq_credit=dict(messages=messages, bytes=size, reset=True))
+
+    def consume(self, queue):
+        """
+        Counts a message taken by the application against the prefetch window
+        :return: dict - the control message granting the credit back once half the window has been consumed, or None
+        """
+        if queue is None or queue == self.connection_id or not (self.credited or self.released):
+            return None
+
+        if self.released:
+            self.released -= 1
+            return None
+
+        self.consumed += 1
+        self.consumed_bytes += self.credited.popleft()
+        if (self.prefetch is None or self.consumed * 2 < self.prefetch) and \
+                (self.prefetch_bytes is None or self.consumed_bytes * 2 < self.prefetch_bytes):
+            return None
+
+        return self.consumed_credit()
+
+    def advance_credit(self):
+        """
+        Called while the application waits for a chunk of a stream. Once the messages and chunks received but not
+        read yet fill the prefetch window, the broker holds the chunk back for lack of credit, so their credit is
+        granted back before they are read.
+        :return: dict - the control message granting the credit, or None
+        """
+        if not self.credited:
+            return None
+
+        if (self.prefetch is None or len(self.credited) + self.consumed < self.prefetch) and \
+                (self.prefetch_bytes is None or sum(self.credited) + self.consumed_bytes < self.prefetch_bytes):
+            return None
+
+        self.released += len(self.credited)
+        self.consumed += len(self.credited)
+        self.consumed_bytes += sum(self.credited)
+        self.credited.clear()
+        return self.consumed_credit()
+
+    def consumed_credit(self):
+        credit = dict(messages=self.consumed if self.prefetch is not None else None,
+                      bytes=self.consumed_bytes if self.prefetch_bytes is not None else None)
+        self.consumed = self.consumed_bytes = 0
+        return dict(coremq_credit=credit)
+
+    def options_request(self, options):
+        if 'compression' in options:
+            if options['compression'] is not None and self.protocol == 1:
+                raise ValueError('Compression needs protocol=2')
+
+            self.compressor = get_compressor(options['compression']) if options['compression'] is not None else None
+        if 'compression_threshold' in options:
+            threshold = options['compression_threshold']
+            self.compression_threshold = COMPRESSION_THRESHOLD if threshold is None else threshold
+
+        self.options.update(options)
+
+        for key, val in options.items():
+            if val is None and key in self.options:
+                del self.options[key]
+
+        return dict(coremq_options=options)
+
+
+class MessageQueue(BaseMessageQueue):
+    """
+    Client for the message broker.
+
+    send_message returns the sequence number of the published message on this client. The broker acknowledges
+    publishes according to the ack option (see set_options): "all" acknowledges each message, "cumulative" one
+    acknowledgement every ack_every messages or ack_interval milliseconds, "none" only on request. wait_for_ack
+    blocks until everything up to a sequence number has been accepted, at the cost of one round trip.
+
+    protocol=2 asks the broker for the binary protocol, which also carries raw bytes messages. Brokers that do not
+    offer it in their welcome message keep the connection on protocol 1.
+
+    With protocol 2, codec picks how published messages are serialized ("json", "raw", "marshal" or a registered
+    Codec). The default sends dicts and strings as JSON and bytes as raw. Received messages are decoded with the codec
+    named in their frame, and the sender and time of the last message are kept in last_sender and last_message_time.
+
+    trace=True, with protocol 2, stamps every published message with the time it was published, and the broker adds
+    the time it dispatched it. Traced messages received by a tracing client are timed from publisher to broker,
+    within the broker and from broker to subscriber, in the pubsub.tracing.Tracer kept as tracer: tracer.summary()
+    gives percentiles by queue and tracer.export() the full histograms.
+
+    The broker numbers the messages of each queue. sequences holds the number of the last message received on each
+    queue, and after a reconnect the subscriptions resume from there: the broker first sends what was published in
+    between, as far as it still keeps it. subscribe(..., from_sequence=n) starts from message n instead of the live
+    ones.
+
+    set_prefetch bounds the messages the broker sends ahead of the application with credit: it sends a window of
+    messages or bytes, then waits for more credit, which the client grants back once get_message has taken half
+    of the window.
+
+    set_options(compression='zlib'), with protocol 2, compresses published messages of compression_threshold bytes
+    or more (1024 by default) and has the broker send this client messages of that size compressed, compressing
+    each message once for all such subscribers. Messages published compressed reach subscribers that did not ask
+    for compression decompressed. 'lzma' compresses more, slower, where Python has the lzma module.
+
+    send_stream, with protocol 2, publishes a message in chunks of chunk_size bytes read from bytes, a file or an
+    iterable, which the broker passes on as they arrive: neither end holds the whole message, and other messages
+    are received in between. Subscribers get a pubsub.stream.MessageStream in place of the message, as soon as the
+    first chunk is in, and read it like a file while the rest arrives. Each chunk counts as a message against the
+    prefetch window. Streamed messages are neither numbered nor kept for history and resuming subscribers.
+    """
+
+    def __init__(self, server='127.0.0.1', port=6747, protocol=1, codec=None, trace=False):
+        super(MessageQueue, self).__init__(server, port, protocol, codec, trace)
+        self.socket = None
+        self.reader = None
 
     def connect(self):
         if self.socket:
             return
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(30)
-        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket = create_connection(self.server, self.port, 30)
+        self.reader = FrameReader(self.socket)
+        self.connection_id, self.welcome_message = self.reader.get_message()
 
-        self.socket.connect((self.server, self.port))
-        self.connection_id, self.welcome_message = get_message(self.socket)
+        self.active_protocol = 1
+        if self.protocol != 1 and self.protocol in self.welcome_message.get('protocols', [1]):
+            self.negotiate_protocol()
 
-        if self.subscriptions:
-            self.subscribe(*self.subscriptions)
+        for request in self.connected():
+            self.send_control(request)
 
         if self.options:
             self.set_options(**self.options)
 
+    def negotiate_protocol(self):
+        send_message(self.socket, self.connection_id, dict(coremq_protocol=self.protocol))
+
+        # the broker answers in protocol 1, then switches
+        while True:
+            queue, message = self.reader.get_message(timeout=30)
+            if queue == self.connection_id and str(message.get('response', '')).startswith('OK: Protocol'):
+                break
+            self.received.append((queue, message))
+
+        self.reader.protocol = self.active_protocol = self.protocol
+
     def close(self):
         if self.socket:
             self.socket.close()
             self.socket = None
-
-    def send_message(self, queue, message):
+            self.reader = None
+        self.abort_streams('Lost the connection to %s:%s' % (self.server, self.port))
+
+    def transmit(self, build):
+        """
+        Sends the frame returned by build(), which is called again after a reconnect since the connection id and
+        protocol may have changed
+        """
         if not self.socket:
             self.connect()
 
         try:
-            send_message(self.socket, queue, message)
+            self.socket.sendall(build())
         except socket.error:
             # attempt to reconnect if there was a connection error
             self.close()
             self.connect()
-            send_message(self.socket, queue, message)
+            self.socket.sendall(build())
 
-        # try:
-        #     return self.get_message()
-        # except socket.error:
-        #     return None, None
+    def send_message(self, queue, message):
+        self.transmit(lambda: construct_message(queue, message, self.active_protocol, FRAME_MESSAGE, self.codec,
+                                                self.tracer is not None, self.compressor, self.compression_threshold))
+        self.published += 1
+        return self.published
+
+    def send_many(self, queue, messages):
+        return self.publish_batch([(queue, m) for m in messages])
+
+    def publish_batch(self, messages):
+        """
+        Publishes several messages in a single frame. The broker routes, stores and acknowledges them together.
+        :param messages: list of (queue, message) pairs
+        :return: int - the sequence number of the last message
+        """
+        messages = list(messages)
+        if not messages:
+            return self.published
+
+        self.transmit(lambda: construct_batch(self.connection_id, messages, self.active_protocol, self.codec,
+                                              self.tracer is not None, self.compressor, self.compression_threshold))
+        self.published += len(messages)
+        return self.published
+
+    def send_stream(self, queue, source, chunk_size=CHUNK_SIZE, codec=None):
+        """
+        Publishes a message in chunks, each sent as soon as it is read from source
+        :param source: bytes, a binary file or anything with read(size), or an iterable of bytes
+        :param codec: The Codec subscribers decode the whole message with, raw by default
+        :return: int - the sequence number of the message, acknowledged with its last chunk
+        """
+        connection_id = None
+        for frame in self.stream_frames(queue, source, chunk_size, codec):
+            self.transmit(lambda: frame)
+            if connection_id is None:
+                connection_id = self.connection_id
+            elif connection_id != self.connection_id:
+                # the broker gave up the start of the message with the old connection
+                raise ConnectionError('Lost the connection to %s:%s while streaming' % (self.server, self.port))
+
+        self.published += 1
+        return self.published
+
+    def send_control(self, message):
+        self.transmit(lambda: construct_message(self.connection_id, message, self.active_protocol, FRAME_CONTROL))
+
+    def wait_for_ack(self, seq=None, timeout=10):
+        """
+        Waits until the broker has accepted every message up to seq
+        :param seq: A sequence number returned by send_message. Defaults to the last message sent
+        :param timeout: Seconds to wait
+        :return: bool - False if the broker did not confirm the messages in time or a reconnect may have lost them
+        """
+        if seq is None:
+            seq = self.published
+
+        acknowledged = self.acknowledged(seq)
+        if acknowledged is not None:
+            return acknowledged
+
+        self.send_control(dict(coremq_sync=True))
+        deadline = time.time() + timeout
+        while self.acked < seq:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            try:
+                queue, message = self.read_message(timeout=remaining)
+            except socket.timeout:
+                return False
+
+            if not self.track(queue, message):
+                self.received.append((queue, message))
+
+        return True
+
+    def read_message(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            queue, message = self.decode(self.reader.read_frame(timeout=timeout))
+            if queue is not None:
+                return queue, message
+
+            # a chunk of a stream already handed out
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise socket.timeout('timed out')
 
     def get_message(self, timeout=1):
+        queue, message = self.next_message(timeout)
+        # the chunks of a stream are counted as they are read
+        if not isinstance(message, BaseMessageStream):
+            self.replenish(queue)
+
+        return queue, message
+
+    def replenish(self, queue):
+        credit = self.consume(queue)
+        if credit is not None:
+            self.send_control(credit)
+
+    def stalled(self):
+        credit = self.advance_credit()
+        if credit is not None:
+            self.send_control(credit)
+
+    def open_stream(self, queue, sender, sent, codec):
+        return MessageStream(queue, sender, sent, codec, self.replenish, self.stalled, self.pump)
+
+    def pump(self, timeout):
+        """
+        Receives frames for up to timeout seconds while a stream is read, keeping the messages for get_message
+        """
+        if not self.socket:
+            return
+
+        try:
+            queue, message = self.decode(self.reader.read_frame(timeout=timeout))
+        except socket.timeout:
+            return
+        except (socket.error, ConnectionClosed):
+            # aborts the streams being read
+            self.close()
+            return
+
+        if queue is not None and not self.track(queue, message):
+            self.received.append((queue, message))
+
+    def next_message(self, timeout=1):
+        if self.received:
+            return self.received.popleft()
+
         if not self.socket:
             self.connect()
 
         try:
-            queue, message = get_message(self.socket, timeout=timeout)
+            queue, message = self.read_message(timeout=timeout)
         except socket.timeout:
             return None, None
         except socket.error:
@@ -93,11 +639,12 @@ class MessageQueue(object):
             self.close()
             self.connect()
             try:
-                queue, message = get_message(self.socket, timeout=timeout)
+                queue, message = self.read_message(timeout=timeout)
             except socket.timeout:
                 return None, None
 
-        if 'response' in message and message['response'] == 'BYE':
+        self.track(queue, message)
+        if isinstance(message, dict) and message.get('response') == 'BYE':
             self.close()
 
         return queue, message
@@ -108,173 +655,37 @@ class MessageQueue(object):
             if m[0]:
                 print(m[0], m[1])
 
-    def stress(self, queue, count=10000, wait=0, silent=False):
-        import time
-
-        start_time = time.time()
-        for i in range(count):
-            self.send_message(queue, dict(iteration=i))
-            if wait:
-                time.sleep(wait)
-        end_time = time.time()
-
-        if not silent:
-            print('Stress results:')
-            print('Iterations: %s' % count)
-            print('Forced wait time: %s' % wait)
-            print('Time taken: %s seconds' % (end_time - start_time))
-            print('Messages per second: %s' % (float(count) / (end_time - start_time)))
-
     def get_history(self, *queues):
-        if not queues:
-            queues = self.subscriptions
-
-        if not queues:
-            raise ValueError('Must pass at least one queue name')
-
-        if not isinstance(queues, (list, tuple)):
-            queues = [queues]
-
-        return self.send_message(self.connection_id, dict(coremq_gethistory=queues))
-
-    def subscribe(self, *queues):
-        if not queues:
-            raise ValueError('Must pass at least one queue name')
-
-        if not isinstance(queues, (list, tuple)):
-            queues = [queues]
-
-        for q in queues:
-            if q not in self.subscriptions:
-                self.subscriptions.append(q)
-
-        return self.send_message(self.connection_id, dict(coremq_subscribe=queues))
+        return self.send_control(self.history_request(queues))
+
+    def get_stats(self, *queues):
+        """
+        Asks for the broker's statistics, which arrive as the response of a control message, see pubsub.metrics
+        :param queues: Queue names or patterns to give the counters of, every queue by default
+        """
+        return self.send_control(self.stats_request(queues))
+
+    def subscribe(self, *queues, from_sequence=None):
+        """
+        :param queues: Queue names or patterns: sensor.* matches sensor.1 but not sensor.1.temp, sensor.# matches
+        sensor and every queue below it
+        :param from_sequence: Optional sequence number to start each queue from, e.g. 1 for everything still kept.
+        Patterns only receive live messages.
+        """
+        return self.send_control(self.subscription(queues, from_sequence))
 
     def unsubscribe(self, *queues):
-        if not queues:
-            raise ValueError('Must pass at least one queue name')
-
-        if not isinstance(queues, (list, tuple)):
-            queues = [queues]
-
-        for q in queues:
-            if q in self.subscriptions:
-                self.subscriptions.remove(q)
-
-        return self.send_message(self.connection_id, dict(coremq_unsubscribe=queues))
+        return self.send_control(self.unsubscription(queues))
 
     def set_options(self, **options):
-        self.options.update(options)
-
-        for key, val in options.items():
-            if val is None and key in self.options:
-                del self.options[key]
-
-        return self.send_message(self.connection_id, dict(coremq_options=options))
-
-
-def stress_worker(args):
-    import random
-    import time
-    server, port, queue, count, wait, listen_only = args
-
-    time.sleep(random.uniform(0, 1))
-    m = MessageQueue(server, port)
-    try:
-        m.connect()
-    except:
-        time.sleep(1)
-        m.connect()
-
-    if listen_only:
-        try:
-            m.subscribe(queue)
-            messages = 0
-            null_msg = 0
-            errors = 0
-            for i in range(count):
-                try:
-                    msg = m.get_message(timeout=10)
-                    if msg[0] is not None:
-                        messages += 1
-                    else:
-                        null_msg += 1
-                        if null_msg >= 2:
-                            break
-                except:
-                    errors += 1
-        except:
-            return count, 1
-
-        m.close()
-
-        return count - messages, errors
-    else:
-        time.sleep(random.uniform(0, 1))
-        errors = 0
-        start_time = time.time()
-        for i in range(count):
-            try:
-                m.send_message(queue, dict(iteration=i + 1))
-                if wait:
-                    time.sleep(wait)
-            except:
-                errors += 1
-
-        end_time = time.time()
-
-        m.close()
-        return end_time - start_time, float(count) / (end_time - start_time), errors
-
-
-def parallel_stress(server, port, queue, count=1000, wait=0.01, workers=10, listeners=90):
-    import multiprocessing
-
-    print('Beginning stress test with these settings:')
-    print('Server: %s' % server)
-    print('Queue: %s' % queue)
-    print('Count per worker: %s' % count)
-    print('Delay between messages: %s' % wait)
-    print('Number of workers: %s' % workers)
-    print('Number of listeners: %s' % listeners)
-    print('')
-
-    pool1 = multiprocessing.Pool(listeners)
-    pool2 = multiprocessing.Pool(workers)
-    tasks1 = [(server, port, queue, count, wait, True) for i in range(listeners)]
-    tasks2 = [(server, port, queue, count, wait, False) for i in range(workers)]
-
-    job1 = pool1.map_async(stress_worker, tasks1)
-    job2 = pool2.map_async(stress_worker, tasks2)
-    job1.wait()
-    job2.wait()
-    listen_results = job1.get()
-    worker_results = job2.get()
-    slowest = 0
-    fastest = 9999
-    average_mps = 0
-    errors = 0
-    missed = 0
-
-    for t, mps, errs in worker_results:
-        if t > slowest:
-            slowest = t
-
-        if t < fastest:
-            fastest = t
-
-        average_mps += mps
-        errors += errs
-
-    average_mps /= float(workers)
-
-    for m, errs in listen_results:
-        missed += m
-
-    print('Test results:')
-    print('Total count: %s' % (count * workers))
-    print('Fastest worker: %s seconds' % fastest)
-    print('Slowest worker: %s seconds' % slowest)
-    print('Number of errors: %s' % errors)
-    print('Number of missing messages: %s' % missed)
-    print('Average messages per second: %s' % average_mps)
+        return self.send_control(self.options_request(options))
+
+    def set_prefetch(self, messages=None, size=None):
+        """
+        Limits what the broker sends ahead of get_message, protocol 2 only. Messages beyond the window wait on the
+        broker, where they count against max_queued and its overflow option, and the window is granted again as
+        get_message takes messages. Subscribe after setting it, or messages may arrive before it applies.
+        :param messages: Messages the broker may send ahead, None for no limit
+        :param size: Bytes of message frames the broker may send ahead, None for no limit
+        """
+        return self.send_control(self.prefetch_request(messages, size))
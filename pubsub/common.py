@@ -24,15 +24,65 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import collections
 import json
 import logging
+import marshal
 import os
+import socket
+import struct
+import time
+import uuid
+import zlib
+
+try:
+    import lzma
+except ImportError:  # Python built without liblzma
+    lzma = None
 
 str_type = str
 from configparser import ConfigParser, NoOptionError, NoSectionError
 
 loggers = dict()
 
+PROTOCOLS = (1, 2)
+UNIX_PREFIX = 'unix://'
+LOCAL_PREFIX = 'local://'
+STATS_QUEUE = 'coremq.stats'  # reserved for the statistics the broker publishes, see pubsub.metrics
+
+# Protocol 2 frames start with a fixed header: frame kind, flags, queue name length and payload length. With
+# FLAG_METADATA the header is followed by the sender id, the time the broker received the message and its sequence
+# number in the queue (0 if it has none).
+HEADER_V2 = struct.Struct('!BBHI')
+MAX_FRAME_SIZE = 99999999  # the 100 MB limit of protocol 1, whose header holds at most 8 digits of length
+METADATA_V2 = struct.Struct('!16sdQ')
+FRAME_JSON = 0  # protocol 1 frame, control messages are recognised by their keys
+FRAME_MESSAGE = 1
+FRAME_CONTROL = 2
+FRAME_BATCH = 3  # payload is a sequence of FRAME_MESSAGE frames
+FRAME_FORWARD = 4  # a message relayed between federated brokers, see Envelope.forward_frame
+# A part of a message streamed in chunks: the payload starts with CHUNK_V2, the number of the stream on the
+# connection that publishes it, the index of the chunk and the CHUNK_ flags. The flags of the frame hold the codec of
+# the whole message, see pubsub.stream.
+FRAME_CHUNK = 5
+CHUNK_V2 = struct.Struct('!IIB')
+CHUNK_LAST = 0x01
+CHUNK_ABORT = 0x02  # the message will not be completed: its publisher went away or a subscriber lost a chunk
+CHUNK_SIZE = 65536
+CODEC_MASK = 0x07  # the low bits of the flags hold the id of the codec of the payload
+FLAG_RAW = 0x01  # id of the raw codec: payload is opaque bytes rather than JSON
+FLAG_METADATA = 0x08
+FLAG_STAMPED = 0x10  # the JSON payload already holds coremq_sender and coremq_sent
+# With FLAG_TRACE the payload is followed by TRACE_V2: the time the message was published and, in frames from the
+# broker, the time the broker dispatched it (0 before that), see pubsub.tracing
+FLAG_TRACE = 0x20
+TRACE_V2 = struct.Struct('!dd')
+COMPRESSION_MASK = 0xC0  # the high bits of the flags hold the id of the compressor of the payload, 0 if it has none
+FLAG_ZLIB = 0x40
+FLAG_LZMA = 0x80
+ENCODING_MASK = CODEC_MASK | COMPRESSION_MASK  # what it takes to decode a payload
+COMPRESSION_THRESHOLD = 1024  # smallest payload compressed by default, in bytes
+
 
 class ConnectionClosed(Exception):
     pass
@@ -42,6 +92,10 @@ class ProtocolError(Exception):
     pass
 
 
+class StreamAborted(Exception):
+    pass
+
+
 class CoreConfigParser(ConfigParser, object):
     def get(self, section, option, default=None):
         try:
@@ -50,16 +104,12 @@ class CoreConfigParser(ConfigParser, object):
             return default
 
 
-def construct_message(queue, message):
-    if not isinstance(queue, str_type):
-        raise ValueError('Queue name must be a string, not %s' % queue)
-
-    if len(queue) < 1:
-        raise ValueError('Queue name must be at least one character in length')
-
-    if ' ' in queue:
-        raise ValueError('Queue name must not contain spaces')
-
+def encode_message(message):
+    """
+    Serializes a message into the payload bytes carried by a frame
+    :param message: dict or str. Strings are wrapped as {"coremq_string": message}
+    :return: bytes
+    """
     if isinstance(message, str_type):
         message = dict(coremq_string=message)
 
@@ -74,26 +124,709 @@ def construct_message(queue, message):
     if not isinstance(message, bytes):
         message = message.encode('utf-8')
 
-    return ('+%s %s ' % (len(message) + len(queue) + 1, queue)).encode('utf-8') + message
+    return message
+
+
+class Codec(object):
+    """
+    Serializes messages into payload bytes. The id of the codec travels in the flags of protocol 2 frames, so
+    receivers decode any payload without prior agreement and the broker forwards payloads without decoding them.
+    Custom codecs take ids 3 to 7 and must be registered with register_codec on every client that uses them.
+    """
+    id = None
+    name = None
+
+    def encode(self, message):
+        raise NotImplementedError()
+
+    def decode(self, payload):
+        raise NotImplementedError()
+
+
+class JSONCodec(Codec):
+    id = 0
+    name = 'json'
+
+    def encode(self, message):
+        return encode_message(message)
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class RawCodec(Codec):
+    id = FLAG_RAW
+    name = 'raw'
+
+    def encode(self, message):
+        if not isinstance(message, (bytes, bytearray, memoryview)):
+            raise ValueError('The raw codec only sends bytes')
+
+        return bytes(message)
+
+    def decode(self, payload):
+        return payload
+
+
+class MarshalCodec(Codec):
+    id = 2
+    name = 'marshal'
+
+    def encode(self, message):
+        return marshal.dumps(message)
+
+    def decode(self, payload):
+        return marshal.loads(payload)
+
+
+CODECS = dict()
+
+
+def register_codec(codec):
+    if not 0 <= codec.id <= CODEC_MASK:
+        raise ValueError('Codec ids must be between 0 and %s' % CODEC_MASK)
+
+    CODECS[codec.id] = CODECS[codec.name] = codec
+
+
+def get_codec(codec):
+    """
+    :param codec: A Codec, or the name or id of a registered one
+    :return: Codec
+    """
+    if isinstance(codec, Codec):
+        return codec
+
+    if codec not in CODECS:
+        raise ValueError('Unknown codec: %s' % codec)
+
+    return CODECS[codec]
+
+
+register_codec(JSONCodec())
+register_codec(RawCodec())
+register_codec(MarshalCodec())
+
+
+class Compressor(object):
+    """
+    Compresses payloads. The id of the compressor travels in the flags of protocol 2 frames, next to the codec, so
+    the broker forwards compressed payloads as they are to every connection that accepts them. Traced frames keep
+    their TRACE_V2 stamps uncompressed after the payload.
+    """
+    id = None
+    name = None
+
+    def compress(self, payload):
+        raise NotImplementedError()
+
+    def decompress(self, payload):
+        raise NotImplementedError()
+
+
+class ZlibCompressor(Compressor):
+    id = FLAG_ZLIB
+    name = 'zlib'
+
+    def __init__(self, level=1):
+        """
+        :param level: 1 (fastest) to 9 (smallest), see examples/perf/compression.py
+        """
+        self.level = level
+
+    def compress(self, payload):
+        return zlib.compress(payload, self.level)
+
+    def decompress(self, payload):
+        return zlib.decompress(payload)
+
+
+class LZMACompressor(Compressor):
+    id = FLAG_LZMA
+    name = 'lzma'
+
+    def __init__(self, preset=0):
+        """
+        :param preset: 0 (fastest) to 9 (smallest)
+        """
+        self.preset = preset
+
+    def compress(self, payload):
+        return lzma.compress(payload, lzma.FORMAT_XZ, lzma.CHECK_NONE, self.preset)
+
+    def decompress(self, payload):
+        return lzma.decompress(payload, lzma.FORMAT_XZ)
+
+
+COMPRESSORS = dict()
+
+
+def register_compressor(compressor):
+    if compressor.id not in (FLAG_ZLIB, FLAG_LZMA, COMPRESSION_MASK):
+        raise ValueError('Compressor ids must be one of %s, %s or %s' % (FLAG_ZLIB, FLAG_LZMA, COMPRESSION_MASK))
+
+    COMPRESSORS[compressor.id] = COMPRESSORS[compressor.name] = compressor
+
+
+def get_compressor(compressor):
+    """
+    :param compressor: A Compressor, or the name or id of a registered one
+    :return: Compressor
+    """
+    if isinstance(compressor, Compressor):
+        return compressor
+
+    if compressor not in COMPRESSORS:
+        raise ValueError('Unknown compression: %s' % compressor)
+
+    return COMPRESSORS[compressor]
+
+
+def compress_payload(payload, compressor, threshold=COMPRESSION_THRESHOLD):
+    """
+    Compresses a payload of at least threshold bytes, unless compressing does not make it smaller
+    :param compressor: Compressor, None not to compress
+    :return: (bytes, int) - the payload and the compression flag it is sent with, 0 if it was left as it was
+    """
+    if compressor is None or len(payload) < threshold:
+        return payload, 0
+
+    compressed = compressor.compress(payload)
+    if len(compressed) >= len(payload):
+        return payload, 0
+
+    return compressed, compressor.id
+
+
+def decompress_payload(payload, flags):
+    """
+    :return: bytes - the payload of a frame with the given flags, decompressed if they name a compressor
+    """
+    if not flags & COMPRESSION_MASK:
+        return payload
+
+    compressor = COMPRESSORS.get(flags & COMPRESSION_MASK)
+    if compressor is None:
+        raise ProtocolError('Unknown compression id %s' % (flags & COMPRESSION_MASK))
+
+    return compressor.decompress(payload)
+
+
+register_compressor(ZlibCompressor())
+if lzma is not None:
+    register_compressor(LZMACompressor())
+
+
+def validate_queue(queue):
+    if not isinstance(queue, str_type):
+        raise ValueError('Queue name must be a string, not %s' % queue)
+
+    if len(queue) < 1:
+        raise ValueError('Queue name must be at least one character in length')
+
+    if ' ' in queue:
+        raise ValueError('Queue name must not contain spaces')
+
+
+def is_pattern(queue):
+    """
+    Tells whether a subscription is a pattern: a name with "*" (exactly one level) or "#" (any number of levels, none
+    included) between its dots, like sensor.* or sensor.#
+    """
+    levels = queue.split('.')
+    return '*' in levels or '#' in levels
+
+
+def queue_matches(pattern, queue):
+    """
+    Tells whether a queue is covered by a subscription, following the rules of is_pattern
+    """
+    return levels_match(pattern.split('.'), queue.split('.'))
+
+
+def levels_match(pattern, levels):
+    if not pattern:
+        return not levels
+
+    if pattern[0] == '#':
+        return any(levels_match(pattern[1:], levels[i:]) for i in range(len(levels) + 1))
+
+    if not levels or pattern[0] not in ('*', levels[0]):
+        return False
+
+    return levels_match(pattern[1:], levels[1:])
+
+
+def construct_frame(queue, payload):
+    """
+    Frames an already encoded payload for the given queue. The result can be sent to any number of sockets.
+    :param queue: The queue name
+    :param payload: bytes from encode_message
+    :return: bytes
+    """
+    return frame_header(queue, len(payload)) + payload
+
+
+def frame_header(queue, length):
+    """
+    Builds everything that precedes a payload of the given length in a protocol 1 frame, so the payload can be sent
+    from its own buffer
+    :return: bytes
+    """
+    validate_queue(queue)
+    return ('+%s %s ' % (length + len(queue.encode('utf-8')) + 1, queue)).encode('utf-8')
+
+
+def construct_frame_v2(queue, payload, kind=FRAME_MESSAGE, flags=0, metadata=None):
+    """
+    Frames a payload with the binary header of protocol 2
+    :param queue: The queue name
+    :param payload: bytes
+    :param kind: FRAME_MESSAGE, FRAME_CONTROL or FRAME_BATCH
+    :param flags: The codec id of the payload, with the flag of its compressor if it is compressed
+    :param metadata: Optional (sender, sent, seq), the sender being a connection id
+    :return: bytes
+    """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError('Message cannot be 100MB or larger')
+
+    return frame_header_v2(queue, len(payload), kind, flags, metadata) + payload
+
+
+def frame_header_v2(queue, length, kind=FRAME_MESSAGE, flags=0, metadata=None):
+    """
+    Builds everything that precedes a payload of the given length in a protocol 2 frame
+    :return: bytes
+    """
+    validate_queue(queue)
+    queue = queue.encode('utf-8')
+
+    if metadata is None:
+        return HEADER_V2.pack(kind, flags, len(queue), length) + queue
+
+    sender, sent, seq = metadata
+    return (HEADER_V2.pack(kind, flags | FLAG_METADATA, len(queue), length) +
+            METADATA_V2.pack(uuid.UUID(sender).bytes, sent, seq or 0) + queue)
+
+
+def construct_message(queue, message, protocol=1, kind=FRAME_MESSAGE, codec=None, trace=False, compressor=None,
+                      threshold=COMPRESSION_THRESHOLD):
+    """
+    :param trace: True to stamp the message with the time it is published, protocol 2 only
+    :param compressor: Compressor of payloads of at least threshold bytes, protocol 2 only
+    """
+    if protocol == 1:
+        return construct_frame(queue, encode_message(message))
+
+    if codec is None:
+        codec = CODECS['raw' if isinstance(message, bytes) else 'json']
+
+    payload, compression = compress_payload(codec.encode(message), compressor, threshold)
+    if trace:
+        return construct_frame_v2(queue, payload + TRACE_V2.pack(time.time(), 0), kind,
+                                  codec.id | compression | FLAG_TRACE)
+
+    return construct_frame_v2(queue, payload, kind, codec.id | compression)
+
+
+def construct_batch(queue, messages, protocol=1, codec=None, trace=False, compressor=None,
+                    threshold=COMPRESSION_THRESHOLD):
+    """
+    Builds a single frame publishing every (queue, message) pair
+    :param queue: The connection id of the publisher, batches are control messages
+    :param messages: list of (queue, message) pairs
+    :param protocol: 1 or 2
+    :param codec: Codec of the messages, protocol 2 only
+    :param trace: True to stamp the messages with the time they are published, protocol 2 only
+    :param compressor: Compressor of the messages of at least threshold bytes, protocol 2 only
+    :return: bytes
+    """
+    if protocol == 1:
+        return construct_message(queue, dict(coremq_batch=messages))
+
+    body = b''.join(construct_message(q, m, 2, FRAME_MESSAGE, codec, trace, compressor, threshold)
+                    for q, m in messages)
+    return construct_frame_v2(queue, body, FRAME_BATCH)
+
+
+def construct_chunk(queue, stream, index, data, flags=0, codec=FLAG_RAW):
+    """
+    Frames a chunk of a streamed message
+    :param stream: The number of the stream on the publishing connection
+    :param index: The index of the chunk in the stream, from 0
+    :param flags: CHUNK_LAST for the last chunk, CHUNK_ABORT to give the message up
+    :param codec: The id of the codec of the whole message
+    :return: bytes
+    """
+    return construct_frame_v2(queue, CHUNK_V2.pack(stream, index, flags) + data, FRAME_CHUNK, codec)
+
 
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """
+    Splits a message to stream into chunks
+    :param source: bytes, a binary file or any object with read(size), or an iterable of bytes
+    :return: generator of bytes of up to chunk_size
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+        return
 
-def send_message(socket, queue, message):
-    socket.send(construct_message(queue, message))
+    if hasattr(source, 'read'):
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    for data in source:
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+
+def split_trace(payload, flags):
+    """
+    Separates a payload from the TRACE_V2 stamps that follow it in frames with FLAG_TRACE
+    :return: (payload, published, dispatched) - the times being None if the frame has no stamps
+    """
+    if not flags & FLAG_TRACE:
+        return payload, None, None
+
+    end = len(payload) - TRACE_V2.size
+    published, dispatched = TRACE_V2.unpack_from(payload, end)
+    return payload[:end], published, dispatched
+
+
+def iter_frames_v2(data):
+    """
+    Splits the payload of a FRAME_BATCH frame into its frames
+    :return: generator of (queue, payload, kind, flags, metadata)
+    """
+    offset = 0
+    view = memoryview(data)
+    while offset < len(data):
+        kind, flags, queue_length, length = HEADER_V2.unpack_from(data, offset)
+        offset += HEADER_V2.size
+        metadata = None
+        if flags & FLAG_METADATA:
+            metadata = unpack_metadata(data, offset)
+            offset += METADATA_V2.size
+        queue = bytes(view[offset:offset + queue_length]).decode('utf-8')
+        offset += queue_length
+        yield queue, bytes(view[offset:offset + length]), kind, flags, metadata
+        offset += length
+
+
+def unpack_metadata(data, offset):
+    sender, sent, seq = METADATA_V2.unpack_from(data, offset)
+    return str(uuid.UUID(bytes=sender)), sent, seq or None
+
+
+def send_message(socket, queue, message, protocol=1, kind=FRAME_MESSAGE):
+    socket.send(construct_message(queue, message, protocol, kind))
+
+
+def send_frame(socket, frame):
+    socket.send(frame)
 
 
 def get_message(socket, timeout=1):
     socket.settimeout(timeout)
-    data = socket.recv(10).decode('utf-8')
+    # the header is ASCII, latin-1 keeps the bytes of the body intact
+    data = socket.recv(10).decode('latin-1')
     expected_length, data = validate_header(data)
 
-    while len(data) < expected_length:
-        data += socket.recv(expected_length - len(data)).decode('utf-8')
+    chunks = [data.encode('latin-1')]
+    received = len(chunks[0])
+    while received < expected_length:
+        chunk = socket.recv(expected_length - received)
+        if not chunk:
+            raise ConnectionClosed()
+        chunks.append(chunk)
+        received += len(chunk)
 
-    if ' ' not in data:
-        return None, data
+    return decode_frame(*split_frame(b''.join(chunks)))
+
+
+def unix_path(address):
+    """
+    :return: str - the path of a unix:///path address, None for other addresses
+    """
+    if isinstance(address, str_type) and address.startswith(UNIX_PREFIX):
+        return address[len(UNIX_PREFIX):]
+
+    return None
+
+
+def create_connection(address, port, timeout=None):
+    """
+    Connects to a broker
+    :param address: A host name or IP address, unix:///path for a Unix domain socket, or local://name for a broker
+    embedded in this process (see pubsub.local.LocalBroker)
+    :param port: The TCP port, unused by the other kinds of address
+    :param timeout: Timeout of the socket in seconds, None to block
+    :return: socket, or a pubsub.local.LocalSocket that works like one
+    """
+    if isinstance(address, str_type) and address.startswith(LOCAL_PREFIX):
+        from pubsub.local import LocalBroker
+        sock = LocalBroker.connect_to(address[len(LOCAL_PREFIX):])
+        sock.settimeout(timeout)
+        return sock
+
+    path = unix_path(address)
+    if path is None:
+        sock = socket.create_connection((address, port), timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+
+    return sock
+
+
+def split_frame(body):
+    """
+    Splits the body of a frame (everything after the length) into its queue name and payload
+    :param body: bytes or bytearray
+    :return: (str, bytes) - the queue, or None if the body has no queue, and the payload
+    """
+    index = body.find(b' ')
+    if index < 0:
+        return None, body, FRAME_JSON, 0, None
+
+    return body[:index].decode('utf-8'), body[index + 1:], FRAME_JSON, 0, None
+
+
+def decode_frame(queue, payload, kind=FRAME_JSON, flags=0, metadata=None):
+    """
+    Decodes the payload of a frame returned by FrameReader with the compressor and codec named in its flags. Sender,
+    time and sequence number from the header are added to dict messages as coremq_sender, coremq_sent and
+    coremq_seq, like protocol 1 brokers do.
+    :return: (str, object) - the queue and the message
+    """
+    if queue is None:
+        return None, payload.decode('utf-8')
+
+    codec = CODECS.get(flags & CODEC_MASK)
+    if codec is None:
+        raise ProtocolError('Unknown codec id %s' % (flags & CODEC_MASK))
+
+    if flags & FLAG_TRACE:
+        payload = split_trace(payload, flags)[0]
+
+    message = codec.decode(decompress_payload(payload, flags))
+    if metadata is not None and isinstance(message, dict):
+        message['coremq_sender'], message['coremq_sent'], seq = metadata
+        if seq is not None:
+            message['coremq_seq'] = seq
+
+    return queue, message
+
+
+class FrameReader(object):
+    """
+    Incremental decoder for "+<length> <queue> <payload>" frames. Data is received with recv_into into a preallocated
+    buffer and the headers are parsed straight from bytes, so one read can yield several frames and a multi-byte
+    character split across reads is never decoded on its own. Frames too large for the buffer get a dedicated
+    buffer that is received into directly.
+
+    Frames are returned as (queue, payload, kind, flags, metadata) tuples. Setting protocol to 2 switches the reader to the
+    binary header of protocol 2 for data parsed from then on, so a peer must wait for the switch to be acknowledged
+    before sending protocol 2 frames.
+    """
 
-    queue, message = data.split(' ', 1)
-    return queue, json.loads(message)
+    def __init__(self, socket=None, buffer_size=65536):
+        self.socket = socket
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.large = None
+        self.large_filled = 0
+        self.large_header = None
+        self.frames = collections.deque()
+        self.timeout = -1
+        self.protocol = 1
+
+    def feed(self, data):
+        """
+        Adds bytes received by other means, for example from an asyncio protocol
+        :param data: bytes
+        :return: list of (queue, payload, kind, flags, metadata) frames completed by this data
+        """
+        offset = 0
+        while offset < len(data):
+            if self.large is not None:
+                count = min(len(data) - offset, len(self.large) - self.large_filled)
+                self.large[self.large_filled:self.large_filled + count] = data[offset:offset + count]
+                self.large_filled += count
+            else:
+                self.compact()
+                count = min(len(data) - offset, len(self.buffer) - self.end)
+                self.buffer[self.end:self.end + count] = data[offset:offset + count]
+                self.end += count
+
+            offset += count
+            self.parse()
+
+        frames = list(self.frames)
+        self.frames.clear()
+        return frames
+
+    def fill(self, timeout):
+        if timeout != self.timeout:
+            self.socket.settimeout(timeout)
+            self.timeout = timeout
+
+        if self.large is not None:
+            count = self.socket.recv_into(memoryview(self.large)[self.large_filled:])
+            self.large_filled += count
+        else:
+            self.compact()
+            count = self.socket.recv_into(self.view[self.end:])
+            self.end += count
+
+        if not count:
+            raise ConnectionClosed()
+
+        self.parse()
+
+    def compact(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            pending = self.end - self.start
+            self.buffer[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+
+    def parse(self):
+        buffer = self.buffer
+
+        while True:
+            if self.large is not None:
+                # bytes of a large frame that arrived together with its header
+                count = min(self.end - self.start, len(self.large) - self.large_filled)
+                if count:
+                    self.large[self.large_filled:self.large_filled + count] = self.view[self.start:self.start + count]
+                    self.large_filled += count
+                    self.start += count
+
+                if self.large_filled < len(self.large):
+                    return
+
+                if self.large_header is None:
+                    self.frames.append(split_frame(self.large))
+                else:
+                    kind, flags, queue_length, metadata = self.large_header
+                    queue = bytes(self.large[:queue_length]).decode('utf-8')
+                    del self.large[:queue_length]
+                    self.frames.append((queue, self.large, kind, flags, metadata))
+                self.large = None
+                continue
+
+            if self.start == self.end:
+                return
+
+            if self.protocol == 2:
+                if not self.parse_v2():
+                    return
+                continue
+
+            if buffer[self.start] != 43:  # +
+                raise ProtocolError('Missing beginning +')
+
+            space = buffer.find(b' ', self.start, min(self.end, self.start + 10))
+            if space < 0:
+                if self.end - self.start >= 10:
+                    raise ProtocolError('Missing space after length')
+                return
+
+            digits = buffer[self.start + 1:space]
+            if not digits.isdigit():
+                # int() would take a sign or spaces, and a negative length never moves past the frame
+                raise ProtocolError('Length integer must be between + and space')
+
+            length = int(digits)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError('Frame of %s bytes is 100MB or larger' % length)
+
+            body_end = space + 1 + length
+            if body_end <= self.end:
+                self.frames.append(split_frame(bytes(self.view[space + 1:body_end])))
+                self.start = body_end
+            elif space + 1 + length - self.start > len(buffer):
+                self.large = bytearray(length)
+                self.large_filled = 0
+                self.large_header = None
+                self.start = space + 1
+            else:
+                return
+
+    def parse_v2(self):
+        """
+        Parses one protocol 2 frame at the start of the buffer
+        :return: bool - False if more data is needed
+        """
+        if self.end - self.start < HEADER_V2.size:
+            return False
+
+        kind, flags, queue_length, length = HEADER_V2.unpack_from(self.buffer, self.start)
+        if length > MAX_FRAME_SIZE:
+            # checked before the frame is allocated, a header alone must not cost the reader its memory
+            raise ProtocolError('Frame of %s bytes is 100MB or larger' % length)
+
+        queue_start = self.start + HEADER_V2.size
+        metadata = None
+        if flags & FLAG_METADATA:
+            if self.end - queue_start < METADATA_V2.size:
+                return False
+
+            metadata = unpack_metadata(self.buffer, queue_start)
+            queue_start += METADATA_V2.size
+
+        body_end = queue_start + queue_length + length
+        if body_end <= self.end:
+            queue = bytes(self.view[queue_start:queue_start + queue_length]).decode('utf-8')
+            self.frames.append((queue, bytes(self.view[queue_start + queue_length:body_end]), kind, flags, metadata))
+            self.start = body_end
+            return True
+
+        if body_end - self.start > len(self.buffer):
+            self.large = bytearray(queue_length + length)
+            self.large_filled = 0
+            self.large_header = (kind, flags, queue_length, metadata)
+            self.start = queue_start
+            return True
+
+        return False
+
+    def read_frames(self, timeout=1):
+        """
+        Returns every frame that is already buffered, receiving from the socket only if there is none
+        :return: list of (queue, payload, kind, flags, metadata)
+        """
+        while not self.frames:
+            self.fill(timeout)
+
+        frames = list(self.frames)
+        self.frames.clear()
+        return frames
+
+    def read_frame(self, timeout=1):
+        while not self.frames:
+            self.fill(timeout)
+
+        return self.frames.popleft()
+
+    def get_message(self, timeout=1):
+        return decode_frame(*self.read_frame(timeout))
 
 
 def validate_header(data):
@@ -0,0 +1,238 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import collections
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from pubsub.common import ENCODING_MASK, FLAG_STAMPED, FRAME_CONTROL, FRAME_FORWARD, ConnectionClosed, FrameReader, \
+    construct_message, create_connection, send_message, split_trace
+from pubsub.server import Envelope, MessageQueueHandler, Outbox, node_id, queue_lock
+
+RETRY_INTERVAL = 1  # seconds between attempts to reach a peer broker
+HANDSHAKE_TIMEOUT = 10
+
+
+class Bridge(MessageQueueHandler):
+    """
+    The connection of this broker to a peer broker, made as a client of the peer. It subscribes there to the queues
+    and patterns wanted on this broker, and publishes what it receives here as if published locally, so the
+    messages are numbered, stored and delivered by this broker too, and relayed on to its other bridges. The peer
+    relays messages with FRAME_FORWARD frames.
+
+    The connection is made again whenever it is lost. Messages published on the peer in the meantime are not
+    relayed.
+    """
+
+    def __init__(self, federation, address, port):
+        self.federation = federation
+        self.address = address
+        self.port = port
+        self.connections = federation.handler_class.connections
+        self.routes = federation.handler_class.routes
+        self.options = dict(ack='none')
+        self.published = 0
+        self.acked = 0
+        self.ack_deadline = None
+        self.protocol = 2
+        self.backlogs = []
+        self.conn_id = str(uuid.uuid4())
+        self.peer_id = None
+        self.outbox = None
+
+    def run(self):
+        while True:
+            try:
+                sock = create_connection(self.address, self.port)
+            except socket.error:
+                time.sleep(RETRY_INTERVAL)
+                continue
+
+            try:
+                self.serve(sock)
+            except (ConnectionClosed, socket.error) as ex:
+                print('Lost the bridge to %s:%s: %s' % (self.address, self.port, ex))
+            finally:
+                self.federation.detach(self)
+                if self.outbox is not None:
+                    self.outbox.close()
+                sock.close()
+
+            time.sleep(RETRY_INTERVAL)
+
+    def serve(self, sock):
+        reader = FrameReader(sock)
+        self.peer_id, welcome = reader.get_message(timeout=HANDSHAKE_TIMEOUT)
+        if 2 not in welcome.get('protocols', [1]):
+            raise ConnectionClosed('%s:%s does not speak protocol 2' % (self.address, self.port))
+
+        # the peer answers in protocol 1, then switches
+        send_message(sock, self.peer_id, dict(coremq_protocol=2), 1, FRAME_CONTROL)
+        self.expect(reader, 'OK: Protocol')
+        reader.protocol = 2
+
+        send_message(sock, self.peer_id, dict(coremq_bridge=node_id()), 2, FRAME_CONTROL)
+        self.node = self.expect(reader, 'OK: Bridged')['coremq_node']
+        if self.node == node_id():
+            raise ConnectionClosed('%s:%s is this broker' % (self.address, self.port))
+
+        self.outbox = Outbox(sock, self.options)
+        self.federation.attach(self)
+        print('Bridged to %s:%s' % (self.address, self.port))
+
+        while True:
+            frames = reader.read_frames(timeout=None)
+            if self.federation.dispatch is None:
+                self.receive(frames)
+            else:
+                self.federation.dispatch(self.receive, frames)
+
+    def expect(self, reader, response):
+        while True:
+            queue, message = reader.get_message(timeout=HANDSHAKE_TIMEOUT)
+            if queue == self.peer_id and isinstance(message, dict):
+                if str(message.get('response', '')).startswith(response):
+                    return message
+                if message.get('response') not in (None, 'OK: Subscribe successful', 'OK: Unsubscribe successful'):
+                    raise ConnectionClosed(message['response'])
+
+    def receive(self, frames):
+        for queue, payload, kind, flags, metadata in frames:
+            try:
+                if kind == FRAME_FORWARD:
+                    self.relay(queue, payload, flags, metadata)
+                elif kind == FRAME_CONTROL:
+                    message = payload.decode('utf-8')
+                    if 'OK' not in message:
+                        print('Bridge to %s:%s: %s' % (self.address, self.port, message))
+            except Exception as ex:
+                print('Bridge to %s:%s' % (self.address, self.port), ex)
+                traceback.print_exc()
+
+    def relay(self, queue, payload, flags, metadata):
+        count = payload[0]
+        start = 1 + 16 * count
+        path = tuple(str(uuid.UUID(bytes=payload[i:i + 16])) for i in range(1, start, 16)) + (node_id(),)
+        seq = metadata[2]
+        message, published, _ = split_trace(payload[start:], flags)
+        envelope = Envelope(queue, message, flags & ENCODING_MASK, metadata[0], metadata[1],
+                            bool(flags & FLAG_STAMPED), origin=(path, seq), published=published)
+
+        with queue_lock(queue):
+            # a message can arrive through more than one bridge when brokers form a cycle, only the first counts
+            key = (path[0], queue)
+            if seq <= self.federation.seen.get(key, 0):
+                return
+
+            self.federation.seen[key] = seq
+            self.route(self.conn_id, [envelope])
+
+    def subscribe_peer(self, queues, subscribe=True):
+        if self.outbox is not None and queues:
+            key = 'coremq_subscribe' if subscribe else 'coremq_unsubscribe'
+            self.outbox.put(construct_message(self.peer_id, {key: queues}, 2, FRAME_CONTROL), control=True)
+
+
+class Federation(object):
+    """
+    Links this broker with peer brokers so their clients share queues. Every broker connects to each of its peers
+    with a Bridge and subscribes there to the queues its own connections want. Those include the bridges of other
+    brokers, so a message travels as far as there is interest in it, but never back to a broker it came from: a
+    bridge asks a peer only for what is wanted by someone other than that peer.
+
+    Each relayed message carries the ids of the brokers it went through, starting from its origin, and is never
+    relayed to one of them again. If the brokers form a cycle a message can still arrive twice by different ways,
+    so each broker remembers the last sequence number it took from each origin, per queue, and drops the rest.
+
+    Peers must list each other for messages to flow both ways.
+    """
+
+    def __init__(self, peers):
+        """
+        :param peers: list of (address, port) of the peer brokers
+        """
+        self.peers = list(peers)
+        self.bridges = []
+        # queue -> Counter of the subscribers of this broker by the broker they come from, None for local clients
+        self.interests = dict()
+        self.seen = dict()
+        self.lock = threading.Lock()
+        self.handler_class = None
+        self.dispatch = None
+
+    def start(self, handler_class, dispatch=None):
+        """
+        :param handler_class: The request handler of the engine, whose connections and routes the bridges use
+        :param dispatch: Function called with a function and its arguments to run them on the engine's thread, None
+        to run them on the thread of the bridge
+        """
+        self.handler_class = handler_class
+        self.dispatch = dispatch
+        print('Federated broker %s' % node_id())
+        for address, port in self.peers:
+            bridge = Bridge(self, address, port)
+            threading.Thread(target=bridge.run, daemon=True).start()
+
+    def wanted(self, queue, node):
+        return any(source != node for source in self.interests.get(queue, ()))
+
+    def interest(self, queues, change, source=None):
+        """
+        Counts the subscribers of this broker to each queue, subscribing the bridges to the queues their peer does
+        not already provide for every subscriber
+        :param source: The id of the broker whose bridge subscribed, None for clients
+        """
+        with self.lock:
+            changes = []
+            for q in queues:
+                before = [self.wanted(q, bridge.node) for bridge in self.bridges]
+                counts = self.interests.setdefault(q, collections.Counter())
+                count = counts[source] + change
+                if count > 0:
+                    counts[source] = count
+                else:
+                    counts.pop(source, None)
+                if not counts:
+                    del self.interests[q]
+
+                for bridge, was in zip(self.bridges, before):
+                    if was != self.wanted(q, bridge.node):
+                        changes.append((bridge, q, not was))
+
+            for bridge, q, subscribe in changes:
+                bridge.subscribe_peer([q], subscribe)
+
+    def attach(self, bridge):
+        with self.lock:
+            self.bridges.append(bridge)
+            bridge.subscribe_peer([q for q in self.interests if self.wanted(q, bridge.node)])
+
+    def detach(self, bridge):
+        with self.lock:
+            if bridge in self.bridges:
+                self.bridges.remove(bridge)
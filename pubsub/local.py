@@ -0,0 +1,390 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import asyncio
+import collections
+import socket
+import threading
+import time
+
+from pubsub.async_server import AsyncRequestHandler
+from pubsub.common import unix_path
+from pubsub.server import PORT, ThreadedTCPServer, open_store, remove_socket
+
+HIGH_WATER = 1 << 20  # bytes waiting for a client before the broker considers it a slow reader
+LOW_WATER = HIGH_WATER // 4
+
+
+class LocalTransport(object):
+    """
+    The broker's end of a connection made within the process, standing in for an asyncio transport. Frames written
+    by the broker are handed to the LocalSocket of the client as they are, and the client's bytes are passed to the
+    broker by receive.
+    """
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.protocol = None
+        self.closing = False
+        self.paused = False
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def receive(self):
+        chunks = self.socket.take()
+        while chunks:
+            if self.closing:
+                return
+
+            if not self.socket.reading:
+                # the broker paused reading from this client, resume_reading takes the rest
+                self.socket.give_back(chunks)
+                return
+
+            self.protocol.data_received(chunks.popleft())
+
+    def write(self, data):
+        if self.closing:
+            return
+
+        buffered = self.socket.feed(data)
+        if buffered > HIGH_WATER and not self.paused:
+            self.paused = True
+            self.protocol.pause_writing()
+
+    def writelines(self, buffers):
+        self.write(b''.join(buffers))
+
+    def drained(self):
+        """
+        Called once the client has read enough of what was written after the transport paused writing
+        """
+        if self.paused and not self.closing:
+            self.paused = False
+            self.protocol.resume_writing()
+
+    def is_closing(self):
+        return self.closing
+
+    def pause_reading(self):
+        self.socket.pause()
+
+    def resume_reading(self):
+        if self.socket.resume():
+            self.receive()
+
+    def close(self):
+        if self.closing:
+            return
+
+        self.closing = True
+        self.socket.feed_eof()
+        asyncio.get_event_loop().call_soon(self.protocol.connection_lost, None)
+
+    abort = close
+
+
+class LocalSocket(object):
+    """
+    The client's end of a connection to a LocalBroker, with the parts of the socket API that the clients use. Writes
+    queue the bytes for the event loop of the broker, which is woken up once for everything written since it last
+    took them. Reads wait for the frames the broker wrote.
+    """
+
+    def __init__(self, broker):
+        self.loop = broker.loop
+        self.transport = LocalTransport(self)
+        self.condition = threading.Condition()
+        # bytes from the broker
+        self.chunks = collections.deque()
+        self.buffered = 0
+        # bytes for the broker, taken by the event loop
+        self.outgoing = collections.deque()
+        self.scheduled = False
+        self.reading = True
+        self.resuming = False
+        self.timeout = None
+        self.eof = False
+        self.closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def wait(self, ready, deadline):
+        """
+        Waits on the condition, which must be held, until ready() is true
+        """
+        while not ready():
+            if deadline is None:
+                self.condition.wait()
+                continue
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('timed out')
+            self.condition.wait(remaining)
+
+    def deadline(self):
+        return None if self.timeout is None else time.time() + self.timeout
+
+    def sendall(self, data):
+        deadline = self.deadline()
+        with self.condition:
+            # the broker stops reading from publishers whose subscribers are too slow
+            self.wait(lambda: self.reading or self.closed or self.eof, deadline)
+            if self.closed or self.eof:
+                raise BrokenPipeError('The connection to the broker is closed')
+
+            self.outgoing.append(bytes(data))
+            if self.scheduled:
+                return
+
+            self.scheduled = True
+
+        self.loop.call_soon_threadsafe(self.transport.receive)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def take(self):
+        with self.condition:
+            chunks, self.outgoing = self.outgoing, collections.deque()
+            self.scheduled = False
+            return chunks
+
+    def give_back(self, chunks):
+        with self.condition:
+            chunks.extend(self.outgoing)
+            self.outgoing = chunks
+
+    def pause(self):
+        with self.condition:
+            self.reading = False
+
+    def resume(self):
+        """
+        :return: bool - True if there are bytes for the broker to read
+        """
+        with self.condition:
+            self.reading = True
+            self.condition.notify_all()
+            return bool(self.outgoing)
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer)
+        if nbytes:
+            view = view[:nbytes]
+
+        deadline = self.deadline()
+        with self.condition:
+            self.wait(lambda: self.chunks or self.eof or self.closed, deadline)
+            count = 0
+            while self.chunks and count < len(view):
+                chunk = self.chunks[0]
+                size = min(len(chunk), len(view) - count)
+                view[count:count + size] = chunk[:size]
+                count += size
+                if size < len(chunk):
+                    self.chunks[0] = memoryview(chunk)[size:]
+                else:
+                    self.chunks.popleft()
+
+            self.buffered -= count
+            resume = self.transport.paused and self.buffered < LOW_WATER and not self.resuming
+            if resume:
+                self.resuming = True
+
+        if resume:
+            self.loop.call_soon_threadsafe(self.drained)
+
+        return count
+
+    def recv(self, size):
+        buffer = bytearray(size)
+        return bytes(buffer[:self.recv_into(buffer)])
+
+    def drained(self):
+        self.resuming = False
+        self.transport.drained()
+
+    def feed(self, data):
+        """
+        Called on the event loop with bytes written by the broker
+        :return: int - the bytes the client has not read yet
+        """
+        with self.condition:
+            self.chunks.append(data)
+            self.buffered += len(data)
+            self.condition.notify_all()
+            return self.buffered
+
+    def feed_eof(self):
+        with self.condition:
+            self.eof = True
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+
+            self.closed = True
+            self.condition.notify_all()
+
+        try:
+            self.loop.call_soon_threadsafe(self.transport.close)
+        except RuntimeError:
+            # the broker has stopped
+            pass
+
+    def shutdown(self, how):
+        self.close()
+
+
+class LocalBroker(object):
+    """
+    A broker embedded in the application: the asyncio engine running on a thread of its own. Clients in the same
+    process connect to it with the address local://name, for example MessageQueue('local://broker'), which hands
+    their frames to the broker, and the broker's frames back, without a socket or a system call per message.
+
+    Messages are still encoded by their publisher and decoded by each subscriber, as the broker keeps and routes
+    encoded payloads for its history, store and other clients.
+
+    The broker can also listen on a TCP port or a Unix socket for clients in other processes. Its state belongs to
+    the process, so a process runs a single broker.
+    """
+    BROKERS = dict()
+
+    def __init__(self, name='broker', store=None, metrics=None):
+        """
+        :param name: The name in the local:// address of the broker
+        :param store: Optional pubsub.store.LogStore to keep history on disk
+        :param metrics: Optional pubsub.metrics.Metrics to count what the broker does
+        """
+        self.name = name
+        self.store = store
+        self.metrics = metrics
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.path = None
+        self.error = None
+
+    def start(self, address=None, port=PORT):
+        """
+        :param address: Optional address to listen on as well, or unix:///path for a Unix domain socket
+        :param port: The TCP port to listen on along with address
+        """
+        if LocalBroker.BROKERS:
+            raise ValueError('A broker is already running in this process')
+
+        print('Starting message queue (local://%s)' % self.name)
+        open_store(self.store)
+        self.loop = asyncio.new_event_loop()
+        ThreadedTCPServer.METRICS = self.metrics
+        if self.metrics is not None:
+            self.metrics.start(AsyncRequestHandler, self.loop.call_soon_threadsafe)
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(address, port, ready), name='coremq-broker', daemon=True)
+        self.thread.start()
+        ready.wait()
+        if self.error is not None:
+            raise self.error
+
+        LocalBroker.BROKERS[self.name] = self
+        return self
+
+    def run(self, address, port, ready):
+        asyncio.set_event_loop(self.loop)
+        try:
+            if address is not None:
+                self.path = unix_path(address)
+                if self.path is not None:
+                    remove_socket(self.path)
+                    self.server = self.loop.run_until_complete(
+                        self.loop.create_unix_server(AsyncRequestHandler, self.path, backlog=1024))
+                else:
+                    self.server = self.loop.run_until_complete(
+                        self.loop.create_server(AsyncRequestHandler, address, port, reuse_address=True, backlog=1024))
+        except Exception as ex:
+            self.error = ex
+            return
+        finally:
+            ready.set()
+
+        try:
+            self.loop.run_forever()
+        finally:
+            if self.server is not None:
+                self.server.close()
+                self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+            if self.path is not None:
+                remove_socket(self.path)
+
+    @classmethod
+    def connect_to(cls, name):
+        """
+        :return: LocalSocket - a new connection to the broker of this process with the given name
+        """
+        broker = cls.BROKERS.get(name)
+        if broker is None:
+            raise ConnectionRefusedError('No broker named %s runs in this process' % name)
+
+        return broker.connect()
+
+    def connect(self):
+        sock = LocalSocket(self)
+        self.loop.call_soon_threadsafe(self.accept, sock)
+        return sock
+
+    def accept(self, sock):
+        handler = AsyncRequestHandler()
+        sock.transport.protocol = handler
+        handler.connection_made(sock.transport)
+
+    def stop(self):
+        LocalBroker.BROKERS.pop(self.name, None)
+        if self.thread is None:
+            return
+
+        def shutdown():
+            print('Shutting down message queue')
+            for d in list(AsyncRequestHandler.connections.values()):
+                d['handler'].transport.close()
+            self.loop.call_soon(self.loop.stop)
+
+        self.loop.call_soon_threadsafe(shutdown)
+        self.thread.join()
+        self.thread = None
+        if self.store is not None:
+            self.store.close()
+
+        print('Message queue stopped')
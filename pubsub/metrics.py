@@ -0,0 +1,203 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import threading
+import time
+import traceback
+import uuid
+
+from pubsub.common import STATS_QUEUE, JSONCodec, encode_message, queue_matches
+from pubsub.server import Envelope, MessageQueueHandler, ThreadedTCPServer, node_id
+from pubsub.tracing import Histogram
+
+
+class Metrics(object):
+    """
+    Counters kept by a broker process while it runs: messages and bytes published to and delivered from each queue,
+    the fan-out of each message, messages dropped for slow subscribers, and histograms of the time spent handling
+    a frame and storing and delivering a publish. Frames waiting for each connection are counted when a snapshot is
+    taken. With several workers, each one counts the queues it owns and answers coremq_stats for itself.
+
+    Set as ThreadedTCPServer.METRICS, where the engines find it. Every count is taken under one lock, which the
+    threaded engine needs and costs the asyncio engine little.
+    """
+
+    def __init__(self, interval=None):
+        """
+        :param interval: Seconds between snapshots published on STATS_QUEUE, None not to publish them
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # queue -> [messages in, bytes in, messages out, bytes out]
+        self.queues = dict()
+        self.frames = 0
+        self.handler_latency = Histogram(1e6)
+        self.broadcast_latency = Histogram(1e6)
+        self.fanout = Histogram()
+        # by connections that have closed
+        self.dropped = 0
+
+    def start(self, handler_class, dispatch=None):
+        """
+        Starts publishing snapshots every interval seconds, if an interval was given
+        :param handler_class: The request handler of the engine, whose connections and routes the snapshots reach
+        :param dispatch: Function called with a function to run it on the engine's thread, None to run it on a thread
+        of its own
+        """
+        if not self.interval:
+            return
+
+        publisher = StatsPublisher(self, handler_class)
+        threading.Thread(target=publisher.run, args=(dispatch,), daemon=True).start()
+
+    def queue(self, queue):
+        counters = self.queues.get(queue)
+        if counters is None:
+            counters = self.queues[queue] = [0, 0, 0, 0]
+
+        return counters
+
+    def handled(self, elapsed):
+        """
+        Counts a frame from a client
+        :param elapsed: Seconds spent handling it
+        """
+        with self.lock:
+            self.frames += 1
+            self.handler_latency.record(elapsed)
+
+    def published(self, queue, envelopes, fanout, elapsed):
+        """
+        Counts messages published together to one queue, and their deliveries
+        :param fanout: Connections each message was passed to
+        :param elapsed: Seconds spent storing and delivering them
+        """
+        size = sum(len(e.payload) for e in envelopes)
+        with self.lock:
+            counters = self.queue(queue)
+            counters[0] += len(envelopes)
+            counters[1] += size
+            counters[2] += fanout * len(envelopes)
+            counters[3] += fanout * size
+            self.fanout.record(fanout, len(envelopes))
+            self.broadcast_latency.record(elapsed)
+
+    def delivered(self, queue, envelope, fanout):
+        """
+        Counts the deliveries of a message published to another worker
+        :param fanout: Connections the message was passed to
+        """
+        with self.lock:
+            counters = self.queue(queue)
+            counters[2] += fanout
+            counters[3] += fanout * len(envelope.payload)
+            self.fanout.record(fanout)
+
+    def closed(self, dropped):
+        if dropped:
+            with self.lock:
+                self.dropped += dropped
+
+    def snapshot(self, connections, queues=None):
+        """
+        :param connections: The connections dict of the engine
+        :param queues: Optional list of queue names or patterns to give the counters of, all queues by default
+        :return: dict of the statistics
+        """
+        outboxes = dict()
+        queued = 0
+        dropped = 0
+        for conn_id, d in list(connections.items()):
+            handler = d['handler']
+            queued += handler.queued
+            dropped += handler.dropped
+            if handler.queued or handler.dropped:
+                outboxes[conn_id] = dict(queued=handler.queued, dropped=handler.dropped)
+
+        with self.lock:
+            totals = [sum(counters[i] for counters in self.queues.values()) for i in range(4)]
+            if queues is None:
+                selected = self.queues
+            else:
+                selected = dict((q, c) for q, c in self.queues.items() if any(queue_matches(p, q) for p in queues))
+
+            stats = dict(node=node_id(), uptime=time.time() - self.started, connections=len(connections),
+                         frames=self.frames, messages_in=totals[0], bytes_in=totals[1], messages_out=totals[2],
+                         bytes_out=totals[3], queued=queued, dropped=self.dropped + dropped,
+                         fanout=self.fanout.summary(), handler_latency_us=self.handler_latency.summary(),
+                         broadcast_latency_us=self.broadcast_latency.summary(),
+                         queues=dict((q, dict(messages_in=c[0], bytes_in=c[1], messages_out=c[2], bytes_out=c[3]))
+                                     for q, c in selected.items()),
+                         outboxes=outboxes)
+
+        if ThreadedTCPServer.BUS is not None:
+            stats['worker'] = ThreadedTCPServer.BUS.index
+
+        return stats
+
+
+class StatsPublisher(MessageQueueHandler):
+    """
+    Publishes snapshots of the broker's Metrics on STATS_QUEUE, routed like any other message so they are numbered,
+    kept as history, and relayed to other workers and federated brokers
+    """
+
+    def __init__(self, metrics, handler_class):
+        self.metrics = metrics
+        self.connections = handler_class.connections
+        self.routes = handler_class.routes
+        self.options = dict(ack='none')
+        self.published = 0
+        self.acked = 0
+        self.ack_deadline = None
+        self.protocol = 2
+        self.backlogs = []
+        self.conn_id = str(uuid.uuid4())
+
+    def run(self, dispatch=None):
+        while True:
+            time.sleep(self.metrics.interval)
+            if dispatch is None:
+                self.publish_stats()
+                continue
+
+            try:
+                dispatch(self.publish_stats)
+            except RuntimeError:
+                # the event loop was closed
+                return
+
+    def publish_stats(self):
+        try:
+            sent = time.time()
+            message = self.metrics.snapshot(self.connections)
+            message['coremq_sender'] = self.conn_id
+            message['coremq_sent'] = sent
+            envelope = Envelope(STATS_QUEUE, encode_message(message), JSONCodec.id, self.conn_id, sent, stamped=True)
+            self.route(self.conn_id, [envelope])
+        except Exception as ex:
+            print('Stats', ex)
+            traceback.print_exc()
@@ -0,0 +1,218 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import collections
+import socket
+import threading
+import time
+import traceback
+import zlib
+
+from pubsub.client import MessageQueue
+from pubsub.common import ConnectionClosed, ProtocolError, validate_queue
+
+POOL_CONNECTIONS = 2
+BATCH_SIZE = 500  # messages sent in one frame at most
+MAX_QUEUED = 100000  # messages waiting for a sender before publishers wait for it
+RETRY_INTERVAL = 1
+
+
+class Flush(object):
+    """
+    Marks a point in the messages of a sender: once the messages before it are sent, the sender waits for the
+    broker to acknowledge them
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.done = threading.Event()
+        self.acknowledged = False
+
+
+class Sender(object):
+    """
+    One connection of a PublisherPool and the thread writing to it. Messages are appended to a deque by any thread
+    and the sender takes them out in batches, so publishers never wait for each other or for the socket.
+    """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.client = MessageQueue(pool.server, pool.port, pool.protocol, pool.codec)
+        self.client.options = dict(ack='none')
+        if pool.compression is not None:
+            self.client.options['compression'] = pool.compression
+        self.messages = collections.deque()
+        self.wakeup = threading.Event()
+        self.drained = threading.Event()
+        self.waiting = False
+        self.thread = threading.Thread(target=self.run, name='coremq-sender-%s' % index, daemon=True)
+
+    def put(self, item):
+        self.messages.append(item)
+        if self.waiting:
+            self.wakeup.set()
+
+        if len(self.messages) > MAX_QUEUED:
+            self.drained.clear()
+            while len(self.messages) > MAX_QUEUED and self.thread.is_alive():
+                self.drained.wait(0.1)
+
+    def run(self):
+        batch = []
+        while True:
+            while self.messages and len(batch) < BATCH_SIZE:
+                item = self.messages.popleft()
+                if isinstance(item, Flush):
+                    self.send(batch)
+                    batch = []
+                    self.flush(item)
+                else:
+                    batch.append(item)
+
+            if batch:
+                self.send(batch)
+                batch = []
+                self.drained.set()
+                continue
+
+            if self.pool.closed:
+                break
+
+            self.waiting = True
+            self.wakeup.clear()
+            # a message appended before waiting was set did not wake the sender up
+            if not self.messages and not self.pool.closed:
+                self.wakeup.wait()
+            self.waiting = False
+
+        self.client.close()
+
+    def send(self, batch):
+        while batch:
+            try:
+                if len(batch) == 1:
+                    self.client.send_message(*batch[0])
+                else:
+                    self.client.publish_batch(batch)
+                return
+            except (socket.error, ConnectionClosed, ProtocolError) as ex:
+                print('Publisher for %s:%s: %s' % (self.pool.server, self.pool.port, ex))
+                self.client.close()
+                if self.pool.closed:
+                    return
+                time.sleep(RETRY_INTERVAL)
+            except (ValueError, TypeError) as ex:
+                if len(batch) > 1:
+                    # only the messages that cannot be encoded are dropped
+                    for item in batch:
+                        self.send([item])
+                    return
+
+                print('Publisher for %s:%s: %s' % (self.pool.server, self.pool.port, ex))
+                traceback.print_exc()
+                return
+
+    def flush(self, flush):
+        try:
+            flush.acknowledged = self.client.published == 0 or self.client.wait_for_ack(timeout=flush.timeout)
+        except (socket.error, ConnectionClosed, ProtocolError):
+            flush.acknowledged = False
+        flush.done.set()
+
+
+class PublisherPool(object):
+    """
+    Publisher that any number of threads can share, sending over a fixed number of connections to the broker.
+
+    Each queue is sent through the same connection, picked by a hash of its name, so the messages of one queue keep
+    the order they were published in, as seen by each thread. Every connection has a sender thread that writes what
+    was published since its last write in a single batch frame, which is where the throughput comes from: the more
+    threads publish, the larger the batches.
+
+    publish returns as soon as the message is queued. The broker does not acknowledge each message, flush waits
+    until everything published so far has been accepted. Messages that cannot be encoded are printed and dropped by
+    the sender.
+
+    compression names the compressor of the messages of 1024 bytes or more, see MessageQueue.
+    """
+
+    def __init__(self, server='127.0.0.1', port=6747, connections=POOL_CONNECTIONS, protocol=2, codec=None,
+                 compression=None):
+        self.server = server
+        self.port = port
+        self.protocol = protocol
+        self.codec = codec
+        self.compression = compression
+        self.closed = False
+        self.senders = [Sender(self, i) for i in range(connections)]
+        for sender in self.senders:
+            sender.thread.start()
+
+    def sender(self, queue):
+        if len(self.senders) == 1:
+            return self.senders[0]
+
+        return self.senders[zlib.crc32(queue.encode('utf-8')) % len(self.senders)]
+
+    def publish(self, queue, message):
+        validate_queue(queue)
+        if self.closed:
+            raise ValueError('The publisher is closed')
+
+        self.sender(queue).put((queue, message))
+
+    send_message = publish
+
+    def flush(self, timeout=10):
+        """
+        Waits until the broker has accepted every message published before the call
+        :param timeout: Seconds to wait
+        :return: bool - False if the broker did not confirm the messages in time or a reconnect may have lost some
+        """
+        deadline = time.time() + timeout
+        flushes = []
+        for sender in self.senders:
+            flush = Flush(timeout)
+            sender.put(flush)
+            flushes.append(flush)
+
+        for flush in flushes:
+            if not flush.done.wait(max(0, deadline - time.time())):
+                return False
+
+        return all(flush.acknowledged for flush in flushes)
+
+    def close(self, timeout=10):
+        """
+        Sends what is still queued and closes the connections
+        :param timeout: Seconds to wait for the senders
+        """
+        self.closed = True
+        deadline = time.time() + timeout
+        for sender in self.senders:
+            sender.wakeup.set()
+
+        for sender in self.senders:
+            sender.thread.join(max(0, deadline - time.time()))
@@ -23,143 +23,1417 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import argparse
+import base64
 import collections
+import itertools
+import json
+import os
 import signal
 import socket
+import stat
+import struct
 import sys
+import threading
 import time
 import traceback
 import uuid
 from multiprocessing import Process
-from socketserver import BaseRequestHandler, ThreadingMixIn, TCPServer
+from socketserver import BaseRequestHandler, ThreadingMixIn, TCPServer, UnixStreamServer
 
-from pubsub.common import ConnectionClosed, get_message, send_message
+from pubsub.common import CHUNK_ABORT, CHUNK_LAST, CHUNK_V2, CODEC_MASK, CODECS, COMPRESSION_MASK, \
+    COMPRESSION_THRESHOLD, ENCODING_MASK, FLAG_RAW, FLAG_STAMPED, FLAG_TRACE, FRAME_BATCH, FRAME_CHUNK, FRAME_CONTROL, \
+    FRAME_FORWARD, FRAME_MESSAGE, PROTOCOLS, STATS_QUEUE, TRACE_V2, ConnectionClosed, FrameReader, JSONCodec, \
+    ProtocolError, compress_payload, construct_frame, construct_frame_v2, construct_message, decode_frame, \
+    decompress_payload, encode_message, frame_header, frame_header_v2, get_compressor, is_pattern, iter_frames_v2, \
+    split_trace, str_type, unix_path, validate_queue
+from pubsub.store import FSYNC_INTERVAL, FSYNC_POLICIES, SEGMENT_BYTES, LogStore
 
 ADDRESS = '127.0.0.1'
 PORT = 6747  # spells MSGQ (message queue)
+ENGINES = ('threaded', 'asyncio')
+MAX_QUEUED = 10000
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest', 'disconnect')
+ACK_MODES = ('none', 'all', 'cumulative')
+ACK_EVERY = 100
+ACK_INTERVAL = 50  # milliseconds
+IOV_MAX = 1024  # buffers per sendmsg call
+HISTORY_SIZE = 10
+BACKLOG_SIZE = 1000  # messages kept per queue for resuming subscribers, unless a LogStore keeps them
+PAGE_SIZE = 100  # messages read at a time when sending a backlog
+ROUTE_CACHE_SIZE = 100000  # queues whose subscribers through patterns are remembered
 
 
 class ThreadedTCPServer(ThreadingMixIn, TCPServer):
     EXITING = False
     PROCESS = None
     HISTORY = dict()
+    SEQUENCES = dict()
+    LOCKS = dict()
+    STORE = None
+    BUS = None
+    WORKERS = []
+    NODE = None
+    FEDERATION = None
+    METRICS = None
 
 
 ThreadedTCPServer.allow_reuse_address = True
 
 
-class TCPRequestHandler(BaseRequestHandler):
-    connections = dict()
+class ThreadedUnixServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Listens on a Unix domain socket for clients on the same host. The state of the broker stays on ThreadedTCPServer.
+    """
 
-    def handle(self):
-        conn_id = str(uuid.uuid4())
-        TCPRequestHandler.connections[conn_id] = dict(handler=self, subscriptions=[conn_id], options=dict())
-        self.respond(conn_id, 'Welcome!')
 
-        print('Clients connected: %s' % len(TCPRequestHandler.connections))
+def remove_socket(path):
+    """
+    Removes the socket file left behind by a broker that did not stop cleanly
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class TopicNode(object):
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = dict()
+        self.subscribers = frozenset()
+
+
+class RoutingTable(object):
+    """
+    Maps each queue name to the set of connection ids subscribed to it. Every queue's subscriber set is a frozenset
+    that is replaced, never mutated, so a broadcast can iterate the set it looked up while other threads subscribe
+    and unsubscribe.
+
+    Patterns are kept in a trie with one level per dot-separated word. The subscribers of a queue, exact and through
+    patterns, are resolved once and cached until any subscription changes, so publishing does not get slower with
+    the number of patterns. A generation counter keeps a lookup racing with a change from caching a stale set.
+    """
+
+    def __init__(self):
+        self.routes = dict()
+        self.lock = threading.Lock()
+        self.patterns = TopicNode()
+        self.pattern_count = 0
+        self.cache = dict()
+        self.generation = 0
+
+    def get(self, queue, patterns=True):
+        if not self.pattern_count or not patterns:
+            return self.routes.get(queue, ())
+
+        subscribers = self.cache.get(queue)
+        if subscribers is None:
+            generation = self.generation
+            matches = set(self.routes.get(queue, ()))
+            self.match(self.patterns, queue.split('.'), 0, matches)
+            subscribers = frozenset(matches)
+
+            with self.lock:
+                if generation == self.generation:
+                    if len(self.cache) >= ROUTE_CACHE_SIZE:
+                        self.cache.clear()
+                    self.cache[queue] = subscribers
+
+        return subscribers
+
+    def match(self, node, levels, i, matches):
+        hash_node = node.children.get('#')
+        if hash_node is not None:
+            for j in range(i, len(levels) + 1):
+                self.match(hash_node, levels, j, matches)
+
+        if i == len(levels):
+            matches.update(node.subscribers)
+            return
+
+        for key in (levels[i], '*'):
+            child = node.children.get(key)
+            if child is not None:
+                self.match(child, levels, i + 1, matches)
+
+    def add(self, conn_id, queues):
+        with self.lock:
+            for q in queues:
+                if is_pattern(q):
+                    node = self.patterns
+                    for level in q.split('.'):
+                        node = node.children.setdefault(level, TopicNode())
+
+                    if not node.subscribers:
+                        self.pattern_count += 1
+                    node.subscribers = node.subscribers | {conn_id}
+                    self.invalidate()
+                else:
+                    self.routes[q] = self.routes.get(q, frozenset()) | {conn_id}
+                    self.invalidate(q)
+
+    def remove(self, conn_id, queues):
+        with self.lock:
+            for q in queues:
+                if is_pattern(q):
+                    self.remove_pattern(conn_id, self.patterns, q.split('.'), 0)
+                    self.invalidate()
+                    continue
+
+                subscribers = self.routes.get(q)
+                if subscribers is None or conn_id not in subscribers:
+                    continue
+
+                subscribers = subscribers - {conn_id}
+                if subscribers:
+                    self.routes[q] = subscribers
+                else:
+                    del self.routes[q]
+                self.invalidate(q)
+
+    def remove_pattern(self, conn_id, node, levels, i):
+        """
+        :return: bool - True if the node is left empty and can be pruned
+        """
+        if i == len(levels):
+            if conn_id in node.subscribers:
+                node.subscribers = node.subscribers - {conn_id}
+                if not node.subscribers:
+                    self.pattern_count -= 1
+        else:
+            child = node.children.get(levels[i])
+            if child is not None and self.remove_pattern(conn_id, child, levels, i + 1):
+                del node.children[levels[i]]
+
+        return not node.subscribers and not node.children
+
+    def invalidate(self, queue=None):
+        # called with the lock held
+        self.generation += 1
+        if queue is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(queue, None)
+
+
+class Envelope(object):
+    """
+    A published message. Its frame is built at most once per protocol, however many subscribers receive it.
+    Payloads published with protocol 2 are kept exactly as received, in the codec of the publisher, and sender and
+    time only go into the frame header. They are decoded only to build protocol 1 frames, which must be JSON with
+    coremq_sender and coremq_sent inside; stamped tells whether the payload already has them.
+
+    seq is the sequence number of the message in its queue, given when it is stored. Protocol 1 frames carry it as
+    coremq_seq, spliced in front of the payload rather than encoded into it.
+
+    origin is None for messages published on this broker. Messages relayed by other brokers have (path, seq): the
+    ids of the brokers they went through, starting with the one they were published on, and their sequence number
+    there.
+
+    published is the time a traced message was published, None for the others. Protocol 2 frames of traced
+    messages carry it after the payload along with the time the frame was built, when the broker dispatched the
+    message, see pubsub.tracing.
+
+    compression is the flag of the compressor of the payload, 0 if it is not compressed. The codec passed in holds
+    both, as in the flags of a frame. A compressed payload goes as it is to the connections that accept its
+    compression and is decompressed once for the others, and a payload is compressed at most once per compressor,
+    see frame.
+    """
+    __slots__ = ('queue', 'payload', 'codec', 'compression', 'sender', 'sent', 'stamped', 'seq', 'origin',
+                 'published', 'v1', 'v2', 'forwarded', 'plain', 'variants')
+
+    def __init__(self, queue, payload, codec, sender, sent, stamped=False, seq=None, origin=None, published=None):
+        self.queue = queue
+        self.payload = payload
+        self.codec = codec & CODEC_MASK
+        self.compression = codec & COMPRESSION_MASK
+        self.sender = sender
+        self.sent = sent
+        self.stamped = stamped
+        self.seq = seq
+        self.origin = origin
+        self.published = published
+        self.v1 = None
+        self.v2 = None
+        self.forwarded = None
+        self.plain = None
+        # compression flag -> protocol 2 frame, for connections that get the payload compressed otherwise
+        self.variants = None
+
+    def plain_payload(self):
+        """
+        :return: The payload, decompressed if it was published compressed
+        """
+        if not self.compression:
+            return self.payload
+
+        if self.plain is None:
+            self.plain = decompress_payload(self.payload, self.compression)
+
+        return self.plain
+
+    def json_payload(self):
+        payload = self.plain_payload()
+        if self.codec == JSONCodec.id:
+            if self.stamped:
+                return payload
+
+            # payloads replayed from a LogStore are memoryviews
+            message = json.loads(bytes(payload))
+            if not isinstance(message, dict):
+                message = dict(coremq_value=message)
+
+            message['coremq_sender'] = self.sender
+            message['coremq_sent'] = self.sent
+            return encode_message(message)
+
+        # protocol 1 only carries JSON
+        codec = CODECS.get(self.codec)
+        return encode_message(dict(coremq_bytes=base64.b64encode(payload).decode('ascii'),
+                                   coremq_codec=codec.name if codec else self.codec,
+                                   coremq_sender=self.sender, coremq_sent=self.sent))
+
+    def frame_v2(self, payload, compression):
+        flags = self.codec | compression
+        if self.stamped:
+            flags |= FLAG_STAMPED
+
+        if self.published is None:
+            return (frame_header_v2(self.queue, len(payload), FRAME_MESSAGE, flags,
+                                    (self.sender, self.sent, self.seq)), payload)
+
+        trace = TRACE_V2.pack(self.published, time.time())
+        return (frame_header_v2(self.queue, len(payload) + len(trace), FRAME_MESSAGE, flags | FLAG_TRACE,
+                                (self.sender, self.sent, self.seq)), payload, trace)
+
+    def frame(self, protocol, compression=None, threshold=COMPRESSION_THRESHOLD):
+        """
+        The frame as a tuple of buffers, so the payload is written from the buffer it was received in
+        :param compression: For protocol 2, the flag of the compressor the connection accepts, 0 for none, or None
+        to send the payload as it was published, for other workers and brokers
+        :param threshold: Smallest payload compressed for the connection, in bytes
+        """
+        if protocol == 1:
+            if self.v1 is None:
+                payload = self.json_payload()
+                if self.seq is None:
+                    self.v1 = (frame_header(self.queue, len(payload)), payload)
+                else:
+                    # the payload is a JSON object with coremq_sender in it, so never empty
+                    seq = b'{"coremq_seq": %d, ' % self.seq
+                    payload = memoryview(payload)[1:]
+                    self.v1 = (frame_header(self.queue, len(seq) + len(payload)), seq, payload)
+            return self.v1
+
+        if compression is None or compression == self.compression or \
+                not self.compression and (not compression or len(self.payload) < threshold):
+            if self.v2 is None:
+                self.v2 = self.frame_v2(self.payload, self.compression)
+            return self.v2
+
+        if self.compression:
+            # connections that do not accept the compression of the payload get it decompressed
+            compression = 0
+
+        if self.variants is None:
+            self.variants = dict()
+
+        frame = self.variants.get(compression)
+        if frame is None:
+            if compression:
+                frame = self.frame_v2(*compress_payload(self.payload, get_compressor(compression), threshold))
+            else:
+                frame = self.frame_v2(self.plain_payload(), 0)
+            self.variants[compression] = frame
+
+        return frame
+
+    def forward_frame(self):
+        """
+        The frame relaying the message to another broker: a FRAME_FORWARD frame whose metadata has the sequence
+        number of the message on its first broker, and whose payload is the number of brokers in the path, their
+        ids as 16 bytes each, then the payload of the message
+        """
+        if self.forwarded is None:
+            path, seq = self.origin or ((node_id(),), self.seq)
+            prefix = struct.pack('!B', len(path)) + b''.join(uuid.UUID(node).bytes for node in path)
+            flags = self.codec | self.compression
+            if self.stamped:
+                flags |= FLAG_STAMPED
+            trace = b''
+            if self.published is not None:
+                trace = TRACE_V2.pack(self.published, 0)
+                flags |= FLAG_TRACE
+            self.forwarded = (frame_header_v2(self.queue, len(prefix) + len(self.payload) + len(trace), FRAME_FORWARD,
+                                              flags, (self.sender, self.sent, seq)), prefix, self.payload, trace)
+        return self.forwarded
+
+
+class Backlog(object):
+    """
+    A subscriber catching up on a queue, from sequence number seq. target is the connection it is for when the
+    backlog is sent through a worker link.
+    """
+    __slots__ = ('queue', 'seq', 'missed', 'target')
+
+    def __init__(self, queue, seq, target=None):
+        self.queue = queue
+        self.seq = seq
+        self.missed = 0
+        self.target = target
+
+
+class Stream(object):
+    """
+    A message being published in chunks, see stream_chunk. targets holds [conn_id, handler, dropped] for every
+    connection its chunks go to, dropped being the count of frames the connection had dropped when it last got one.
+    """
+    __slots__ = ('queue', 'sender', 'sent', 'codec', 'number', 'targets')
+
+    def __init__(self, queue, sender, sent, codec, number):
+        self.queue = queue
+        self.sender = sender
+        self.sent = sent
+        self.codec = codec
+        self.number = number
+        self.targets = []
+
+    def frame(self, payload):
+        return frame_header_v2(self.queue, len(payload), FRAME_CHUNK, self.codec, (self.sender, self.sent, None)), \
+            payload
+
+    def abort_frame(self):
+        return self.frame(CHUNK_V2.pack(self.number, 0, CHUNK_ABORT))
+
+
+def node_id():
+    """
+    :return: str - the id of this broker among federated brokers, new every time it starts
+    """
+    if ThreadedTCPServer.NODE is None:
+        ThreadedTCPServer.NODE = str(uuid.uuid4())
+
+    return ThreadedTCPServer.NODE
+
+
+def queue_lock(queue):
+    """
+    The lock held from numbering a message of the queue to delivering it, so a subscriber can switch from the
+    backlog to live messages without missing or repeating any
+    """
+    lock = ThreadedTCPServer.LOCKS.get(queue)
+    if lock is None:
+        lock = ThreadedTCPServer.LOCKS.setdefault(queue, threading.RLock())
+
+    return lock
+
+
+def frame_buffers(frames):
+    """
+    Flattens frames, each either bytes or a tuple of buffers, into the list of non-empty buffers to write
+    """
+    buffers = []
+    for frame in frames:
+        if isinstance(frame, tuple):
+            buffers.extend(b for b in frame if len(b))
+        elif len(frame):
+            buffers.append(frame)
+
+    return buffers
+
+
+def frame_size(frame):
+    """
+    :return: int - the bytes of a frame, either bytes or a tuple of buffers
+    """
+    if isinstance(frame, tuple):
+        return sum(len(b) for b in frame)
+
+    return len(frame)
+
+
+def is_chunk(frame):
+    """
+    :return: bool - True for the chunks of streams, framed by Stream.frame
+    """
+    return isinstance(frame, tuple) and frame[0][0] == FRAME_CHUNK
+
+
+def evict_oldest(frames, held, credit):
+    """
+    Discards the oldest queued message frame for drop-oldest, returning the credit it took. Control frames are never
+    evicted, nor the chunks of streams: one could be evicted after the last chunk of its stream was sent, when nothing
+    is left to abort the stream (see send_chunk).
+    :param frames: deque of (frame, evictable, message) waiting to be written, message frames having taken credit
+    :param held: deque of the same, waiting for credit
+    :return: bool - False if there was no message frame to evict
+    """
+    for queue in (frames, held):
+        for i, (frame, evictable, message) in enumerate(queue):
+            if evictable:
+                del queue[i]
+                if message and queue is frames:
+                    credit.release(frame)
+                return True
+
+    return False
+
+
+class Credit(object):
+    """
+    What a client lets the broker send it with coremq_credit: a number of messages, bytes of message frames, or
+    both, None standing for no limit. Connections start without limits. A grant adds to the credit left, or with
+    reset replaces it, and a grant of None removes the limits again. A message is sent as long as some credit is
+    left, so the last one may exceed the bytes granted.
+    """
+    __slots__ = ('messages', 'bytes')
+
+    def __init__(self):
+        self.messages = None
+        self.bytes = None
+
+    def grant(self, credit):
+        """
+        :param credit: dict with messages and/or bytes, and optionally reset, or None
+        """
+        if credit is None:
+            self.messages = self.bytes = None
+            return
+
+        reset = credit.get('reset', False)
+        for key in ('messages', 'bytes'):
+            value = credit.get(key)
+            if value is None:
+                if reset:
+                    setattr(self, key, None)
+                continue
+
+            if not isinstance(value, int) or value < 0:
+                raise ValueError('Credit must be a number of messages or bytes')
+
+            left = getattr(self, key)
+            setattr(self, key, value if reset or left is None else left + value)
+
+    def available(self):
+        return (self.messages is None or self.messages > 0) and (self.bytes is None or self.bytes > 0)
+
+    def take(self, frame):
+        if self.messages is not None:
+            self.messages -= 1
+        if self.bytes is not None:
+            self.bytes -= frame_size(frame)
+
+    def release(self, frame):
+        """
+        Gives back what take took for a frame that was discarded rather than sent
+        """
+        if self.messages is not None:
+            self.messages += 1
+        if self.bytes is not None:
+            self.bytes += frame_size(frame)
+
+
+class Outbox(object):
+    """
+    Bounded queue of frames waiting to be written to one client, drained by its own writer thread so a slow client
+    never blocks the connection that published the message. The options dict of the connection selects the limit
+    (max_queued) and what happens when it is reached (overflow):
+    block: the publisher waits for room
+    drop-oldest: the oldest queued message frame is discarded, or the new frame if only control frames and chunks
+    of streams are queued
+    drop-newest: the new frame is discarded
+    disconnect: the client is disconnected
+    Control responses are never dropped.
+
+    Every frame queued while the writer was busy goes out in one vectored write. The flush_delay option (milliseconds)
+    makes the writer wait that long before each write so more frames can join it, much like TCP_CORK.
+
+    Message frames beyond the Credit granted by the client are held, in order, until it grants more, and count
+    against max_queued like the others. Control frames are not held back, so responses can overtake them.
+    """
+
+    def __init__(self, socket, options):
+        self.socket = socket
+        self.options = options
+        self.frames = collections.deque()
+        self.credit = Credit()
+        self.held = collections.deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def queued(self):
+        return len(self.frames) + len(self.held)
+
+    def put(self, frame, control=False, message=False):
+        """
+        :param control: True for frames that are never dropped and never wait for room
+        :param message: True for frames that need credit, if the client granted any
+        """
+        with self.condition:
+            if self.closed:
+                return
+
+            if not control and self.queued() >= self.options.get('max_queued', MAX_QUEUED):
+                overflow = self.options.get('overflow', 'block')
+                if overflow == 'block':
+                    while self.queued() >= self.options.get('max_queued', MAX_QUEUED) and not self.closed:
+                        self.condition.wait()
+
+                    if self.closed:
+                        return
+                elif overflow == 'drop-oldest':
+                    self.dropped += 1
+                    if not evict_oldest(self.frames, self.held, self.credit):
+                        return
+                    self.send_held()
+                elif overflow == 'drop-newest':
+                    self.dropped += 1
+                    return
+                else:
+                    self.dropped += 1
+                    self.closed = True
+                    self.condition.notify_all()
+                    try:
+                        self.socket.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+                    return
+
+            entry = (frame, not control and not is_chunk(frame), message)
+            if message:
+                if self.held or not self.credit.available():
+                    self.held.append(entry)
+                    return
+
+                self.credit.take(frame)
+
+            self.frames.append(entry)
+            self.condition.notify_all()
+
+    def grant(self, credit):
+        """
+        Adds credit granted by the client and queues the held frames it covers
+        """
+        with self.condition:
+            self.credit.grant(credit)
+            self.send_held()
+            self.condition.notify_all()
+
+    def send_held(self):
+        while self.held and self.credit.available():
+            entry = self.held.popleft()
+            self.credit.take(entry[0])
+            self.frames.append(entry)
+
+    def close(self, timeout=1):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.thread.join(timeout)
+
+    def wait_for_room(self):
+        """
+        Blocks while max_queued frames are waiting
+        :return: bool - False if the outbox was closed, or holds frames until the client grants more credit
+        """
+        with self.condition:
+            while self.queued() >= self.options.get('max_queued', MAX_QUEUED) and not self.closed and not self.held:
+                self.condition.wait()
+
+            return not self.closed and not self.held
+
+    def run(self):
         while True:
+            with self.condition:
+                while not self.frames and not self.closed:
+                    self.condition.wait()
+
+                delay = self.options.get('flush_delay', 0)
+                if delay:
+                    deadline = time.time() + delay / 1000.0
+                    while not self.closed and len(self.frames) < self.options.get('max_queued', MAX_QUEUED):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+
+                if not self.frames:
+                    return
+
+                buffers = frame_buffers(frame for frame, evictable, message in self.frames)
+                self.frames.clear()
+                self.condition.notify_all()
+
             try:
-                queue, message = get_message(self.request)
-                message['coremq_sender'] = conn_id
-                message['coremq_sent'] = time.time()
-
-                if 'coremq_subscribe' in message:
-                    self.subscribe(conn_id, message['coremq_subscribe'])
-                    self.respond(conn_id, 'OK: Subscribe successful')
-                elif 'coremq_unsubscribe' in message:
-                    self.unsubscribe(conn_id, message['coremq_unsubscribe'])
-                    self.respond(conn_id, 'OK: Unsubscribe successful')
-                elif 'coremq_options' in message:
-                    self.set_options(conn_id, message['coremq_options'])
-                    self.respond(conn_id, 'OK: Options set')
-                elif 'coremq_gethistory' in message:
-                    self.get_history(conn_id, message['coremq_gethistory'])
-                else:
-                    self.respond(conn_id, 'OK: Message sent')
-                    self.broadcast(queue, message)
-                    self.store_message(queue, message)
+                self.send(buffers)
+            except socket.error:
+                with self.condition:
+                    self.closed = True
+                    self.frames.clear()
+                    self.condition.notify_all()
+                return
+
+    def send(self, buffers):
+        if hasattr(self.socket, 'sendmsg'):
+            views = [memoryview(b) for b in buffers]
+        else:
+            views = [memoryview(b''.join(buffers))]
 
+        i = 0
+        while i < len(views):
+            try:
+                if len(views) > 1:
+                    sent = self.socket.sendmsg(views[i:i + IOV_MAX])
+                else:
+                    sent = self.socket.send(views[i])
             except socket.timeout:
-                pass
-            except (ConnectionClosed, socket.error):
-                break
-            except Exception as ex:
-                self.respond(conn_id, str(ex))
-                print(conn_id, ex)
-                traceback.print_exc()
+                # the socket timeout is there for the reader, keep waiting for a slow client unless closing
+                if self.closed:
+                    raise
+                continue
 
+            # skip what was written, a partial write can end anywhere in a buffer
+            while sent:
+                size = views[i].nbytes
+                if sent < size:
+                    views[i] = views[i][sent:]
+                    break
+                sent -= size
+                i += 1
+
+
+class MessageQueueHandler(object):
+    """
+    Broker logic shared by every engine. Subclasses own the transport and must provide send_frame(frame, publisher,
+    message) to queue encoded bytes for their client, plus their own connections dict and routing table. publisher is
+    the handler that published the frame, or None for control responses and backlogs, which are never dropped.
+    message is True for the frames of messages, which wait for the client to grant credit once it has granted some
+    (see Credit), and engines implement grant(credit) to add it. Engines pass every frame from their FrameReader,
+    kept as self.reader, to handle_frame.
+
+    Connections start on protocol 1. The welcome message lists the supported protocols and a client switches by
+    sending coremq_protocol, which is answered in the old protocol before both directions change. Protocol 2 clients
+    may also publish a message in chunks, which are passed on as they arrive, see stream_chunk.
+
+    Publishes are acknowledged according to the ack option of the connection:
+    all: every message is acknowledged (the default)
+    cumulative: one acknowledgement covers every message up to ack_every messages or ack_interval milliseconds
+    none: nothing is acknowledged unless the client sends coremq_sync
+    Acknowledgements carry coremq_ack, the number of messages published on the connection so far. Engines call
+    ack_due(conn_id, deadline) once the ack_deadline set by acknowledge has passed, and may implement
+    schedule_ack(conn_id, delay) to be reminded.
+    """
+    connections = dict()
+    routes = RoutingTable()
+    # connections to other workers or federated brokers get messages through forward
+    peer = False
+    node = None
+    # the coremq_id of the control message being handled, echoed in the responses to it
+    request_id = None
+    # frames waiting to be written to the client, and those dropped because it was too slow
+    queued = 0
+    dropped = 0
+    # the flag of the compressor the client accepts, 0 for none, and the smallest payload compressed for it
+    compression = 0
+    compression_threshold = COMPRESSION_THRESHOLD
+
+    def send_frame(self, frame, publisher=None, message=False):
+        raise NotImplementedError()
+
+    def grant(self, credit):
+        raise ValueError('This connection does not take credit')
+
+    def send_message(self, queue, message):
+        self.send_frame(construct_message(queue, message, self.protocol, FRAME_CONTROL))
+
+    def schedule_ack(self, conn_id, delay):
+        pass
+
+    def writable(self):
+        """
+        Engines return False while the client has more queued than it can take, and call send_backlogs once it can
+        take more. They may block instead.
+        """
+        return True
+
+    def open_connection(self):
+        self.published = 0
+        self.acked = 0
+        self.ack_deadline = None
+        self.protocol = 1
+        self.backlogs = []
+        # stream number -> Stream being published on the connection
+        self.streams = dict()
+
+        conn_id = str(uuid.uuid4())
+        self.connections[conn_id] = dict(handler=self, subscriptions=[conn_id], options=self.options)
+        self.routes.add(conn_id, [conn_id])
+        self.announce([conn_id], 1, connection=True)
+        self.send_message(conn_id, dict(response='Welcome!', protocols=list(PROTOCOLS)))
+
+        print('Clients connected: %s' % len(self.connections))
+        return conn_id
+
+    def close_connection(self, conn_id):
+        self.request_id = None
         try:
             self.respond(conn_id, 'BYE')
         except socket.error:
             pass
 
-        if conn_id in TCPRequestHandler.connections:
-            del TCPRequestHandler.connections[conn_id]
+        self.abort_streams()
+        if conn_id in self.connections:
+            self.routes.remove(conn_id, self.connections[conn_id]['subscriptions'])
+            self.announce(self.connections[conn_id]['subscriptions'], -1)
+            del self.connections[conn_id]
+
+        if ThreadedTCPServer.METRICS is not None:
+            ThreadedTCPServer.METRICS.closed(self.dropped)
+
+        print('Clients connected: %s' % len(self.connections))
 
-        print('Clients connected: %s' % len(TCPRequestHandler.connections))
+    def announce(self, queues, change, connection=False):
+        """
+        Tells the other workers, if any, that this worker's clients subscribed to (change 1) or unsubscribed from
+        (change -1) queues
+        :param connection: True for the queue of a new connection
+        """
+        if ThreadedTCPServer.BUS is not None and queues:
+            ThreadedTCPServer.BUS.interest(queues, change, connection)
 
-    def respond(self, conn_id, text):
-        send_message(self.request, conn_id, dict(response=text))
+        # connections only exist on their own broker
+        if ThreadedTCPServer.FEDERATION is not None and queues and not connection:
+            ThreadedTCPServer.FEDERATION.interest(queues, change, self.node)
+
+    def handle_frame(self, conn_id, queue, payload, kind, flags, metadata):
+        self.request_id = None
+        metrics = ThreadedTCPServer.METRICS
+        started = time.perf_counter() if metrics is not None else 0
+        if kind == FRAME_BATCH:
+            self.publish_frames(conn_id, list(iter_frames_v2(payload)))
+        elif kind == FRAME_MESSAGE:
+            self.publish_frames(conn_id, [(queue, payload, kind, flags, metadata)])
+        elif kind == FRAME_CHUNK:
+            self.stream_chunk(conn_id, queue, payload, flags)
+        else:
+            self.handle_message(conn_id, *decode_frame(queue, payload, kind, flags))
+
+        if metrics is not None:
+            metrics.handled(time.perf_counter() - started)
+
+    def handle_message(self, conn_id, queue, message):
+        self.request_id = message.pop('coremq_id', None)
+        message['coremq_sender'] = conn_id
+        message['coremq_sent'] = time.time()
+
+        if 'coremq_subscribe' in message:
+            queues = message['coremq_subscribe']
+            if not isinstance(queues, (list, tuple)):
+                queues = [queues]
+
+            cursors = message.get('coremq_from') or dict()
+            next_seqs = self.subscribe(conn_id, [q for q in queues if q not in cursors])
+            self.respond(conn_id, 'OK: Subscribe successful', coremq_next=next_seqs)
+            if cursors:
+                self.resume(conn_id, cursors)
+        elif 'coremq_unsubscribe' in message:
+            self.unsubscribe(conn_id, message['coremq_unsubscribe'])
+            self.respond(conn_id, 'OK: Unsubscribe successful')
+        elif 'coremq_options' in message:
+            self.set_options(conn_id, message['coremq_options'])
+            self.respond(conn_id, 'OK: Options set')
+        elif 'coremq_gethistory' in message:
+            self.get_history(conn_id, message['coremq_gethistory'])
+        elif 'coremq_stats' in message:
+            self.get_stats(conn_id, message['coremq_stats'])
+        elif 'coremq_sync' in message:
+            self.acknowledge(conn_id, force=True)
+        elif 'coremq_credit' in message:
+            # granted as messages are consumed, so never answered
+            self.grant(message['coremq_credit'])
+            if self.backlogs:
+                self.send_backlogs(conn_id)
+        elif 'coremq_batch' in message:
+            self.publish(conn_id, message['coremq_batch'])
+        elif 'coremq_bridge' in message:
+            self.bridge(conn_id, message['coremq_bridge'])
+        elif 'coremq_protocol' in message:
+            protocol = message['coremq_protocol']
+            if protocol not in PROTOCOLS:
+                raise ValueError('Protocol must be one of: %s' % ', '.join(str(p) for p in PROTOCOLS))
+
+            self.respond(conn_id, 'OK: Protocol %s' % protocol)
+            self.protocol = self.reader.protocol = protocol
+        else:
+            self.publish(conn_id, [(queue, message)])
+
+    def bridge(self, conn_id, node):
+        """
+        Turns the connection into the bridge of another broker, which subscribes through it to what its own
+        subscribers want
+        :param node: The id of the other broker
+        """
+        if self.protocol != 2:
+            raise ValueError('Bridges need protocol 2')
+
+        self.peer = True
+        self.node = str(uuid.UUID(node))
+        self.respond(conn_id, 'OK: Bridged', coremq_node=node_id())
+
+    def forward(self, envelope, publisher):
+        """
+        Relays a message to the broker at the other end of a bridge, unless it went through that broker already
+        """
+        if envelope.origin is None or self.node not in envelope.origin[0]:
+            self.send_frame(envelope.forward_frame(), publisher)
+
+    def forward_chunk(self, frame, publisher):
+        """
+        Relays a chunk of a streamed message to another worker. Federated brokers get no streams.
+        """
+        pass
+
+    def publish(self, conn_id, messages):
+        """
+        Routes and stores published messages as one unit: every message is validated and encoded before any of them
+        is delivered, and they are acknowledged together.
+        :param conn_id: The publishing connection
+        :param messages: list of (queue, message) pairs, messages being dicts, strings or raw bytes
+        """
+        sent = time.time()
+        envelopes = []
+        for queue, message in messages:
+            validate_queue(queue)
+            if queue == STATS_QUEUE:
+                raise ValueError('%s is reserved for the statistics of the broker' % queue)
+
+            if isinstance(message, (bytes, bytearray)):
+                envelopes.append(Envelope(queue, bytes(message), FLAG_RAW, conn_id, sent))
+                continue
+
+            if isinstance(message, str_type):
+                message = dict(coremq_string=message)
+            elif not isinstance(message, dict):
+                raise ValueError('Messages should be either a dictionary or a string')
+
+            message['coremq_sender'] = conn_id
+            message['coremq_sent'] = sent
+            envelopes.append(Envelope(queue, encode_message(message), JSONCodec.id, conn_id, sent, stamped=True))
+
+        self.route(conn_id, envelopes)
+
+    def publish_frames(self, conn_id, frames):
+        """
+        Publishes protocol 2 message frames without decoding their payloads
+        :param conn_id: The publishing connection
+        :param frames: list of (queue, payload, kind, flags, metadata) from FrameReader
+        """
+        sent = time.time()
+        envelopes = []
+        for queue, payload, kind, flags, metadata in frames:
+            validate_queue(queue)
+            if queue == STATS_QUEUE:
+                raise ValueError('%s is reserved for the statistics of the broker' % queue)
+
+            payload, published, _ = split_trace(payload, flags)
+            envelopes.append(Envelope(queue, payload, flags & ENCODING_MASK, conn_id, sent, published=published))
+
+        self.route(conn_id, envelopes)
+
+    def route(self, conn_id, envelopes):
+        by_queue = dict()
+        for envelope in envelopes:
+            by_queue.setdefault(envelope.queue, []).append(envelope)
+
+        bus = ThreadedTCPServer.BUS
+        metrics = ThreadedTCPServer.METRICS
+        for queue, queue_envelopes in by_queue.items():
+            if bus is not None and not bus.owns(queue):
+                # numbered, stored and delivered by the worker that owns the queue
+                bus.forward(queue, queue_envelopes)
+                continue
+
+            with queue_lock(queue):
+                started = time.perf_counter() if metrics is not None else 0
+                self.store_queue(queue, queue_envelopes)
+                for envelope in queue_envelopes:
+                    fanout = self.broadcast(queue, envelope, conn_id)
+
+                if metrics is not None:
+                    # the messages of one queue and publisher all went to the same connections
+                    metrics.published(queue, queue_envelopes, fanout, time.perf_counter() - started)
+
+        self.published += len(envelopes)
+        self.acknowledge(conn_id)
+
+    def acknowledge(self, conn_id, force=False):
+        mode = self.options.get('ack', 'all')
+        if not force:
+            if self.acked == self.published or mode == 'none':
+                return
+
+            if mode == 'cumulative' and self.published - self.acked < self.options.get('ack_every', ACK_EVERY):
+                if self.ack_deadline is None:
+                    delay = self.options.get('ack_interval', ACK_INTERVAL) / 1000.0
+                    self.ack_deadline = time.time() + delay
+                    self.schedule_ack(conn_id, delay)
+
+                if time.time() < self.ack_deadline:
+                    return
+
+        self.acked = self.published
+        self.ack_deadline = None
+        self.send_message(conn_id, dict(response='OK: Message sent', coremq_ack=self.acked))
+
+    def ack_due(self, conn_id, deadline):
+        # a later deadline means this reminder belongs to an ack that was already sent
+        if deadline is not None and deadline == self.ack_deadline:
+            self.acknowledge(conn_id, force=True)
+
+    def respond(self, conn_id, text, **fields):
+        """
+        Answers the control message being handled, passing on its coremq_id so clients can tell which request the
+        response belongs to
+        """
+        fields['response'] = text
+        if self.request_id is not None:
+            fields['coremq_id'] = self.request_id
+        self.send_message(conn_id, fields)
 
     def subscribe(self, conn_id, queues):
+        """
+        :param queues: Queue names or patterns such as sensor.* and sensor.#
+        :return: dict - the sequence number of the first message each queue will deliver, patterns left out
+        """
         if not queues:
-            return
+            return dict()
 
-        if conn_id not in TCPRequestHandler.connections:
-            return
+        if conn_id not in self.connections:
+            return dict()
 
         if not isinstance(queues, (list, tuple)):
             queues = [queues]
 
-        subs = TCPRequestHandler.connections[conn_id]['subscriptions']
+        subs = self.connections[conn_id]['subscriptions']
+        added = [q for q in queues if q not in subs]
+        subs.extend(added)
+        self.announce(added, 1)
+
+        bus = ThreadedTCPServer.BUS
+        next_seqs = dict()
         for q in queues:
-            if q not in subs:
-                subs.append(q)
+            if is_pattern(q) or bus is not None and not bus.owns(q):
+                self.routes.add(conn_id, [q])
+                continue
+
+            with queue_lock(q):
+                self.routes.add(conn_id, [q])
+                next_seqs[q] = self.last_sequence(q) + 1
+
+        return next_seqs
+
+    def resume(self, conn_id, cursors):
+        """
+        Subscribes to queues from a sequence number each: the messages still kept from there on are sent first, in
+        pages, and the live ones follow. Each queue ends its backlog with an "OK: Resumed" response giving
+        coremq_next, the sequence number of the next live message, and coremq_missed, the number of messages that
+        were no longer kept.
+        :param cursors: dict of queue name to sequence number
+        """
+        for queue in cursors:
+            validate_queue(queue)
+            if is_pattern(queue):
+                raise ValueError('Patterns cannot be resumed, only queues: %s' % queue)
+
+        bus = ThreadedTCPServer.BUS
+        for queue, seq in cursors.items():
+            # live messages are held back until the backlog has caught up
+            self.unsubscribe(conn_id, [queue])
+            if bus is not None and not bus.owns(queue):
+                bus.request(queue, dict(coremq_resume={queue: int(seq)}, coremq_for=conn_id))
+            else:
+                self.backlogs.append(Backlog(queue, int(seq)))
+
+        self.send_backlogs(conn_id)
+
+    def send_backlogs(self, conn_id):
+        while self.backlogs:
+            if not self.writable():
+                return
+
+            backlog = self.backlogs[0]
+            envelopes = self.read_backlog(backlog.queue, backlog.seq, PAGE_SIZE)
+            if len(envelopes) == PAGE_SIZE:
+                self.send_backlog_page(conn_id, backlog, envelopes)
+                continue
+
+            # publishers of the queue wait while the last few messages go out, then become live
+            with queue_lock(backlog.queue):
+                while envelopes:
+                    self.send_backlog_page(conn_id, backlog, envelopes)
+                    envelopes = self.read_backlog(backlog.queue, backlog.seq, PAGE_SIZE)
+
+                self.finish_backlog(conn_id, backlog)
+
+            self.backlogs.pop(0)
+
+    def finish_backlog(self, conn_id, backlog):
+        last = self.last_sequence(backlog.queue)
+        self.send_message(conn_id, dict(response='OK: Resumed', coremq_queue=backlog.queue, coremq_next=last + 1,
+                                        coremq_missed=backlog.missed))
+        self.subscribe(conn_id, [backlog.queue])
+
+    def send_backlog_page(self, conn_id, backlog, envelopes):
+        if envelopes[0].seq > backlog.seq:
+            backlog.missed += envelopes[0].seq - backlog.seq
+
+        echo = self.options.get('echo', False)
+        for envelope in envelopes:
+            if envelope.sender != conn_id or backlog.queue == conn_id or echo:
+                self.send_frame(envelope.frame(self.protocol, self.compression, self.compression_threshold),
+                                message=backlog.queue != conn_id)
+
+        backlog.seq = envelopes[-1].seq + 1
 
     def unsubscribe(self, conn_id, queues):
         if not queues:
             return
 
-        if conn_id not in TCPRequestHandler.connections:
+        if conn_id not in self.connections:
             return
 
         if not isinstance(queues, (list, tuple)):
             queues = [queues]
 
-        subs = TCPRequestHandler.connections[conn_id]['subscriptions']
-        for q in queues:
-            if q in subs:
-                subs.remove(q)
+        subs = self.connections[conn_id]['subscriptions']
+        removed = [q for q in queues if q in subs]
+        for q in removed:
+            subs.remove(q)
+
+        self.routes.remove(conn_id, queues)
+        self.announce(removed, -1)
 
     def set_options(self, conn_id, options):
-        opts = TCPRequestHandler.connections[conn_id]['options']
+        if options.get('overflow') not in (None,) + OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of: %s' % ', '.join(OVERFLOW_POLICIES))
+
+        if options.get('ack') not in (None,) + ACK_MODES:
+            raise ValueError('ack must be one of: %s' % ', '.join(ACK_MODES))
+
+        compression = get_compressor(options['compression']).id if options.get('compression') is not None else 0
+        threshold = options.get('compression_threshold')
+        if threshold is not None and (not isinstance(threshold, int) or threshold < 0):
+            raise ValueError('compression_threshold must be a number of bytes')
+
+        opts = self.connections[conn_id]['options']
         opts.update(options)
 
         for key, val in options.items():
             if val is None and key in opts:
                 del opts[key]
 
-    def broadcast(self, queue, message):
-        for conn_id, d in TCPRequestHandler.connections.items():
-            if conn_id == message['coremq_sender'] and queue != conn_id and d['options'].get('echo', False) is False:
+        if 'compression' in options:
+            self.compression = compression
+        if 'compression_threshold' in options:
+            self.compression_threshold = COMPRESSION_THRESHOLD if threshold is None else threshold
+
+    def broadcast(self, queue, envelope, sender, peers=True):
+        """
+        :param peers: False to deliver to this worker's clients only, leaving out links to other workers and bridges
+        :return: int - the number of connections the message was passed to
+        """
+        # the queue of a connection only reaches it and exact subscribers, never patterns such as #
+        patterns = queue not in self.connections
+        if patterns and ThreadedTCPServer.BUS is not None:
+            patterns = queue not in ThreadedTCPServer.BUS.connections
+
+        count = 0
+        for conn_id in self.routes.get(queue, patterns):
+            d = self.connections.get(conn_id)
+            if d is None:
+                continue
+
+            if conn_id == sender and queue != conn_id and d['options'].get('echo', False) is False:
+                continue
+
+            handler = d['handler']
+            if handler.peer:
+                if peers:
+                    handler.forward(envelope, self)
+                    count += 1
+                continue
+
+            # messages sent to the queue of a connection itself need no credit
+            handler.send_frame(envelope.frame(handler.protocol, handler.compression, handler.compression_threshold),
+                               self, queue != conn_id)
+            count += 1
+
+        return count
+
+    def stream_chunk(self, conn_id, queue, payload, flags, metadata=None, peers=True):
+        """
+        Passes a chunk of a streamed message on as it arrives, so the message is never held whole. The connections
+        subscribed when its first chunk arrives get every chunk, interleaved with other messages, and the message is
+        acknowledged with its last chunk. Streams are neither numbered, stored nor counted in the metrics.
+        :param payload: CHUNK_V2 and the data of the chunk
+        :param flags: The flags of the frame, holding the codec of the message
+        :param metadata: (sender, sent, seq) of a chunk relayed by another worker, None for chunks from the client
+        :param peers: False to pass the chunk to this worker's clients only
+        """
+        number, index, marks = CHUNK_V2.unpack_from(payload)
+        key = number if metadata is None else (metadata[0], number)
+        stream = self.streams.get(key)
+        if stream is None:
+            if index != 0:
+                raise ValueError('Stream %s does not start with chunk 0' % number)
+
+            validate_queue(queue)
+            if queue == STATS_QUEUE:
+                raise ValueError('%s is reserved for the statistics of the broker' % queue)
+
+            sender, sent = (conn_id, time.time()) if metadata is None else metadata[:2]
+            stream = Stream(queue, sender, sent, flags & CODEC_MASK, number)
+            with queue_lock(queue):
+                stream.targets = self.stream_targets(queue, sender, peers)
+            self.streams[key] = stream
+        elif queue != stream.queue:
+            raise ValueError('Stream %s is published to %s' % (number, stream.queue))
+
+        if marks & (CHUNK_LAST | CHUNK_ABORT):
+            del self.streams[key]
+
+        self.send_chunk(stream, stream.frame(payload), marks & CHUNK_ABORT)
+        if metadata is None and marks & CHUNK_LAST:
+            self.published += 1
+            self.acknowledge(conn_id)
+
+    def stream_targets(self, queue, sender, peers=True):
+        """
+        :return: list of [conn_id, handler, dropped] - the connections a stream published to queue goes to: the
+        worker that owns the queue, or the subscribers as in broadcast. Protocol 1 clients cannot take chunks.
+        """
+        bus = ThreadedTCPServer.BUS
+        if peers and bus is not None and not bus.owns(queue):
+            link = bus.links[bus.owner(queue)]
+            return [[link.conn_id, link, link.dropped]]
+
+        patterns = queue not in self.connections
+        if patterns and bus is not None:
+            patterns = queue not in bus.connections
+
+        targets = []
+        for conn_id in self.routes.get(queue, patterns):
+            d = self.connections.get(conn_id)
+            if d is None:
+                continue
+
+            if conn_id == sender and queue != conn_id and d['options'].get('echo', False) is False:
+                continue
+
+            handler = d['handler']
+            if (handler.peer and not peers) or handler.protocol != 2:
+                continue
+
+            targets.append([conn_id, handler, handler.dropped])
+
+        return targets
+
+    def send_chunk(self, stream, frame, abort=False):
+        """
+        Passes a chunk to the connections of its stream. One that dropped a frame meanwhile may have lost a chunk,
+        so it gets CHUNK_ABORT instead and nothing more of the stream. Aborts are never dropped nor held for credit.
+        """
+        for target in list(stream.targets):
+            conn_id, handler, dropped = target
+            if conn_id not in self.connections:
+                stream.targets.remove(target)
                 continue
 
-            if queue in d['subscriptions']:
-                send_message(d['handler'].request, queue, message)
+            publisher = None if abort else self
+            if handler.peer:
+                handler.forward_chunk(frame, publisher)
+            else:
+                # chunks sent to the queue of a connection itself need no credit
+                handler.send_frame(frame, publisher, not abort and stream.queue != conn_id)
+
+            if handler.dropped != dropped and not abort:
+                # only clients drop frames
+                stream.targets.remove(target)
+                handler.send_frame(stream.abort_frame())
+
+    def abort_streams(self):
+        """
+        Gives up the streams the connection was publishing, telling the connections they went to
+        """
+        streams, self.streams = self.streams, dict()
+        for stream in streams.values():
+            self.send_chunk(stream, stream.abort_frame(), True)
+
+    def store_queue(self, queue, envelopes):
+        """
+        Numbers and stores messages of one queue. The caller holds its lock.
+        """
+        if ThreadedTCPServer.STORE is not None:
+            first = ThreadedTCPServer.STORE.append(queue, envelopes) + 1
+        else:
+            first = ThreadedTCPServer.SEQUENCES.get(queue, 0) + 1
+            ThreadedTCPServer.SEQUENCES[queue] = first + len(envelopes) - 1
+
+        for i, envelope in enumerate(envelopes):
+            envelope.seq = first + i
+
+        if ThreadedTCPServer.STORE is None:
+            if not queue in ThreadedTCPServer.HISTORY:
+                ThreadedTCPServer.HISTORY[queue] = collections.deque(maxlen=BACKLOG_SIZE)
+
+            ThreadedTCPServer.HISTORY[queue].extend(envelopes)
+
+    def last_sequence(self, queue):
+        if ThreadedTCPServer.STORE is not None:
+            return ThreadedTCPServer.STORE.count(queue)
+
+        return ThreadedTCPServer.SEQUENCES.get(queue, 0)
+
+    def read_backlog(self, queue, seq, limit):
+        """
+        :return: list of up to limit stored Envelopes of the queue, from sequence number seq or the oldest one kept
+        """
+        if ThreadedTCPServer.STORE is not None:
+            return [Envelope(queue, *record[1:], seq=record[0] + 1)
+                    for record in ThreadedTCPServer.STORE.read(queue, seq - 1, limit)]
 
-    def store_message(self, queue, message):
-        if not queue in ThreadedTCPServer.HISTORY:
-            ThreadedTCPServer.HISTORY[queue] = collections.deque(maxlen=10)
+        envelopes = list(ThreadedTCPServer.HISTORY.get(queue, ()))
+        if not envelopes:
+            return envelopes
 
-        ThreadedTCPServer.HISTORY[queue].append(message)
+        # the numbers of the envelopes kept in memory follow on from the first one
+        start = max(0, seq - envelopes[0].seq)
+        return envelopes[start:start + limit]
 
     def get_history(self, conn_id, queues):
-        result = dict()
+        bus = ThreadedTCPServer.BUS
+        if bus is not None:
+            # queues owned by other workers are answered by them, in separate responses
+            remote = [q for q in queues if not bus.owns(q)]
+            for q in remote:
+                bus.request(q, dict(coremq_gethistory=[q], coremq_for=conn_id, coremq_id=self.request_id))
+
+            queues = [q for q in queues if bus.owns(q)]
+            if remote and not queues:
+                return
+
+        self.send_response(conn_id, self.history_payload(queues, self.request_id))
+
+    def history_payload(self, queues, request_id=None):
+        """
+        :param request_id: The coremq_id of the request, if any
+        :return: bytes - the JSON response to coremq_gethistory
+        """
+        # history holds encoded messages, so the response is spliced together from their JSON payloads
+        result = []
         for q in queues:
-            if q in ThreadedTCPServer.HISTORY:
-                result[q] = list(ThreadedTCPServer.HISTORY[q])
+            if ThreadedTCPServer.STORE is not None:
+                # the payloads are views of the store's memory maps until they are joined into the response
+                envelopes = [Envelope(q, *record[1:], seq=record[0] + 1)
+                             for record in ThreadedTCPServer.STORE.tail(q, HISTORY_SIZE)]
+            else:
+                envelopes = list(itertools.islice(reversed(ThreadedTCPServer.HISTORY.get(q, ())), HISTORY_SIZE))[::-1]
+
+            if envelopes:
+                payloads = b', '.join(b''.join(e.frame(1)[1:]) for e in envelopes)
+                result.append(json.dumps(q).encode('utf-8') + b': [' + payloads + b']')
+
+        payload = b'{"response": {' + b', '.join(result) + b'}'
+        if request_id is not None:
+            payload += b', "coremq_id": ' + json.dumps(request_id).encode('utf-8')
+
+        return payload + b'}'
+
+    def get_stats(self, conn_id, queues):
+        """
+        Answers coremq_stats with a snapshot of the broker's metrics
+        :param queues: Queue names or patterns to give the counters of, or True for every queue
+        """
+        if ThreadedTCPServer.METRICS is None:
+            raise ValueError('Metrics are disabled on this broker')
+
+        if queues is True:
+            queues = None
+        elif not isinstance(queues, (list, tuple)):
+            queues = [queues]
 
-        send_message(self.request, conn_id, dict(response=result))
+        self.respond(conn_id, ThreadedTCPServer.METRICS.snapshot(self.connections, queues))
+
+    def send_response(self, conn_id, payload):
+        """
+        Sends an encoded JSON response
+        """
+        if self.protocol == 1:
+            self.send_frame(construct_frame(conn_id, payload))
+        else:
+            self.send_frame(construct_frame_v2(conn_id, payload, FRAME_CONTROL))
+
+
+class TCPRequestHandler(MessageQueueHandler, BaseRequestHandler):
+    connections = dict()
+    routes = RoutingTable()
+
+    def handle(self):
+        self.options = dict()
+        self.outbox = Outbox(self.request, self.options)
+        conn_id = self.open_connection()
+        self.reader = FrameReader(self.request)
+        while True:
+            try:
+                if self.ack_deadline is None:
+                    timeout = 1
+                else:
+                    # wake up in time to send a pending cumulative ack
+                    timeout = max(0.001, self.ack_deadline - time.time())
+
+                self.handle_frame(conn_id, *self.reader.read_frame(timeout=timeout))
+            except socket.timeout:
+                self.ack_due(conn_id, self.ack_deadline)
+            except (ConnectionClosed, socket.error):
+                break
+            except ProtocolError as ex:
+                # the stream cannot be resynchronised once a header is broken
+                self.respond(conn_id, str(ex))
+                break
+            except Exception as ex:
+                self.respond(conn_id, str(ex))
+                print(conn_id, ex)
+                traceback.print_exc()
+
+        self.close_connection(conn_id)
+        self.outbox.close()
+
+        if self.outbox.dropped:
+            print('Dropped %s messages for %s' % (self.outbox.dropped, conn_id))
+
+    @property
+    def queued(self):
+        return self.outbox.queued()
+
+    @property
+    def dropped(self):
+        return self.outbox.dropped
+
+    def writable(self):
+        return self.outbox.wait_for_room()
+
+    def send_frame(self, frame, publisher=None, message=False):
+        self.outbox.put(frame, control=publisher is None, message=message)
+
+    def grant(self, credit):
+        self.outbox.grant(credit)
 
 
 def signal_handler(signal, frame):
@@ -167,24 +1441,145 @@ def signal_handler(signal, frame):
     ThreadedTCPServer.EXITING = True
 
 
-def message_queue_process():
+def open_store(store):
+    """
+    Opens the LogStore given to a broker process, which then keeps history in it instead of in memory
+    """
+    if store is not None:
+        store.open()
+
+    ThreadedTCPServer.STORE = store
+
+
+def message_queue_process(address=ADDRESS, port=PORT, store=None, bus=None, federation=None, metrics=None):
+    """
+    :param bus: pubsub.workers.WorkerBus when running as one of several worker processes
+    :param federation: pubsub.federation.Federation to bridge this broker to others
+    :param metrics: pubsub.metrics.Metrics to count what the broker does, None to count nothing
+    """
     print('Starting message queue')
-    server = ThreadedTCPServer((ADDRESS, PORT), TCPRequestHandler)
-    server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    open_store(store)
+    path = unix_path(address)
+    if path is not None:
+        remove_socket(path)
+        server = ThreadedUnixServer(path, TCPRequestHandler, bind_and_activate=False)
+    else:
+        server = ThreadedTCPServer((address, port), TCPRequestHandler, bind_and_activate=False)
+    if bus is not None:
+        # the workers listen on the same port and the kernel spreads the connections between them
+        server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ThreadedTCPServer.BUS = bus
+        bus.start(TCPRequestHandler)
+    if federation is not None:
+        ThreadedTCPServer.FEDERATION = federation
+        federation.start(TCPRequestHandler)
+    if metrics is not None:
+        ThreadedTCPServer.METRICS = metrics
+        metrics.start(TCPRequestHandler)
+
+    server.server_bind()
+    server.server_activate()
+    if path is None:
+        server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     server.timeout = 1
     while not ThreadedTCPServer.EXITING:
         server.handle_request()
 
+    if path is not None:
+        remove_socket(path)
+
+    if bus is not None:
+        bus.close()
+    if store is not None:
+        store.close()
+
     print('Message queue stopped')
     sys.exit(0)
 
 
-def start():
+def start(engine='threaded', address=ADDRESS, port=PORT, store=None, workers=1, bridges=None, metrics=True,
+          stats_interval=None):
+    """
+    Starts the broker in its own process
+    :param store: Optional pubsub.store.LogStore to keep history on disk
+    :param address: Address to listen on, or unix:///path for a Unix domain socket
+    :param workers: Number of broker processes sharing the port, see pubsub.workers.WorkerBus. Each keeps its
+    history in its own directory under the path of store.
+    :param bridges: Optional list of (address, port) of peer brokers to federate with, see pubsub.federation
+    :param metrics: False not to keep the statistics answering coremq_stats, see pubsub.metrics
+    :param stats_interval: Seconds between statistics published on the coremq.stats queue, None not to publish them
+    """
+    if engine == 'threaded':
+        target = message_queue_process
+    elif engine == 'asyncio':
+        from pubsub.async_server import message_queue_process as target
+    else:
+        raise ValueError('Engine must be one of: %s' % ', '.join(ENGINES))
+
+    if workers > 1 and unix_path(address) is not None:
+        raise ValueError('Workers share a TCP port and cannot listen on a Unix socket')
+
+    federation = None
+    if bridges:
+        if workers > 1:
+            raise ValueError('Bridges cannot be used with several workers')
+
+        from pubsub.federation import Federation
+        federation = Federation(bridges)
+
+    if metrics:
+        from pubsub.metrics import Metrics
+        metrics = Metrics(stats_interval)
+    else:
+        metrics = None
+
+    # once nothing is left to fail, and before the broker processes start since they inherit the handlers
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    ThreadedTCPServer.PROCESS = Process(target=message_queue_process)
+    if workers > 1:
+        from pubsub.workers import start_workers
+        ThreadedTCPServer.WORKERS = start_workers(target, workers, address, port, store, metrics)
+        return
+
+    ThreadedTCPServer.PROCESS = Process(target=target, args=(address, port, store, None, federation, metrics))
     ThreadedTCPServer.PROCESS.start()
 
 
+def main():
+    parser = argparse.ArgumentParser(description='Starts the pubsub message broker')
+    parser.add_argument('--engine', choices=ENGINES, default='threaded',
+                        help='threaded uses one thread per connection, asyncio serves every connection from one thread')
+    parser.add_argument('--address', default=ADDRESS, help='address to listen on, or unix:///path for a Unix socket')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=1, help='broker processes sharing the port')
+    parser.add_argument('--bridge', action='append', default=[], metavar='HOST:PORT',
+                        help='peer broker to federate with (HOST:PORT or unix:///path), may be repeated')
+    parser.add_argument('--data-dir', help='keep history in segment files under this directory')
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='interval')
+    parser.add_argument('--fsync-interval', type=int, default=FSYNC_INTERVAL, help='milliseconds')
+    parser.add_argument('--segment-bytes', type=int, default=SEGMENT_BYTES)
+    parser.add_argument('--retention-bytes', type=int, help='per queue')
+    parser.add_argument('--retention-hours', type=float)
+    parser.add_argument('--no-metrics', action='store_true', help='do not keep statistics for coremq_stats')
+    parser.add_argument('--stats-interval', type=float, help='seconds between statistics published on coremq.stats')
+    args = parser.parse_args()
+
+    store = None
+    if args.data_dir:
+        store = LogStore(args.data_dir, args.fsync, args.fsync_interval, args.segment_bytes, args.retention_bytes,
+                         args.retention_hours * 3600 if args.retention_hours else None)
+
+    bridges = []
+    for peer in args.bridge:
+        if unix_path(peer) is not None:
+            bridges.append((peer, None))
+            continue
+
+        host, _, peer_port = peer.rpartition(':')
+        bridges.append((host or ADDRESS, int(peer_port)))
+
+    start(args.engine, args.address, args.port, store, args.workers, bridges, not args.no_metrics, args.stats_interval)
+
+
 if __name__ == '__main__':
-    start()
+    main()
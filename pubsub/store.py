@@ -0,0 +1,454 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from urllib.parse import quote, unquote
+
+# payload length, crc32 of the payload, codec and compression flags, stamped, sent time, sender uuid
+RECORD = struct.Struct('!IIBBd16s')
+# record number relative to the segment base, position of the record in the segment
+INDEX_ENTRY = struct.Struct('!II')
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+FSYNC_INTERVAL = 1000  # milliseconds
+SEGMENT_BYTES = 64 * 1024 * 1024
+INDEX_INTERVAL = 4096  # bytes of log between index entries
+IOV_MAX = 1024
+
+
+class Segment(object):
+    """
+    One file of a queue log, holding the records numbered from base. Records are RECORD headers followed by their
+    payload. The .idx file next to it is a sparse index with an entry every INDEX_INTERVAL bytes, so a record is found
+    by a bisect and a short walk. Reads go through a read-only memory map of the file, remapped when it has grown.
+    """
+
+    def __init__(self, directory, base):
+        self.base = base
+        self.path = os.path.join(directory, '%020d' % base)
+        self.count = 0
+        self.size = 0
+        self.modified = time.time()
+        self.offsets = []
+        self.positions = []
+        self.indexed = -INDEX_INTERVAL
+        self.fd = None
+        self.index_fd = None
+        self.view = None
+        self.sender = self.sender_bytes = None
+
+    def create(self):
+        self.fd = os.open(self.path + '.log', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self.path + '.idx', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def load(self, count):
+        """
+        Opens a sealed segment, whose record count is known from the base of the next one
+        """
+        self.count = count
+        self.size = os.path.getsize(self.path + '.log')
+        self.modified = os.path.getmtime(self.path + '.log')
+
+        try:
+            with open(self.path + '.idx', 'rb') as f:
+                data = f.read()
+        except IOError:
+            data = b''
+
+        if not data:
+            self.recover(reopen=False)
+            return
+
+        for i in range(0, len(data) - len(data) % INDEX_ENTRY.size, INDEX_ENTRY.size):
+            offset, position = INDEX_ENTRY.unpack_from(data, i)
+            self.offsets.append(offset)
+            self.positions.append(position)
+
+    def recover(self, reopen=True):
+        """
+        Scans the whole segment, truncating a torn or corrupt tail left by a crash, and rebuilds the index
+        """
+        size = os.path.getsize(self.path + '.log')
+        self.offsets, self.positions, self.indexed = [], [], -INDEX_INTERVAL
+        self.count = 0
+        index = []
+        position = 0
+        view = self.map(size)
+        while position + RECORD.size <= size:
+            length, crc, codec, stamped, sent, sender = RECORD.unpack_from(view, position)
+            end = position + RECORD.size + length
+            if end > size or zlib.crc32(view[position + RECORD.size:end]) != crc:
+                break
+
+            if position - self.indexed >= INDEX_INTERVAL:
+                self.offsets.append(self.count)
+                self.positions.append(position)
+                self.indexed = position
+                index.append(INDEX_ENTRY.pack(self.count, position))
+
+            self.count += 1
+            position = end
+
+        self.view = None
+        if position < size:
+            print('Truncating %s bytes of %s.log' % (size - position, self.path))
+            os.truncate(self.path + '.log', position)
+
+        self.size = position
+        if self.size:
+            self.modified = os.path.getmtime(self.path + '.log')
+
+        with open(self.path + '.idx', 'wb') as f:
+            f.write(b''.join(index))
+
+        if reopen:
+            self.fd = os.open(self.path + '.log', os.O_WRONLY | os.O_APPEND)
+            self.index_fd = os.open(self.path + '.idx', os.O_WRONLY | os.O_APPEND)
+
+    def append(self, envelopes):
+        buffers = []
+        index = []
+        position = self.size
+        for envelope in envelopes:
+            if position - self.indexed >= INDEX_INTERVAL:
+                self.offsets.append(self.count)
+                self.positions.append(position)
+                self.indexed = position
+                index.append(INDEX_ENTRY.pack(self.count, position))
+
+            payload = envelope.payload
+            if envelope.sender != self.sender:
+                self.sender, self.sender_bytes = envelope.sender, uuid.UUID(envelope.sender).bytes
+            buffers.append(RECORD.pack(len(payload), zlib.crc32(payload), envelope.codec | envelope.compression,
+                                       envelope.stamped, envelope.sent, self.sender_bytes))
+            buffers.append(payload)
+            position += RECORD.size + len(payload)
+            self.count += 1
+
+        write_all(self.fd, buffers)
+        if index:
+            os.write(self.index_fd, b''.join(index))
+
+        self.size = position
+        self.modified = time.time()
+
+    def map(self, size):
+        if self.view is None or len(self.view) < size:
+            # views handed out by earlier reads keep the old map alive until they are released
+            fd = os.open(self.path + '.log', os.O_RDONLY)
+            try:
+                self.view = memoryview(mmap.mmap(fd, size, access=mmap.ACCESS_READ)) if size else memoryview(b'')
+            finally:
+                os.close(fd)
+
+        return self.view
+
+    def read(self, start, limit):
+        """
+        Reads up to limit records from record number start
+        :return: list of (number, payload, codec, sender, sent, stamped), payloads being views of the memory map
+        """
+        records = []
+        if start >= self.base + self.count or limit <= 0:
+            return records
+
+        view = self.map(self.size)
+        number = self.base
+        position = 0
+        i = bisect.bisect_right(self.offsets, start - self.base) - 1
+        if i >= 0:
+            number += self.offsets[i]
+            position = self.positions[i]
+
+        while number < self.base + self.count and len(records) < limit:
+            length, crc, codec, stamped, sent, sender = RECORD.unpack_from(view, position)
+            begin = position + RECORD.size
+            position = begin + length
+            if number >= start:
+                records.append((number, view[begin:position], codec, str(uuid.UUID(bytes=sender)), sent,
+                                bool(stamped)))
+            number += 1
+
+        return records
+
+    def sync(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+
+    def seal(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            os.close(self.index_fd)
+            self.fd = self.index_fd = None
+
+    def delete(self):
+        self.seal()
+        self.view = None
+        for ext in ('.log', '.idx'):
+            try:
+                os.remove(self.path + ext)
+            except OSError:
+                pass
+
+
+class QueueLog(object):
+    """
+    The segments of one queue, oldest first. Only the last segment is written to.
+    """
+
+    def __init__(self, store, queue):
+        self.store = store
+        self.queue = queue
+        self.directory = os.path.join(store.path, quote(queue, safe='').replace('.', '%2E'))
+        self.segments = []
+        self.lock = threading.Lock()
+        self.unsynced = False  # appended to since the last fsync
+
+    def open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log'))
+        for i, base in enumerate(bases):
+            segment = Segment(self.directory, base)
+            if i + 1 < len(bases):
+                segment.load(bases[i + 1] - base)
+            else:
+                segment.recover()
+            self.segments.append(segment)
+
+        if not self.segments:
+            self.roll(0)
+
+        self.retain()
+
+    @property
+    def next_number(self):
+        last = self.segments[-1]
+        return last.base + last.count
+
+    def roll(self, base):
+        if self.segments:
+            self.segments[-1].seal()
+
+        segment = Segment(self.directory, base)
+        segment.create()
+        self.segments.append(segment)
+
+    def append(self, envelopes):
+        with self.lock:
+            first = self.next_number
+            if self.segments[-1].size >= self.store.segment_bytes:
+                self.roll(self.next_number)
+                self.retain()
+
+            self.segments[-1].append(envelopes)
+            if self.store.fsync == 'always':
+                self.segments[-1].sync()
+            else:
+                self.unsynced = True
+
+            return first
+
+    def retain(self):
+        """
+        Deletes the oldest segments beyond the retention limits, never the one being written
+        """
+        total = sum(s.size for s in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_big = self.store.retention_bytes is not None and total > self.store.retention_bytes
+            too_old = self.store.retention_seconds is not None and \
+                oldest.modified < time.time() - self.store.retention_seconds
+            if not too_big and not too_old:
+                break
+
+            total -= oldest.size
+            oldest.delete()
+            del self.segments[0]
+
+    def read(self, start, limit):
+        with self.lock:
+            start = max(start, self.segments[0].base)
+            i = bisect.bisect_right([s.base for s in self.segments], start) - 1
+            records = []
+            for segment in self.segments[i:]:
+                records.extend(segment.read(start, limit - len(records)))
+                if len(records) >= limit:
+                    break
+
+            return records
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                self.segments[-1].sync()
+                self.unsynced = False
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.seal()
+                segment.view = None
+
+
+class LogStore(object):
+    """
+    Persistent history: every queue gets a directory of append-only segment files under path, so history survives
+    a restart of the broker. Records keep the payload exactly as published, in the publisher's codec and
+    compression, with its sender and time.
+
+    fsync controls durability against power loss. Appends always reach the operating system before the publish is
+    acknowledged, so a crash of the broker itself loses nothing.
+    always: fsync after every append, the slowest
+    interval: fsync every fsync_interval milliseconds the queues appended to since (the default), from a thread
+    started by open, so a queue that went quiet is synced as well
+    never: leave it to the operating system
+    A new segment is started once the current one holds segment_bytes. The oldest segments of a queue are deleted
+    once the queue holds more than retention_bytes or they are older than retention_seconds.
+
+    The store is created without touching the disk, so it can be handed to the broker process before open is called.
+    """
+
+    def __init__(self, path, fsync='interval', fsync_interval=FSYNC_INTERVAL, segment_bytes=SEGMENT_BYTES,
+                 retention_bytes=None, retention_seconds=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of: %s' % ', '.join(FSYNC_POLICIES))
+
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.logs = dict()
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+
+    def open(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        for name in sorted(os.listdir(self.path)):
+            if os.path.isdir(os.path.join(self.path, name)):
+                self.log(unquote(name))
+
+        if self.fsync == 'interval':
+            threading.Thread(target=self.run, name='coremq-fsync', daemon=True).start()
+
+        print('Opened history of %s queues in %s' % (len(self.logs), self.path))
+
+    def run(self):
+        while not self.closing.wait(self.fsync_interval / 1000.0):
+            self.sync()
+
+    def log(self, queue):
+        log = self.logs.get(queue)
+        if log is None:
+            with self.lock:
+                log = self.logs.get(queue)
+                if log is None:
+                    log = QueueLog(self, queue)
+                    log.open()
+                    self.logs[queue] = log
+
+        return log
+
+    def append(self, queue, envelopes):
+        """
+        Appends published messages to the log of their queue
+        :param envelopes: objects with payload, codec, compression, sender, sent and stamped attributes
+        :return: int - the record number of the first message, the others following on
+        """
+        return self.log(queue).append(envelopes)
+
+    def count(self, queue):
+        """
+        :return: int - the number of records ever appended to the queue, including those deleted by retention
+        """
+        if queue not in self.logs:
+            return 0
+
+        return self.logs[queue].next_number
+
+    def read(self, queue, start, limit):
+        """
+        :return: list of (number, payload, codec, sender, sent, stamped) for up to limit records of the queue,
+        starting at record number start or the oldest one retained
+        """
+        if queue not in self.logs:
+            return []
+
+        return self.logs[queue].read(start, limit)
+
+    def tail(self, queue, count):
+        """
+        :return: The last count records of the queue, as read returns them
+        """
+        if queue not in self.logs:
+            return []
+
+        log = self.logs[queue]
+        return log.read(log.next_number - count, count)
+
+    def sync(self):
+        for log in list(self.logs.values()):
+            log.sync()
+
+    def close(self):
+        self.closing.set()
+        for log in list(self.logs.values()):
+            log.close()
+
+
+def write_all(fd, buffers):
+    """
+    Writes every buffer to the file in as few system calls as possible
+    """
+    if not hasattr(os, 'writev'):
+        buffers = [b''.join(buffers)]
+
+    i = 0
+    while i < len(buffers):
+        if hasattr(os, 'writev'):
+            written = os.writev(fd, buffers[i:i + IOV_MAX])
+        else:
+            written = os.write(fd, buffers[i])
+
+        # skip what was written, a partial write can end anywhere in a buffer
+        while i < len(buffers) and written >= len(buffers[i]):
+            written -= len(buffers[i])
+            i += 1
+
+        if written:
+            buffers[i] = memoryview(buffers[i])[written:]
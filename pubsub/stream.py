@@ -0,0 +1,320 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import asyncio
+import collections
+import threading
+import time
+
+from pubsub.common import CHUNK_ABORT, CHUNK_LAST, CODECS, StreamAborted
+
+STREAM_TIMEOUT = 30  # seconds a reader waits for the next chunk of a message
+
+
+class BaseMessageStream(object):
+    """
+    A message received in chunks (see FRAME_CHUNK), which the broker passes on as they arrive. Clients hand it to
+    the application as soon as its first chunk is in, in place of the message, and keep the chunks only until they
+    are read: a reader that keeps up holds one chunk of the message at a time, while the chunks of other streams
+    and small messages are received in between.
+
+    Reading raises StreamAborted once the message will not be completed: its publisher gave it up or went away, the
+    connection was lost, or a chunk was dropped on the way to this subscriber. The chunks count against the prefetch
+    window until they are read, so a stream should be read to the end or closed. While a read waits, what the client
+    holds unread no longer counts once it fills the window, so other streams cannot hold up the one being read.
+    """
+
+    def __init__(self, queue, sender, sent, codec, consumed=None, stalled=None, timeout=STREAM_TIMEOUT):
+        """
+        :param queue: The queue the message was published to
+        :param sender: The connection id of the publisher
+        :param sent: The time the broker received the first chunk
+        :param codec: The id of the codec of the whole message
+        :param consumed: Function called with the queue for every chunk taken out of the stream, which gives its
+        credit back
+        :param stalled: Function called whenever a read has to wait for a chunk
+        :param timeout: Seconds a read waits for the next chunk before raising TimeoutError
+        """
+        self.queue = queue
+        self.sender = sender
+        self.sent = sent
+        self.codec = CODECS.get(codec)
+        self.consumed = consumed
+        self.stalled = stalled
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.waiting = collections.deque()
+        self.index = 0
+        self.complete = False
+        self.closed = False
+        self.error = None
+        # True while a read waits for a chunk another thread receives
+        self.reading = False
+        # the rest of the chunk read last
+        self.buffer = b''
+        self.offset = 0
+
+    def feed(self, index, data, flags):
+        """
+        Adds a chunk received from the broker. Chunks the stream has no use for, after an error or close, are
+        counted as consumed straight away.
+        :param index: The index of the chunk in the message
+        :param flags: The CHUNK_ flags of the chunk
+        """
+        with self.condition:
+            if flags & CHUNK_ABORT:
+                if self.error is None and not self.complete:
+                    self.error = StreamAborted('The message on %s was given up' % self.queue)
+                self.condition.notify_all()
+                return
+
+            keep = self.error is None and not self.complete and not self.closed
+            if keep and index != self.index:
+                self.error = StreamAborted('Chunk %s of the message on %s was lost' % (self.index, self.queue))
+                keep = False
+            if keep:
+                self.waiting.append(data)
+                self.index += 1
+                self.complete = bool(flags & CHUNK_LAST)
+            self.condition.notify_all()
+
+        if not keep and self.consumed is not None:
+            self.consumed(self.queue)
+
+    def abort(self, reason):
+        """
+        Ends an incomplete stream with StreamAborted(reason), e.g. when the connection is lost
+        """
+        with self.condition:
+            if self.error is None and not self.complete:
+                self.error = StreamAborted(reason)
+            self.condition.notify_all()
+
+    def take(self):
+        """
+        :return: bytes - the next chunk, b'' at the end of the message, or None if it has not arrived yet
+        """
+        with self.condition:
+            if self.closed:
+                raise ValueError('Read from a closed stream')
+
+            if not self.waiting:
+                if self.error is not None:
+                    raise self.error
+                return b'' if self.complete else None
+
+            data = self.waiting.popleft()
+
+        if self.consumed is not None:
+            self.consumed(self.queue)
+        return data
+
+    def rest(self):
+        """
+        :return: bytes - what is left of the chunk read last, which becomes empty
+        """
+        data = self.buffer[self.offset:] if self.offset else self.buffer
+        self.buffer, self.offset = b'', 0
+        return data
+
+    def cut(self, size):
+        """
+        :return: bytes - up to size bytes of the chunk read last
+        """
+        if self.offset == 0 and size >= len(self.buffer):
+            return self.rest()
+
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        """
+        Gives up the rest of the message: chunks are discarded as they arrive
+        """
+        with self.condition:
+            self.closed = True
+            discarded = len(self.waiting)
+            self.waiting.clear()
+            self.buffer, self.offset = b'', 0
+
+        for i in range(discarded if self.consumed is not None else 0):
+            self.consumed(self.queue)
+
+    def readable(self):
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return '<%s %s from %s>' % (self.__class__.__name__, self.queue, self.sender)
+
+
+class MessageStream(BaseMessageStream):
+    """
+    A streamed message read like a binary file: read(size) and readinto, or iteration over the chunks as they came.
+    The codec attribute is the Codec the publisher sent the message in.
+    """
+
+    def __init__(self, queue, sender, sent, codec, consumed=None, stalled=None, pump=None, timeout=STREAM_TIMEOUT):
+        """
+        :param pump: Function receiving frames from the connection for up to the given seconds, called by reads
+        waiting for a chunk; None when another thread receives them
+        """
+        super(MessageStream, self).__init__(queue, sender, sent, codec, consumed, stalled, timeout)
+        self.pump = pump
+
+    def next_chunk(self):
+        """
+        :return: bytes - the next chunk, b'' at the end of the message
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            data = self.take()
+            if data is not None:
+                return data
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError('No chunk of the message on %s in %s seconds' % (self.queue, self.timeout))
+
+            if self.pump is not None:
+                if self.stalled is not None:
+                    self.stalled()
+                self.pump(remaining)
+                continue
+
+            # the client checks the prefetch window again as frames arrive
+            self.reading = True
+            try:
+                if self.stalled is not None:
+                    self.stalled()
+                with self.condition:
+                    if not self.waiting and self.error is None and not self.complete:
+                        self.condition.wait(remaining)
+            finally:
+                self.reading = False
+
+    def read(self, size=-1):
+        """
+        :param size: The most bytes to return, all the rest of the message if negative
+        :return: bytes - b'' at the end of the message
+        """
+        if size is None or size < 0:
+            return b''.join(self.chunks())
+
+        if self.offset >= len(self.buffer):
+            self.buffer, self.offset = self.next_chunk(), 0
+        return self.cut(size)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def chunks(self):
+        """
+        :return: generator of the rest of the message, chunk by chunk
+        """
+        if self.offset < len(self.buffer):
+            yield self.rest()
+
+        while True:
+            data = self.next_chunk()
+            if not data:
+                return
+            yield data
+
+    def __iter__(self):
+        return self.chunks()
+
+
+class AsyncMessageStream(BaseMessageStream):
+    """
+    A streamed message for AsyncMessageQueue: read, readinto and chunks are coroutines, and async for iterates over
+    the chunks.
+    """
+
+    def __init__(self, queue, sender, sent, codec, consumed=None, stalled=None, timeout=STREAM_TIMEOUT):
+        super(AsyncMessageStream, self).__init__(queue, sender, sent, codec, consumed, stalled, timeout)
+        self.arrived = asyncio.Event()
+
+    def feed(self, index, data, flags):
+        super(AsyncMessageStream, self).feed(index, data, flags)
+        self.arrived.set()
+
+    def abort(self, reason):
+        super(AsyncMessageStream, self).abort(reason)
+        self.arrived.set()
+
+    async def next_chunk(self):
+        """
+        :return: bytes - the next chunk, b'' at the end of the message
+        """
+        while True:
+            data = self.take()
+            if data is not None:
+                return data
+
+            self.arrived.clear()
+            self.reading = True
+            try:
+                if self.stalled is not None:
+                    self.stalled()
+                await asyncio.wait_for(self.arrived.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError('No chunk of the message on %s in %s seconds' % (self.queue, self.timeout))
+            finally:
+                self.reading = False
+
+    async def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join([data async for data in self.chunks()])
+
+        if self.offset >= len(self.buffer):
+            self.buffer, self.offset = await self.next_chunk(), 0
+        return self.cut(size)
+
+    async def readinto(self, buffer):
+        data = await self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    async def chunks(self):
+        if self.offset < len(self.buffer):
+            yield self.rest()
+
+        while True:
+            data = await self.next_chunk()
+            if not data:
+                return
+            yield data
+
+    def __aiter__(self):
+        return self.chunks()
@@ -0,0 +1,467 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import collections
+import itertools
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pubsub.client import MessageQueue
+from pubsub.common import CHUNK_SIZE, ConnectionClosed, ProtocolError, queue_matches
+from pubsub.stream import BaseMessageStream, MessageStream
+
+CONNECT_TIMEOUT = 30
+RECONNECT_INTERVAL = 1  # seconds between attempts of the reader to reconnect
+CALLBACK_WORKERS = 4
+
+
+class ThreadedMessageQueue(MessageQueue):
+    """
+    MessageQueue with a thread of its own reading from the broker, so neither the application nor its callbacks ever
+    poll the socket.
+
+    Messages of the queues that have a callback (see on and subscribe) are passed to it as callback(queue, message)
+    on a thread pool: callbacks of different queues run in parallel, those of one queue one at a time and in order.
+    The other messages, and responses that belong to no request, are kept for get_message.
+
+    subscribe, unsubscribe, set_options and get_history return a concurrent.futures.Future. Each request carries a
+    coremq_id that the broker repeats in its response, which resolves the future: with the response, or for
+    get_history with a dict of queue name to messages. An error response fails it with ValueError. Acknowledgements
+    are recorded by the reader and wait_for_ack waits for them.
+
+    The reader makes a lost connection again every reconnect_interval seconds, resuming the subscriptions, and fails
+    the requests still waiting on it with ConnectionError. Publishers wait for the new connection.
+
+    Streamed messages are fed by the reader, so a callback reads its MessageStream while the chunks arrive. The
+    stream is closed once the callback returns.
+    """
+
+    def __init__(self, server='127.0.0.1', port=6747, protocol=1, codec=None, max_workers=CALLBACK_WORKERS,
+                 executor=None, reconnect_interval=RECONNECT_INTERVAL, trace=False):
+        """
+        :param max_workers: Threads of the pool running the callbacks
+        :param executor: An Executor to run the callbacks on instead, which close leaves running
+        """
+        super(ThreadedMessageQueue, self).__init__(server, port, protocol, codec, trace)
+        self.owns_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='coremq-callback')
+        self.executor = executor
+        self.reconnect_interval = reconnect_interval
+        # queue name or pattern -> callback
+        self.callbacks = dict()
+        # queue name -> messages waiting for the callback of the queue while it runs
+        self.lanes = dict()
+        # coremq_id -> Future of the request
+        self.pending = dict()
+        self.request_ids = itertools.count(1)
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = None
+        self.closed = False
+
+    def connect(self):
+        with self.lock:
+            if self.socket:
+                return
+
+            self.closed = False
+            try:
+                super(ThreadedMessageQueue, self).connect()
+            except BaseException:
+                self.disconnect()
+                raise
+
+            # the reader waits for frames without a timeout, which would otherwise apply to publishers too
+            self.socket.settimeout(None)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='coremq-reader', daemon=True)
+                self.thread.start()
+
+            self.changed.notify_all()
+
+    def run(self):
+        while not self.closed:
+            reader = self.reader
+            if reader is None:
+                try:
+                    self.connect()
+                except (socket.error, ConnectionClosed, ProtocolError) as ex:
+                    print('Reconnecting to %s:%s: %s' % (self.server, self.port, ex))
+                    time.sleep(self.reconnect_interval)
+                continue
+
+            try:
+                frame = reader.read_frame(timeout=None)
+            except (ConnectionClosed, ProtocolError, socket.error):
+                self.lost(reader)
+                continue
+
+            try:
+                self.receive(frame)
+            except Exception as ex:
+                print('Reader of %s:%s' % (self.server, self.port), ex)
+                traceback.print_exc()
+
+    def receive(self, frame):
+        try:
+            queue, message = self.decode(frame)
+        except (ProtocolError, ValueError):
+            traceback.print_exc()
+            return
+
+        if self.stream_waited():
+            self.stalled()
+
+        if queue is None:
+            return
+
+        with self.lock:
+            if self.track(queue, message):
+                self.changed.notify_all()
+                return
+
+            future = None
+            if queue == self.connection_id and isinstance(message, dict):
+                future = self.pending.pop(message.get('coremq_id'), None)
+
+            if future is None:
+                if queue == self.connection_id or self.callback_for(queue) is None:
+                    self.received.append((queue, message))
+                    self.changed.notify_all()
+                    return
+
+                lane = self.lanes.get(queue)
+                if lane is not None:
+                    # the callback of the queue is running and takes this message next
+                    lane.append(message)
+                    return
+
+                self.lanes[queue] = collections.deque([message])
+
+        if future is not None:
+            response = message.get('response')
+            if isinstance(response, str) and not response.startswith('OK'):
+                future.set_exception(ValueError(response))
+            else:
+                future.set_result(message)
+        else:
+            self.executor.submit(self.dispatch, queue)
+
+    def dispatch(self, queue):
+        """
+        Passes the messages of a queue to its callback until none are left
+        """
+        while True:
+            with self.lock:
+                lane = self.lanes[queue]
+                if not lane:
+                    del self.lanes[queue]
+                    return
+
+                message = lane.popleft()
+                callback = self.callback_for(queue)
+                if callback is None:
+                    self.received.append((queue, message))
+                    self.changed.notify_all()
+                    continue
+
+            try:
+                callback(queue, message)
+            except Exception as ex:
+                print('Callback for %s' % queue, ex)
+                traceback.print_exc()
+
+            if isinstance(message, BaseMessageStream):
+                message.close()
+            else:
+                self.replenish(queue)
+
+    def callback_for(self, queue):
+        callback = self.callbacks.get(queue)
+        if callback is None:
+            for pattern, c in self.callbacks.items():
+                if queue_matches(pattern, queue):
+                    return c
+
+        return callback
+
+    def on(self, queue, callback):
+        """
+        Passes the messages of a queue to a callback rather than get_message. The queue must also be subscribed to.
+        :param queue: Queue name or pattern. A queue name takes precedence over the patterns matching it
+        :param callback: callback(queue, message), or None to keep the messages for get_message again
+        """
+        with self.lock:
+            if callback is None:
+                self.callbacks.pop(queue, None)
+            else:
+                self.callbacks[queue] = callback
+
+    def lost(self, reader):
+        with self.lock:
+            if self.reader is not reader:
+                return
+
+            self.disconnect()
+            pending, self.pending = self.pending, dict()
+            self.changed.notify_all()
+
+        for future in pending.values():
+            future.set_exception(ConnectionError('Lost the connection to %s:%s' % (self.server, self.port)))
+
+    def disconnect(self):
+        with self.lock:
+            if self.socket:
+                try:
+                    # wakes the reader up
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+            super(ThreadedMessageQueue, self).close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.disconnect()
+            pending, self.pending = self.pending, dict()
+            self.changed.notify_all()
+
+        for future in pending.values():
+            future.cancel()
+
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+
+    def transmit(self, build):
+        """
+        Sends the frame returned by build(), waiting for the reader to reconnect if the connection is lost
+        """
+        with self.lock:
+            if self.thread is None or self.closed:
+                self.connect()
+
+            deadline = time.time() + CONNECT_TIMEOUT
+            while True:
+                while not self.socket:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ConnectionError('Could not reconnect to %s:%s' % (self.server, self.port))
+                    self.changed.wait(remaining)
+
+                try:
+                    self.socket.sendall(build())
+                    return
+                except socket.error:
+                    # the reader reconnects
+                    self.disconnect()
+
+    def send_message(self, queue, message):
+        with self.lock:
+            return super(ThreadedMessageQueue, self).send_message(queue, message)
+
+    def publish_batch(self, messages):
+        with self.lock:
+            return super(ThreadedMessageQueue, self).publish_batch(messages)
+
+    def send_stream(self, queue, source, chunk_size=CHUNK_SIZE, codec=None):
+        """
+        Publishes a message in chunks, see MessageQueue.send_stream. Other threads publish between the chunks.
+        """
+        connection_id = None
+        for frame in self.stream_frames(queue, source, chunk_size, codec):
+            with self.lock:
+                self.transmit(lambda: frame)
+                if connection_id is None:
+                    connection_id = self.connection_id
+                elif connection_id != self.connection_id:
+                    raise ConnectionError('Lost the connection to %s:%s while streaming' % (self.server, self.port))
+
+        with self.lock:
+            self.published += 1
+            return self.published
+
+    def stalled(self):
+        with self.lock:
+            super(ThreadedMessageQueue, self).stalled()
+
+    def open_stream(self, queue, sender, sent, codec):
+        return MessageStream(queue, sender, sent, codec, self.replenish, self.stalled)
+
+    def request(self, message):
+        """
+        Sends a control message
+        :return: Future - resolved with the response of the broker
+        """
+        future = Future()
+        with self.lock:
+            request_id = next(self.request_ids)
+            message['coremq_id'] = request_id
+            self.pending[request_id] = future
+            try:
+                self.send_control(message)
+            except BaseException:
+                self.pending.pop(request_id, None)
+                raise
+
+        return future
+
+    def wait_for_ack(self, seq=None, timeout=10):
+        """
+        Waits until the broker has accepted every message up to seq
+        :param seq: A sequence number returned by send_message. Defaults to the last message sent
+        :param timeout: Seconds to wait
+        :return: bool - False if the broker did not confirm the messages in time or a reconnect may have lost them
+        """
+        if seq is None:
+            seq = self.published
+
+        acknowledged = self.acknowledged(seq)
+        if acknowledged is not None:
+            return acknowledged
+
+        self.send_control(dict(coremq_sync=True))
+        deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                acknowledged = self.acknowledged(seq)
+                if acknowledged is not None:
+                    return acknowledged
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+
+    def get_message(self, timeout=1):
+        """
+        :return: (str, object) - the next message without a callback, or (None, None) if none arrived in time
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            if self.thread is None:
+                self.connect()
+
+            while not self.received:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self.closed:
+                    return None, None
+                self.changed.wait(remaining)
+
+            queue, message = self.received.popleft()
+            if not isinstance(message, BaseMessageStream):
+                self.replenish(queue)
+            return queue, message
+
+    def replenish(self, queue):
+        """
+        Grants the broker credit again for the messages taken by get_message and the callbacks
+        """
+        with self.lock:
+            credit = self.consume(queue)
+            if credit is not None:
+                self.send_control(credit)
+
+    def get_history(self, *queues):
+        """
+        :return: Future - resolved with a dict of queue name to its last messages
+        """
+        queues = self.history_request(queues)['coremq_gethistory']
+        # one request per queue, as each queue can be answered by a different worker of the broker
+        futures = [self.request(dict(coremq_gethistory=[q])) for q in queues]
+        result = Future()
+
+        def done(future):
+            with self.lock:
+                if result.done():
+                    return
+
+                if future.cancelled():
+                    result.cancel()
+                elif future.exception() is not None:
+                    result.set_exception(future.exception())
+                elif all(f.done() for f in futures):
+                    history = dict()
+                    for f in futures:
+                        history.update(f.result()['response'])
+                    result.set_result(history)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+        return result
+
+    def get_stats(self, *queues):
+        """
+        :param queues: Queue names or patterns to give the counters of, see MessageQueue.get_stats
+        :return: Future - resolved with the response of the broker
+        """
+        return self.request(self.stats_request(queues))
+
+    def subscribe(self, *queues, from_sequence=None, callback=None):
+        """
+        :param queues: Queue names or patterns, see MessageQueue.subscribe
+        :param from_sequence: Optional sequence number to start each queue from
+        :param callback: Optional callback(queue, message) for the messages of these queues, see on
+        :return: Future - resolved with the response of the broker
+        """
+        message = self.subscription(queues, from_sequence)
+        if callback is not None:
+            for q in message['coremq_subscribe']:
+                self.on(q, callback)
+
+        return self.request(message)
+
+    def unsubscribe(self, *queues):
+        """
+        Also removes the callbacks of the queues
+        :return: Future - resolved with the response of the broker
+        """
+        message = self.unsubscription(queues)
+        for q in message['coremq_unsubscribe']:
+            self.on(q, None)
+
+        return self.request(message)
+
+    def set_options(self, **options):
+        """
+        :return: Future - resolved with the response of the broker
+        """
+        return self.request(self.options_request(options))
+
+    def set_prefetch(self, messages=None, size=None):
+        """
+        Limits what the broker sends ahead of get_message and the callbacks, see MessageQueue.set_prefetch. The credit
+        is not answered, so nothing is returned.
+        """
+        with self.lock:
+            self.send_control(self.prefetch_request(messages, size))
@@ -0,0 +1,159 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import threading
+import time
+
+BUCKETS = 64
+PRECISION = 3  # 8 buckets for every power of two, percentiles within 12.5%
+SEGMENTS = ('publish', 'queueing', 'delivery', 'total')
+
+
+class Histogram(object):
+    """
+    Counts values in logarithmic buckets, like HdrHistogram: values below 2 ** (precision + 1) have a bucket each and
+    every power of two above is split into 2 ** precision buckets. Recording a value costs an int.bit_length() and
+    percentiles are given as the upper bound of their bucket, within a factor of 1 + 2 ** -precision. The default
+    precision of 0 counts in power-of-two buckets: bucket i holds the values below 2 ** i.
+    """
+
+    def __init__(self, scale=1, precision=0):
+        """
+        :param scale: Factor applied to recorded values, e.g. 1e6 to record seconds as microseconds
+        :param precision: Bits of each value kept below its highest bit
+        """
+        self.scale = scale
+        self.precision = precision
+        self.counts = [0] * (BUCKETS << precision)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value, times=1):
+        value = int(value * self.scale)
+        shift = value.bit_length() - self.precision - 1
+        index = value if shift <= 0 else (shift << self.precision) + (value >> shift)
+        self.counts[min(index, len(self.counts) - 1)] += times
+        self.count += times
+        self.total += value * times
+        if value > self.max:
+            self.max = value
+
+    def upper(self, index):
+        """
+        :return: int - the largest value counted in a bucket
+        """
+        if index < 2 << self.precision:
+            return index
+
+        shift = (index >> self.precision) - 1
+        return ((index - (shift << self.precision) + 1) << shift) - 1
+
+    def percentile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.upper(i), self.max)
+
+        return self.max
+
+    def summary(self):
+        return dict(count=self.count, mean=self.total / self.count if self.count else 0,
+                    p50=self.percentile(0.5), p99=self.percentile(0.99), p999=self.percentile(0.999), max=self.max)
+
+    def buckets(self):
+        """
+        :return: list of (upper bound, count) for the buckets that counted anything
+        """
+        return [(min(self.upper(i), self.max), count) for i, count in enumerate(self.counts) if count]
+
+
+class Tracer(object):
+    """
+    Latency of the traced messages a client receives, by queue, split into where the time went:
+    publish: from the publisher stamping the message to the broker receiving it, its coremq_sent time
+    queueing: from then to the broker dispatching it: storing, routing and, with several workers, passing it to the
+    worker that owns the queue
+    delivery: from then to the subscriber decoding it, including the time spent in the broker's outbox for the
+    connection and in the subscriber's own buffers until the application asked for it
+    total: from the publisher to the subscriber
+
+    The times come from the clocks of the publisher, the broker and the subscriber, so between hosts the segments are
+    only as accurate as the synchronization of their clocks. Negative spans from clock skew count as 0.
+    """
+
+    def __init__(self, precision=PRECISION):
+        """
+        :param precision: See Histogram
+        """
+        self.precision = precision
+        self.lock = threading.Lock()
+        # queue -> segment -> Histogram of microseconds
+        self.queues = dict()
+        self.started = time.time()
+
+    def record(self, queue, published, received, dispatched, arrived):
+        """
+        :param published: When the publisher stamped the message
+        :param received: When the broker received it
+        :param dispatched: When the broker dispatched it
+        :param arrived: When the subscriber decoded it
+        """
+        with self.lock:
+            histograms = self.queues.get(queue)
+            if histograms is None:
+                histograms = self.queues[queue] = dict((s, Histogram(1e6, self.precision)) for s in SEGMENTS)
+
+            histograms['publish'].record(max(0, received - published))
+            histograms['queueing'].record(max(0, dispatched - received))
+            histograms['delivery'].record(max(0, arrived - dispatched))
+            histograms['total'].record(max(0, arrived - published))
+
+    def summary(self, queue=None):
+        """
+        :param queue: Optional queue name, every queue traced so far by default
+        :return: dict of queue to a dict of segment to the count, mean, p50, p99, p999 and max of its microseconds
+        """
+        with self.lock:
+            return dict((q, dict((s, h.summary()) for s, h in histograms.items()))
+                        for q, histograms in self.queues.items() if queue is None or q == queue)
+
+    def export(self):
+        """
+        :return: dict - the summaries along with every bucket of the histograms, as (upper bound in microseconds,
+        count) pairs, ready to be saved as JSON
+        """
+        with self.lock:
+            queues = dict((q, dict((s, dict(h.summary(), buckets=h.buckets())) for s, h in histograms.items()))
+                          for q, histograms in self.queues.items())
+
+        return dict(started=self.started, exported=time.time(), precision=self.precision, queues=queues)
+
+    def reset(self):
+        with self.lock:
+            self.queues.clear()
+            self.started = time.time()
@@ -0,0 +1,439 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import collections
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+import zlib
+from multiprocessing import Process
+
+from pubsub.common import ENCODING_MASK, FLAG_STAMPED, FRAME_BATCH, FRAME_CHUNK, FRAME_CONTROL, FRAME_MESSAGE, \
+    ConnectionClosed, FrameReader, construct_frame_v2, construct_message, encode_message, is_pattern, iter_frames_v2, \
+    send_frame, split_trace
+from pubsub.server import Backlog, Envelope, MessageQueueHandler, Outbox, ThreadedTCPServer, frame_buffers
+from pubsub.store import LogStore
+
+LINK_TIMEOUT = 10  # seconds to wait for the other workers at startup
+LINK_QUEUE = 'coremq_workers'  # queue of the control frames between workers that are not addressed to a connection
+
+
+class PeerLink(MessageQueueHandler):
+    """
+    The Unix socket between two worker processes. It is registered as a connection of the engine, so the owner of a
+    queue delivers to the workers interested in it exactly as it delivers to its own subscribers. It receives:
+    MESSAGE frames: publishes forwarded to this worker as the owner of their queue, or else messages from the owner
+    for this worker's subscribers
+    BATCH frames addressed to a connection: backlog pages for a subscriber resuming a queue of the other worker
+    CHUNK frames: chunks of streamed messages, relayed like MESSAGE frames as they arrive
+    CONTROL frames: interest in queues, requests made for a connection (coremq_for), and responses to them addressed
+    to the connection
+
+    Frames are read by a thread of the link and handled in order, by that thread for the threaded engine and on the
+    event loop for the asyncio engine. Frames are written by an Outbox, which blocks the sender while it is full.
+    """
+    peer = True
+
+    def __init__(self, bus, index, sock, reader):
+        self.bus = bus
+        self.index = index
+        self.socket = sock
+        self.reader = reader
+        self.connections = bus.handler_class.connections
+        self.routes = bus.handler_class.routes
+        # the worker that forwarded a message gets it back for its own subscribers
+        self.options = dict(ack='none', echo=True)
+        self.outbox = Outbox(sock, self.options)
+        self.reading = threading.Event()
+        self.reading.set()
+        # the asyncio engine pauses and resumes publishers through their transport
+        self.transport = self
+        self.conn_id = self.open_connection()
+
+    def open_connection(self):
+        self.published = 0
+        self.acked = 0
+        self.ack_deadline = None
+        self.protocol = 2
+        self.backlogs = []
+        # (sender, stream number) -> Stream relayed through the link
+        self.streams = dict()
+
+        conn_id = str(uuid.uuid4())
+        self.connections[conn_id] = dict(handler=self, subscriptions=[], options=self.options)
+        return conn_id
+
+    def run(self):
+        while True:
+            try:
+                frames = self.reader.read_frames(timeout=None)
+            except (ConnectionClosed, socket.error):
+                break
+
+            self.reading.wait()
+            if self.bus.dispatch is None:
+                self.receive(frames)
+            else:
+                self.bus.dispatch(self.receive, frames)
+
+        if self.bus.dispatch is None:
+            self.abort_streams()
+        else:
+            self.bus.dispatch(self.abort_streams)
+        print('Lost the link to worker %s' % self.index)
+
+    def receive(self, frames):
+        publishes = []
+        for queue, payload, kind, flags, metadata in frames:
+            try:
+                if kind == FRAME_MESSAGE:
+                    payload, published, _ = split_trace(payload, flags)
+                    envelope = Envelope(queue, payload, flags & ENCODING_MASK, metadata[0], metadata[1],
+                                        bool(flags & FLAG_STAMPED), metadata[2], published=published)
+                    if self.bus.owns(queue):
+                        publishes.append(envelope)
+                    else:
+                        fanout = self.broadcast(queue, envelope, envelope.sender, peers=False)
+                        if ThreadedTCPServer.METRICS is not None:
+                            ThreadedTCPServer.METRICS.delivered(queue, envelope, fanout)
+                    continue
+
+                if publishes:
+                    self.route(self.conn_id, publishes)
+                    publishes = []
+
+                if kind == FRAME_CHUNK:
+                    self.stream_chunk(self.conn_id, queue, payload, flags, metadata, peers=self.bus.owns(queue))
+                elif kind == FRAME_BATCH:
+                    self.deliver(queue, iter_frames_v2(payload))
+                else:
+                    self.handle_control(queue, payload, json.loads(payload.decode('utf-8')))
+            except Exception as ex:
+                print('worker %s' % self.index, ex)
+                traceback.print_exc()
+
+        if publishes:
+            self.route(self.conn_id, publishes)
+
+    def handle_control(self, queue, payload, message):
+        if 'response' in message:
+            self.respond_for(queue, payload, message)
+        elif 'coremq_subscribe' in message:
+            queues = message['coremq_subscribe']
+            subs = self.connections[self.conn_id]['subscriptions']
+            subs.extend([q for q in queues if q not in subs])
+            self.routes.add(self.conn_id, queues)
+            if message.get('coremq_connection'):
+                self.bus.connections.update(queues)
+        elif 'coremq_unsubscribe' in message:
+            queues = message['coremq_unsubscribe']
+            subs = self.connections[self.conn_id]['subscriptions']
+            for q in queues:
+                if q in subs:
+                    subs.remove(q)
+                self.bus.connections.discard(q)
+            self.routes.remove(self.conn_id, queues)
+        elif 'coremq_resume' in message:
+            for queue, seq in message['coremq_resume'].items():
+                self.backlogs.append(Backlog(queue, int(seq), message['coremq_for']))
+            self.send_backlogs(self.conn_id)
+        elif 'coremq_gethistory' in message:
+            self.send_response(message['coremq_for'], self.history_payload(message['coremq_gethistory'],
+                                                                          message.get('coremq_id')))
+
+    def respond_for(self, conn_id, payload, message):
+        """
+        Passes a response of the owner of a queue on to the connection it was requested for
+        """
+        d = self.connections.get(conn_id)
+        if message['response'] == 'OK: Resumed':
+            # the owner delivers the queue to this worker from now on, which becomes the interest of the connection
+            if d is None:
+                self.bus.release(message['coremq_queue'])
+                return
+
+            d['handler'].subscribe(conn_id, [message['coremq_queue']])
+
+        if d is not None:
+            d['handler'].send_response(conn_id, payload)
+
+    def deliver(self, conn_id, frames):
+        d = self.connections.get(conn_id)
+        if d is None:
+            return
+
+        handler = d['handler']
+        echo = d['options'].get('echo', False)
+        for queue, payload, kind, flags, metadata in frames:
+            if metadata[0] != conn_id or echo:
+                payload, published, _ = split_trace(payload, flags)
+                envelope = Envelope(queue, payload, flags & ENCODING_MASK, metadata[0], metadata[1],
+                                    bool(flags & FLAG_STAMPED), metadata[2], published=published)
+                handler.send_frame(envelope.frame(handler.protocol, handler.compression, handler.compression_threshold),
+                                   message=queue != conn_id)
+
+    def finish_backlog(self, conn_id, backlog):
+        last = self.last_sequence(backlog.queue)
+        self.send_response(backlog.target, encode_message(dict(
+            response='OK: Resumed', coremq_queue=backlog.queue, coremq_next=last + 1, coremq_missed=backlog.missed)))
+
+        # live messages follow the backlog on the link, the other worker holds on to them until its subscriber is in
+        subs = self.connections[conn_id]['subscriptions']
+        if backlog.queue not in subs:
+            subs.append(backlog.queue)
+        self.routes.add(conn_id, [backlog.queue])
+
+    def send_backlog_page(self, conn_id, backlog, envelopes):
+        if envelopes[0].seq > backlog.seq:
+            backlog.missed += envelopes[0].seq - backlog.seq
+
+        # deliver leaves out the subscriber's own messages, unless it wants them echoed
+        payload = b''.join(frame_buffers([e.frame(2) for e in envelopes]))
+        self.send_frame(construct_frame_v2(backlog.target, payload, FRAME_BATCH))
+        backlog.seq = envelopes[-1].seq + 1
+
+    def forward(self, envelope, publisher):
+        self.send_frame(envelope.frame(2), publisher)
+
+    def forward_chunk(self, frame, publisher):
+        self.send_frame(frame, publisher)
+
+    def writable(self):
+        return self.outbox.wait_for_room()
+
+    @property
+    def queued(self):
+        return len(self.outbox.frames)
+
+    def send_frame(self, frame, publisher=None, message=False):
+        # the worker at the other end holds messages for its own clients' credit
+        self.outbox.put(frame, control=publisher is None)
+
+    def pause_reading(self):
+        self.reading.clear()
+
+    def resume_reading(self):
+        self.reading.set()
+
+    def is_closing(self):
+        return self.outbox.closed
+
+
+class WorkerBus(object):
+    """
+    Connects a broker worker process to the other workers. Workers share the listening port through SO_REUSEPORT,
+    so the kernel spreads clients between them, and every pair of workers is linked by a Unix socket in directory.
+
+    Each queue is owned by one worker, chosen by hashing its name. The owner numbers, stores and delivers every
+    message of the queue: other workers forward what their clients publish to it, and tell it which of its queues
+    their clients subscribe to, so it sends them the messages for those subscribers. Patterns can match queues of
+    every worker, so subscribing to one is announced to them all. History and backlogs of resuming subscribers are
+    requested from the owner.
+    """
+
+    def __init__(self, index, count, directory):
+        self.index = index
+        self.count = count
+        self.directory = directory
+        self.links = dict()
+        self.interests = collections.Counter()
+        # connections of other workers that subscribed through this one, their queues never match patterns
+        self.connections = set()
+        self.lock = threading.Condition()
+        self.handler_class = None
+        self.dispatch = None
+        self.server = None
+
+    def path(self, index):
+        return os.path.join(self.directory, 'worker-%s.sock' % index)
+
+    def owner(self, queue):
+        return zlib.crc32(queue.encode('utf-8')) % self.count
+
+    def owns(self, queue):
+        return self.owner(queue) == self.index
+
+    def start(self, handler_class, dispatch=None):
+        """
+        Links this worker to the others, waiting for all of them
+        :param handler_class: The request handler of the engine, whose connections and routes the links join
+        :param dispatch: Function called with a function and its arguments to run them on the engine's thread, None
+        to run them on the thread of the link
+        """
+        self.handler_class = handler_class
+        self.dispatch = dispatch
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path(self.index))
+        self.server.listen(self.count)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+        # each pair of workers is linked once, by the worker with the higher index
+        for index in range(self.index):
+            sock = self.connect(index)
+            send_frame(sock, construct_message(LINK_QUEUE, dict(coremq_worker=self.index), 2, FRAME_CONTROL))
+            reader = FrameReader(sock)
+            reader.protocol = 2
+            self.add_link(index, sock, reader)
+
+        deadline = time.time() + LINK_TIMEOUT
+        with self.lock:
+            while len(self.links) < self.count - 1:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('Worker %s timed out waiting for the other workers' % self.index)
+                self.lock.wait(remaining)
+
+        print('Worker %s linked to %s other workers' % (self.index, len(self.links)))
+
+    def connect(self, index):
+        deadline = time.time() + LINK_TIMEOUT
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path(index))
+                return sock
+            except socket.error:
+                sock.close()
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def accept(self):
+        for _ in range(self.index + 1, self.count):
+            sock, _ = self.server.accept()
+            reader = FrameReader(sock)
+            reader.protocol = 2
+            queue, payload, kind, flags, metadata = reader.read_frame(timeout=LINK_TIMEOUT)
+            self.add_link(json.loads(payload.decode('utf-8'))['coremq_worker'], sock, reader)
+
+    def add_link(self, index, sock, reader):
+        sock.settimeout(None)
+        link = PeerLink(self, index, sock, reader)
+        with self.lock:
+            self.links[index] = link
+            self.lock.notify_all()
+
+        threading.Thread(target=link.run, daemon=True).start()
+
+    def forward(self, queue, envelopes):
+        link = self.links[self.owner(queue)]
+        for envelope in envelopes:
+            link.send_frame(envelope.frame(2), link)
+
+    def request(self, queue, message):
+        """
+        Sends a request about a queue to its owner
+        """
+        self.links[self.owner(queue)].send_message(LINK_QUEUE, message)
+
+    def interest(self, queues, change, connection=False):
+        """
+        Counts the subscribers of this worker to each queue, announcing the queues that gain their first one or lose
+        their last one
+        """
+        subscribe = collections.defaultdict(list)
+        unsubscribe = collections.defaultdict(list)
+        # held while sending so announcements reach the other workers in the order they were counted
+        with self.lock:
+            for q in queues:
+                before = self.interests[q]
+                after = before + change
+                if after > 0:
+                    self.interests[q] = after
+                else:
+                    self.interests.pop(q, None)
+
+                if (before > 0) == (after > 0):
+                    continue
+
+                if is_pattern(q):
+                    indexes = list(self.links)
+                elif not self.owns(q):
+                    indexes = [self.owner(q)]
+                else:
+                    continue
+
+                for index in indexes:
+                    (subscribe if after > 0 else unsubscribe)[index].append(q)
+
+            for index, qs in subscribe.items():
+                self.links[index].send_message(LINK_QUEUE, dict(coremq_subscribe=qs, coremq_connection=connection))
+            for index, qs in unsubscribe.items():
+                self.links[index].send_message(LINK_QUEUE, dict(coremq_unsubscribe=qs))
+
+    def release(self, queue):
+        """
+        Withdraws from the owner of the queue the interest it gave this worker when the subscriber a backlog was
+        sent for is gone
+        """
+        with self.lock:
+            if not self.interests[queue]:
+                self.links[self.owner(queue)].send_message(LINK_QUEUE, dict(coremq_unsubscribe=[queue]))
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+        try:
+            os.unlink(self.path(self.index))
+            # the last worker to stop removes the directory
+            os.rmdir(self.directory)
+        except OSError:
+            pass
+
+
+def worker_store(store, index):
+    """
+    :return: LogStore - a store of its own for worker index, in a directory under the path of store
+    """
+    if store is None:
+        return None
+
+    return LogStore(os.path.join(store.path, 'worker-%s' % index), store.fsync, store.fsync_interval,
+                    store.segment_bytes, store.retention_bytes, store.retention_seconds)
+
+
+def start_workers(target, count, address, port, store=None, metrics=None):
+    """
+    Starts count broker worker processes listening on the same port
+    :param target: message_queue_process of the engine
+    :param metrics: Optional pubsub.metrics.Metrics, which each worker keeps a copy of
+    :return: list of Process
+    """
+    directory = tempfile.mkdtemp(prefix='pubsub-workers-')
+    processes = []
+    for index in range(count):
+        process = Process(target=target, args=(address, port, worker_store(store, index),
+                                               WorkerBus(index, count, directory), None, metrics))
+        process.start()
+        processes.append(process)
+
+    return processes
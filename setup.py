@@ -10,7 +10,8 @@ setup(
     install_requires=[],
     entry_points={
         'console_scripts': [
-            'start_pubsub_broker=pubsub.server:start',
+            'start_pubsub_broker=pubsub.server:main',
+            'pubsub_bench=pubsub.bench:main',
         ],
     }
 )